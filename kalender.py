@@ -5,35 +5,34 @@ __author__ = "Niklas Fiekas"
 __email__ = "niklas.fiekas@backscattering.de"
 __version__ = "0.1.0"
 
+import sys
+
+if __name__ == "__main__":
+    # Hand a plain launch to a running instance before the expensive
+    # imports below.
+    import kalender_instance
+    kalender_instance.handoff(sys.argv)
+
 from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 from PySide2.QtGui import *
 
 import datetime
-import sys
 import os
-import json
-import itertools
 import random
+import io
+import argparse
+import bisect
+import collections
+import itertools
+import math
+import colorsys
 
+from kalender_core import *
+from kalender_stats import Statistics, print_report
+import kalender_caldav
+import kalender_instance
 
-MONTH_NAMES = ["Januar", "Februar", u"März", "April", "Mai", "Juni", "Juli",
-               "August", "September", "Oktober", "November", "Dezember"]
-
-WEEKDAY_NAMES = ["Sonntag", "Montag", "Dienstag", "Mittwoch", "Donnerstag",
-                 "Freitag", "Samstag", "Sonntag"]
-
-
-SOLARIZED_ACCENT_COLORS = [
-    QColor("#b58900"),  # Yellow
-    QColor("#cb4b16"),  # Orange
-    QColor("#dc322f"),  # Red
-    QColor("#d33682"),  # Magenta
-    QColor("#6c71c4"),  # Violet
-    QColor("#268bd2"),  # Blue
-    QColor("#2aa198"),  # Cyan
-    QColor("#859900"),  # Green
-]
 
 SOLARIZED_BASE_COLOR = QColor(7, 54, 66)
 
@@ -45,193 +44,32 @@ GREEN_LIGHT_COLOR = QColor(100, 219, 100, 50)
 RED_LIGHT_COLOR = QColor(240, 130, 130, 80)
 YELLOW_LIGHT_COLOR = QColor(255, 255, 0, 50)
 
+OCCUPANCY_LEVELS = 6
 
-GOLDEN_RATIO_CONJUGATE = 0.618033988749895
-
-
-def days_of_month(month):
-    date = qdate(month, 1)
-    return date.daysInMonth()
-
-def qdate(month, day):
-    return QDate(1900 + month // 12, month % 12 + 1, day)
-
-def easter_sunday(year):
-    g = year % 19
-    c = year / 100
-    h = (c - (c / 4) - ((9 * c + 13) / 25) + 19 * g + 15) % 30
-    i = h - (h / 28) * (1 - (h / 28) * (29 / (h + 1)) * ((21 - g) / 11))
-    day = i - ((year + (year / 4) + i + 2 - c + (c / 4)) % 7) + 28
-    if day > 31:
-        return (year - 1900) * 12 + 3, day - 31
-    else:
-        return (year - 1900) * 12 + 2, day
-
-
-HOLIDAY_NONE = 0
-HOLIDAY_NEWYEAR = 1
-HOLIDAY_GOOD_FRIDAY = 2
-HOLIDAY_EASTER_MONDAY = 4
-HOLIDAY_MAY_1 = 8
-HOLIDAY_ASCENSION = 16
-HOLIDAY_PENTECOST = 32
-HOLIDAY_TAG_DER_DEUTSCHEN_EINHEIT = 64
-HOLIDAY_CHRISTMAS = 128
-HOLIDAY_SUNDAY = 256
-HOLIDAY_REFORMATIONSTAG = 512
-
-def is_holiday(month, day):
-    holiday = HOLIDAY_NONE
-
-    easter_month, easter_day = easter_sunday(1900 + month // 12)
-    easter = qdate(easter_month, easter_day)
-    date = qdate(month, day)
-
-    if date.dayOfWeek() == 7:
-        holiday |= HOLIDAY_SUNDAY
-
-    if date.addDays(2) == easter:
-        holiday |= HOLIDAY_GOOD_FRIDAY
-    elif date.addDays(-1) == easter:
-        holiday |= HOLIDAY_EASTER_MONDAY
-    elif date.addDays(-39) == easter:
-        holiday |= HOLIDAY_ASCENSION
-    elif date.addDays(-49) == easter:
-        holiday |= HOLIDAY_PENTECOST
-
-    if date.dayOfYear() == 1:
-        holiday |= HOLIDAY_NEWYEAR
-    elif date.month() == 5 and date.day() == 1:
-        holiday |= HOLIDAY_MAY_1
-    elif date.month() == 10 and date.day() == 3:
-        holiday |= HOLIDAY_TAG_DER_DEUTSCHEN_EINHEIT
-    elif date.month() == 10 and date.day() == 31:
-        holiday |= HOLIDAY_REFORMATIONSTAG
-    elif date.month() == 12 and date.day() in (25, 26):
-        holiday |= HOLIDAY_CHRISTMAS
-
-    return holiday
-
-
-class Range(object):
-    def __init__(self):
-        self.index = None
-        self.deleted = False
-        self.title = ""
-        self.notes = ""
-        self.start = QDate()
-        self.end = QDate()
-        self.color = QColor()
-
-    def copy(self):
-        r = Range()
-        r.index = self.index
-        r.deleted = self.deleted
-        r.title = self.title
-        r.notes = self.notes
-        r.start = self.start
-        r.end = self.end
-        r.color = self.color
-        return r
-
-
-class Model(QObject):
-
-    modelChanged = Signal()
-
-    def __init__(self):
-        super(Model, self).__init__()
-        self.ranges = {}
-        self.modified = False
-
-        self.undoStack = []
-        self.redoStack = []
-
-    def nextId(self):
-        return max(itertools.chain(self.ranges.keys(), [0])) + 1
-
-    def commit(self, r):
-        i = r.index if r.index else self.nextId()
-
-        if i in self.ranges:
-            restoreAction = self.ranges[i]
-            self.undoStack.append(restoreAction)
-        else:
-            deleteAction = Range()
-            deleteAction.index = i
-            deleteAction.deleted = True
-            self.undoStack.append(deleteAction)
-
-        self.ranges[i] = r.copy()
-        self.ranges[i].index = i
-        self.redoStack = []
-
-        self.modified = True
-
-        self.modelChanged.emit()
-
-    def undo(self):
-        if not self.undoStack:
-            return
-
-        action = self.undoStack.pop()
-
-        restoreAction = self.ranges[action.index]
-        self.redoStack.append(restoreAction)
-
-        self.ranges[action.index] = action.copy()
-
-        self.modelChanged.emit()
-
-    def redo(self):
-        if not self.redoStack:
-            return
-
-        action = self.redoStack.pop()
 
-        restoreAction = self.ranges[action.index]
-        self.undoStack.append(restoreAction)
-
-        self.ranges[action.index] = action.copy()
-
-        self.modelChanged.emit()
+GOLDEN_RATIO_CONJUGATE = 0.618033988749895
 
-    def save(self, path):
-        document = {}
-        for key in self.ranges:
-            r = self.ranges[key]
-            if not r.deleted:
-                document[r.index] = {
-                    "title": r.title,
-                    "notes": r.notes,
-                    "start": r.start.toString(Qt.ISODate),
-                    "end": r.end.toString(Qt.ISODate),
-                    "color": r.color.name(),
-                }
+# Month columns with more entries are drawn as stacked bars per day and
+# color, unless the column is wide enough to keep the lines apart.
+DENSITY_THRESHOLD = 24
+DENSITY_COLORS = 8
+DENSITY_OTHER_COLOR = 0x93a1a1
 
-        with open(path, "w") as handle:
-            json.dump(document, handle)
 
-        self.modified = False
+# Adapters between the Qt types and the plain values of kalender_core.
+JULIAN_DAY_OF_ORDINAL_ZERO = 1721425
 
-    @classmethod
-    def load(cls, path):
-        model = cls()
+def qdate_of_ordinal(date):
+    return QDate.fromJulianDay(date + JULIAN_DAY_OF_ORDINAL_ZERO)
 
-        with open(path, "r") as handle:
-            document = json.load(handle)
+def ordinal_of_qdate(date):
+    return date.toJulianDay() - JULIAN_DAY_OF_ORDINAL_ZERO
 
-            for key in document:
-                r = Range()
-                r.index = int(key)
-                r.title = document[key]["title"]
-                r.notes = document[key]["notes"]
-                r.start = QDate.fromString(document[key]["start"], Qt.ISODate)
-                r.end = QDate.fromString(document[key]["end"], Qt.ISODate)
-                r.color = QColor(document[key]["color"])
-                model.ranges[r.index] = r
+def qcolor(rgb):
+    return QColor((rgb >> 16) & 0xff, (rgb >> 8) & 0xff, rgb & 0xff)
 
-        return model
+def rgb_of_qcolor(color):
+    return color.rgb() & 0xffffff
 
 
 class Application(QApplication):
@@ -329,36 +167,72 @@ class RangeDialog(QDialog):
 
         layout.addWidget(QLabel("Farbe:"), 1, 0)
         self.colorBox = ColorButton()
-        self.colorBox.setColor(r.color)
+        self.colorBox.setColor(qcolor(r.color))
         self.colorBox.clicked.connect(self.onColorClicked)
         layout.addWidget(self.colorBox, 1, 1, Qt.AlignLeft)
 
         layout.addWidget(QLabel("Von:"), 2, 0)
         self.startBox = QDateEdit()
         self.startBox.setDisplayFormat("dd.MM.yyyy")
-        self.startBox.setDate(r.start)
+        self.startBox.setDate(qdate_of_ordinal(r.start))
         layout.addWidget(self.startBox, 2, 1, Qt.AlignLeft)
 
         layout.addWidget(QLabel("Bis:"), 3, 0)
         self.endBox = QDateEdit()
         self.endBox.setDisplayFormat("dd.MM.yyyy")
-        self.endBox.setDate(r.end)
+        self.endBox.setDate(qdate_of_ordinal(r.end))
         layout.addWidget(self.endBox, 3, 1, Qt.AlignLeft)
 
-        layout.addWidget(QLabel("Notizen:"), 4, 0)
+        layout.addWidget(QLabel("Wiederholung:"), 4, 0)
+        repeatLayout = QHBoxLayout()
+        self.repeatBox = QComboBox()
+        self.repeatBox.addItems(REPEAT_NAMES)
+        self.repeatBox.setCurrentIndex(r.repeat)
+        self.repeatBox.currentIndexChanged.connect(self.onRepeatChanged)
+        repeatLayout.addWidget(self.repeatBox)
+        repeatLayout.addWidget(QLabel("alle"))
+        self.intervalBox = QSpinBox()
+        self.intervalBox.setRange(1, 99)
+        self.intervalBox.setValue(r.interval)
+        repeatLayout.addWidget(self.intervalBox)
+        repeatLayout.addWidget(QLabel("bis"))
+        self.untilBox = QDateEdit()
+        self.untilBox.setDisplayFormat("dd.MM.yyyy")
+        self.untilBox.setMinimumDate(QDate(1900, 1, 1))
+        self.untilBox.setSpecialValueText("unbegrenzt")
+        self.untilBox.setDate(qdate_of_ordinal(r.until) if r.until is not None else self.untilBox.minimumDate())
+        repeatLayout.addWidget(self.untilBox)
+        repeatLayout.addStretch()
+        layout.addLayout(repeatLayout, 4, 1)
+
+        layout.addWidget(QLabel("Ausnahmen:"), 5, 0)
+        self.exceptionsBox = QLineEdit()
+        self.exceptionsBox.setPlaceholderText("TT.MM.JJJJ, ...")
+        self.exceptionsBox.setText(", ".join(qdate_of_ordinal(d).toString("dd.MM.yyyy") for d in r.exceptions))
+        layout.addWidget(self.exceptionsBox, 5, 1)
+
+        self.onRepeatChanged(r.repeat)
+
+        layout.addWidget(QLabel("Tags:"), 6, 0)
+        self.tagsBox = QLineEdit()
+        self.tagsBox.setPlaceholderText("Tag, ...")
+        self.tagsBox.setText(", ".join(tag_names(r.tags)))
+        layout.addWidget(self.tagsBox, 6, 1)
+
+        layout.addWidget(QLabel("Notizen:"), 7, 0)
         self.notesBox = QTextEdit()
         self.notesBox.setText(r.notes)
-        layout.addWidget(self.notesBox, 4, 1)
+        layout.addWidget(self.notesBox, 7, 1)
 
         deleteButton = QPushButton()
         deleteButton.setIcon(QIcon(self.app.deletePixmap))
         deleteButton.clicked.connect(self.onDelete)
-        layout.addWidget(deleteButton, 5, 0, Qt.AlignLeft)
+        layout.addWidget(deleteButton, 8, 0, Qt.AlignLeft)
 
         buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
         buttons.rejected.connect(self.reject)
         buttons.accepted.connect(self.onSave)
-        layout.addWidget(buttons, 5, 1)
+        layout.addWidget(buttons, 8, 1)
 
     def onTitleChanged(self, title):
         if self.colorExplicit:
@@ -371,14 +245,41 @@ class RangeDialog(QDialog):
         for key in self.parent.model.ranges:
             r = self.parent.model.ranges[key]
             if r.title.lower().startswith(normalized):
-                self.colorBox.setColor(r.color)
+                self.colorBox.setColor(qcolor(r.color))
                 break
 
     def onColorClicked(self):
         self.colorExplicit = True
 
+    def onRepeatChanged(self, repeat):
+        self.intervalBox.setEnabled(repeat != REPEAT_NONE)
+        self.untilBox.setEnabled(repeat != REPEAT_NONE)
+        self.exceptionsBox.setEnabled(repeat != REPEAT_NONE)
+
     def onSave(self):
-        self.parent.model.commit(self.range())
+        r = self.range()
+
+        conflicts = self.parent.calendar.conflicts.conflictsWith(r)
+        if conflicts:
+            lines = []
+            others = self.parent.model.peek(conflicts[:10], summaries=True)
+            for index in conflicts[:10]:
+                other = others[index]
+                lines.append(u"%s (%s – %s)" % (
+                    other.title or "Eintrag %d" % other.index,
+                    qdate_of_ordinal(other.start).toString("dd.MM.yyyy"),
+                    qdate_of_ordinal(other.end).toString("dd.MM.yyyy")))
+            if len(conflicts) > 10:
+                lines.append("...")
+
+            result = QMessageBox.question(
+                self, u"Überschneidung",
+                u"Der Eintrag überschneidet sich mit:\n\n%s\n\nTrotzdem speichern?" % ("\n".join(lines), ),
+                QMessageBox.Save | QMessageBox.Cancel)
+            if result != QMessageBox.Save:
+                return
+
+        self.parent.model.commit(r)
         self.accept()
 
     def onDelete(self):
@@ -391,11 +292,23 @@ class RangeDialog(QDialog):
     def range(self):
         r = Range()
         r.index = self.r.index
-        r.color = self.colorBox.color()
+        r.color = rgb_of_qcolor(self.colorBox.color())
         r.title = self.titleBox.text().strip()
-        r.start = min(self.startBox.date(), self.endBox.date())
-        r.end = max(self.startBox.date(), self.endBox.date())
+        r.start = ordinal_of_qdate(min(self.startBox.date(), self.endBox.date()))
+        r.end = ordinal_of_qdate(max(self.startBox.date(), self.endBox.date()))
         r.notes = self.notesBox.toPlainText()
+        r.tags = tag_mask(self.tagsBox.text().split(","))
+
+        r.repeat = self.repeatBox.currentIndex()
+        if r.isRecurring():
+            r.interval = self.intervalBox.value()
+            if self.untilBox.date() != self.untilBox.minimumDate():
+                r.until = ordinal_of_qdate(self.untilBox.date())
+            for text in self.exceptionsBox.text().split(","):
+                date = QDate.fromString(text.strip(), "dd.MM.yyyy")
+                if date.isValid():
+                    r.exceptions.append(ordinal_of_qdate(date))
+
         return r
 
     def closeEvent(self, event):
@@ -406,11 +319,17 @@ class RangeDialog(QDialog):
 
 class MainWindow(QMainWindow):
 
-    def __init__(self, app):
+    def __init__(self, app, background=False):
         super(MainWindow, self).__init__()
         self.app = app
+        self.background = background
+        self.quitting = False
 
         self.initWidget()
+        self.initMinimap()
+        self.initStatistics()
+        self.initAgenda()
+        self.initReminders()
         self.initOverlays()
         self.initActions()
         self.initMenu()
@@ -419,25 +338,103 @@ class MainWindow(QMainWindow):
         self.setModel(Model())
         self.path = None
 
+        self.syncEngine = None
+        self.syncPassword = None
+        self.syncSignals = SyncSignals()
+        self.syncSignals.finished.connect(self.onSyncFinished)
+
+        self.freeSlotValues = None
+
         self.restoreSettings()
+        self.hiddenMtime = os.stat(self.path).st_mtime if self.path and os.path.exists(self.path) else None
 
         self.setWindowTitle("Kalender")
         self.setWindowIcon(self.app.calendarIcon)
 
     def setModel(self, model):
+        if self.calendar.asOf is not None:
+            self.calendar.setAsOf(None)
+
         if self.model:
             self.model.modelChanged.disconnect(self.onModelChanged)
         self.model = model
         self.model.modelChanged.connect(self.onModelChanged)
+        self.statistics.setModel(model)
+        self.minimap.setModel(model)
+        self.agendaDock.setModel(model)
+        self.reminders.setModel(model)
+        self.occupancyOverlay.setModel(model)
         self.calendar.setModel(model)
         self.onModelChanged()
 
+    def initMinimap(self):
+        self.minimap = MinimapWidget(self.calendar)
+
+        self.minimapDock = QDockWidget("Jahre", self)
+        self.minimapDock.setObjectName("minimapDock")
+        self.minimapDock.setWidget(self.minimap)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.minimapDock)
+
+    def initStatistics(self):
+        self.statistics = Statistics()
+
+        self.statisticsDock = StatisticsDock(self.statistics, self)
+        self.statisticsDock.hide()
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statisticsDock)
+
+        self.selectionLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.selectionLabel)
+        self.calendar.selectionChanged.connect(self.onSelectionChanged)
+
+    def initAgenda(self):
+        self.agendaDock = AgendaDock(self.calendar, self)
+        self.agendaDock.hide()
+        self.addDockWidget(Qt.RightDockWidgetArea, self.agendaDock)
+
+    def initReminders(self):
+        self.reminders = ReminderScheduler(self)
+        self.reminders.dayChanged.connect(self.calendar.setToday)
+        self.reminders.dayChanged.connect(self.agendaDock.agenda.setToday)
+        self.reminders.remind.connect(self.onReminders)
+
+        self.trayIcon = None
+        if QSystemTrayIcon.isSystemTrayAvailable():
+            self.trayIcon = QSystemTrayIcon(self.app.calendarIcon, self)
+            self.trayIcon.setToolTip("Kalender")
+            self.trayIcon.messageClicked.connect(self.onTrayMessageClicked)
+
+    def onReminders(self, due):
+        lines = []
+        for kind, start, r in due[:10]:
+            lines.append(u"%s: %s" % ("Heute" if kind == REMINDER_TODAY else "Morgen", r.title or "Eintrag %d" % r.index))
+        if len(due) > 10:
+            lines.append(u"und %d weitere" % (len(due) - 10, ))
+
+        if self.trayIcon is not None:
+            self.trayIcon.show()
+            self.trayIcon.showMessage("Kalender", "\n".join(lines), self.app.calendarIcon, 10000)
+        else:
+            self.statusBar().showMessage(u" · ".join(lines), 30000)
+            QApplication.alert(self)
+
+    def onTrayActivated(self, reason):
+        if reason in (QSystemTrayIcon.Trigger, QSystemTrayIcon.DoubleClick):
+            self.bringToFront()
+
+    def onTrayMessageClicked(self):
+        self.showNormal()
+        self.activateWindow()
+        self.calendar.setSelection(self.calendar.today, self.calendar.today)
+
     def initOverlays(self):
+        self.occupancyOverlay = OccupancyOverlay()
+        self.calendar.addOverlay(self.occupancyOverlay)
+
         self.ferienNiedersachsenOverlay = FerienNiedersachsen()
-        self.calendar.overlays.append(self.ferienNiedersachsenOverlay)
+        self.calendar.addOverlay(self.ferienNiedersachsenOverlay)
 
         self.holidayOverlay = HolidayOverlay()
-        self.calendar.overlays.append(self.holidayOverlay)
+        self.calendar.addOverlay(self.holidayOverlay)
 
     def initActions(self):
         self.newAction = QAction("Neu", self)
@@ -453,9 +450,21 @@ class MainWindow(QMainWindow):
         self.saveAsAction = QAction("Speichern unter ...", self)
         self.saveAsAction.triggered.connect(self.onSaveAsAction)
 
+        self.importAction = QAction("Importieren (iCalendar) ...", self)
+        self.importAction.triggered.connect(self.onImportAction)
+
+        self.exportAction = QAction("Exportieren (iCalendar) ...", self)
+        self.exportAction.triggered.connect(self.onExportAction)
+
+        self.syncAction = QAction("Synchronisieren (CalDAV) ...", self)
+        self.syncAction.triggered.connect(self.onSyncAction)
+
         self.closeAction = QAction(u"Schließen", self)
         self.closeAction.triggered.connect(self.onCloseAction)
 
+        self.quitAction = QAction("Beenden", self)
+        self.quitAction.triggered.connect(self.onQuitAction)
+
         self.undoAction = QAction(u"Rückgängig", self)
         self.undoAction.setShortcut("Ctrl+Z")
         self.undoAction.triggered.connect(self.onUndoAction)
@@ -468,6 +477,13 @@ class MainWindow(QMainWindow):
         self.createAction.setShortcut("Ctrl+N")
         self.createAction.triggered.connect(self.onCreateAction)
 
+        self.copyYearAction = QAction("Jahr kopieren ...", self)
+        self.copyYearAction.triggered.connect(self.onCopyYearAction)
+
+        self.freeSlotAction = QAction(u"Freien Zeitraum suchen ...", self)
+        self.freeSlotAction.setShortcut("Ctrl+F")
+        self.freeSlotAction.triggered.connect(self.onFreeSlotAction)
+
         self.leftAction = QAction(u"Jahr zurück", self)
         self.leftAction.triggered.connect(self.calendar.onLeftClicked)
 
@@ -477,6 +493,20 @@ class MainWindow(QMainWindow):
         self.rightAction = QAction("Jahr vor", self)
         self.rightAction.triggered.connect(self.calendar.onRightClicked)
 
+        self.yearsActions = QActionGroup(self)
+        self.yearsActions.triggered.connect(self.onYearsAction)
+        for years, title, shortcut in ((1, "1 Jahr", "Ctrl+1"), (2, "2 Jahre", "Ctrl+2"), (5, "5 Jahre", "Ctrl+5"), (10, "10 Jahre", "Ctrl+0")):
+            action = self.yearsActions.addAction(title)
+            action.setCheckable(True)
+            action.setShortcut(shortcut)
+            action.setData(years)
+        self.calendar.yearsChanged.connect(self.onYearsChanged)
+
+        self.asOfAction = QAction("Stand vom ...", self)
+        self.asOfAction.setCheckable(True)
+        self.asOfAction.triggered.connect(self.onAsOfAction)
+        self.calendar.asOfChanged.connect(self.onAsOfChanged)
+
         self.holidayAction = QAction("Feiertage", self)
         self.holidayAction.setIcon(self.holidayOverlay.icon())
         self.holidayAction.setCheckable(True)
@@ -487,6 +517,21 @@ class MainWindow(QMainWindow):
         self.ferienNiedersachsenAction.setCheckable(True)
         self.ferienNiedersachsenAction.toggled.connect(self.onFerienNiedersachsenToggled)
 
+        self.occupancyAction = QAction("Belegung", self)
+        self.occupancyAction.setIcon(self.occupancyOverlay.icon())
+        self.occupancyAction.setCheckable(True)
+        self.occupancyAction.toggled.connect(self.onOccupancyToggled)
+
+        self.occupancyFilterAction = QAction("Belegung filtern ...", self)
+        self.occupancyFilterAction.triggered.connect(self.onOccupancyFilterAction)
+
+        self.conflictActions = QActionGroup(self)
+        self.conflictActions.triggered.connect(self.onConflictAction)
+        for mode, title in ((CONFLICTS_NONE, "Keine"), (CONFLICTS_BY_TITLE, "Gleicher Titel"), (CONFLICTS_BY_COLOR, "Gleiche Farbe")):
+            action = self.conflictActions.addAction(title)
+            action.setCheckable(True)
+            action.setData(mode)
+
         self.aboutAction = QAction(u"Über ...", self)
         self.aboutAction.triggered.connect(self.onAboutAction)
         self.aboutAction.setShortcut("F1")
@@ -502,26 +547,57 @@ class MainWindow(QMainWindow):
         fileMenu.addAction(self.saveAction)
         fileMenu.addAction(self.saveAsAction)
         fileMenu.addSeparator()
+        fileMenu.addAction(self.importAction)
+        fileMenu.addAction(self.exportAction)
+        fileMenu.addAction(self.syncAction)
+        fileMenu.addSeparator()
         fileMenu.addAction(self.closeAction)
+        if self.background:
+            fileMenu.addAction(self.quitAction)
 
         editMenu = self.menuBar().addMenu("Bearbeiten")
         editMenu.addAction(self.undoAction)
         editMenu.addAction(self.redoAction)
         editMenu.addSeparator()
         editMenu.addAction(self.createAction)
+        editMenu.addAction(self.copyYearAction)
+        editMenu.addAction(self.freeSlotAction)
 
         viewMenu = self.menuBar().addMenu("Ansicht")
         viewMenu.addAction(self.leftAction)
         viewMenu.addAction(self.todayAction)
         viewMenu.addAction(self.rightAction)
+        yearsMenu = viewMenu.addMenu("Zoom")
+        yearsMenu.addActions(self.yearsActions.actions())
+        viewMenu.addAction(self.asOfAction)
         viewMenu.addSeparator()
         viewMenu.addAction(self.holidayAction)
         viewMenu.addAction(self.ferienNiedersachsenAction)
+        viewMenu.addAction(self.minimapDock.toggleViewAction())
+        viewMenu.addAction(self.statisticsDock.toggleViewAction())
+        viewMenu.addAction(self.agendaDock.toggleViewAction())
+        viewMenu.addSeparator()
+        viewMenu.addAction(self.occupancyAction)
+        viewMenu.addAction(self.occupancyFilterAction)
+        conflictMenu = viewMenu.addMenu(u"Überschneidungen markieren")
+        conflictMenu.addActions(self.conflictActions.actions())
+        self.tagsMenu = viewMenu.addMenu("Tags")
+        self.tagsMenu.aboutToShow.connect(self.onTagsMenuAboutToShow)
+        self.tagsMenu.triggered.connect(self.onTagAction)
 
         infoMenu = self.menuBar().addMenu("Info")
         infoMenu.addAction(self.aboutAction)
         infoMenu.addAction(self.aboutQtAction)
 
+        if self.background and self.trayIcon is not None:
+            # The pre-started instance is reached through the tray.
+            trayMenu = QMenu(self)
+            trayMenu.addAction(u"Öffnen").triggered.connect(self.bringToFront)
+            trayMenu.addAction(self.quitAction)
+            self.trayIcon.setContextMenu(trayMenu)
+            self.trayIcon.activated.connect(self.onTrayActivated)
+            self.trayIcon.show()
+
     def initWidget(self):
         self.calendar = CalendarWidget(self.app, self)
         self.calendar.createClicked.connect(self.onCreateAction)
@@ -541,6 +617,26 @@ class MainWindow(QMainWindow):
         self.ferienNiedersachsenOverlay.enabled = bool(int(self.app.settings.value("ferienNiedersachsen", "1")))
         self.ferienNiedersachsenAction.setChecked(self.ferienNiedersachsenOverlay.enabled)
 
+        # Restore occupancy.
+        self.occupancyOverlay.enabled = bool(int(self.app.settings.value("occupancy", "0")))
+        self.occupancyAction.setChecked(self.occupancyOverlay.enabled)
+
+        # Restore zoom.
+        self.calendar.setYears(int(self.app.settings.value("years", "1")))
+        self.onYearsChanged(self.calendar.years)
+
+        # Restore conflict detection.
+        mode = int(self.app.settings.value("conflicts", str(CONFLICTS_BY_TITLE)))
+        self.calendar.setConflictMode(mode)
+        for action in self.conflictActions.actions():
+            action.setChecked(action.data() == mode)
+
+        # Restore density threshold, 0 always draws every entry.
+        self.calendar.setDensityThreshold(int(self.app.settings.value("densityThreshold", str(DENSITY_THRESHOLD))))
+
+        # Restore hidden tags.
+        self.calendar.setHiddenTags(tag_mask(self.app.settings.value("hiddenTags", "").split("\n")))
+
         # Load most recent file.
         if self.app.settings.value("path"):
             try:
@@ -562,6 +658,51 @@ class MainWindow(QMainWindow):
     def onCloseAction(self):
         self.close()
 
+    def onQuitAction(self):
+        self.quitting = True
+        if self.close():
+            self.app.quit()
+        self.quitting = False
+
+    def onInstanceRequest(self, request):
+        # From a further launch, or the command line of this one.
+        if request.get("background"):
+            return
+
+        path = request.get("path")
+        if path and path != self.path and self.askClose():
+            try:
+                self.setModel(Model.load(path))
+                self.path = path
+            except Exception as err:
+                QMessageBox.critical(self, "Fehler", u"Öffnen fehlgeschlagen.")
+                print(err)
+
+        text = (request.get("date") or "").strip()
+        if text:
+            date = QDate.fromString(text, "yyyy-MM-dd")
+            if not date.isValid():
+                date = QDate.fromString(text, "dd.MM.yyyy")
+            if date.isValid():
+                self.calendar.setSelection(ordinal_of_qdate(date), ordinal_of_qdate(date))
+
+        self.bringToFront()
+
+    def bringToFront(self):
+        if self.isHidden() and self.path:
+            # The file may have been changed while the window was hidden.
+            try:
+                if os.stat(self.path).st_mtime != self.hiddenMtime:
+                    self.setModel(Model.load(self.path))
+            except Exception as err:
+                print(err)
+
+        self.show()
+        if self.isMinimized():
+            self.showNormal()
+        self.raise_()
+        self.activateWindow()
+
     def onSaveAction(self):
         if not self.path:
             return self.onSaveAsAction()
@@ -608,14 +749,183 @@ class MainWindow(QMainWindow):
                     print(err)
                     return False
 
+    def onImportAction(self):
+        path, _ = QFileDialog.getOpenFileName(self, "iCalendar importieren", self.path, "iCalendar (*.ics)")
+        if path:
+            skipped = []
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                with io.open(path, "r", encoding="utf-8-sig") as handle:
+                    self.model.commitBatches(read_ics(handle, skipped))
+            except Exception as err:
+                QMessageBox.critical(self, "Fehler", "Importieren fehlgeschlagen.")
+                print(err)
+                return
+            finally:
+                QApplication.restoreOverrideCursor()
+
+            if skipped:
+                lines = [u"%s: %s" % (title or "Ohne Titel", reason) for title, reason in skipped[:10]]
+                if len(skipped) > 10:
+                    lines.append("...")
+                QMessageBox.warning(
+                    self, "iCalendar importieren",
+                    u"%d Termine wurden nicht importiert:\n\n%s" % (len(skipped), "\n".join(lines)))
+
+    def onExportAction(self):
+        path, _ = QFileDialog.getSaveFileName(self, "iCalendar exportieren", self.path, "iCalendar (*.ics)")
+        if path:
+            if not path.endswith(".ics"):
+                path += ".ics"
+
+            try:
+                with io.open(path, "w", encoding="utf-8", newline="") as handle:
+                    write_ics(self.model, handle)
+            except Exception as err:
+                QMessageBox.critical(self, "Fehler", "Exportieren fehlgeschlagen.")
+                print(err)
+
+    def onSyncAction(self):
+        if not self.path and not self.onSaveAsAction():
+            return
+
+        dialog = CalDAVDialog(self.app.settings.value("caldavUrl", ""), self.app.settings.value("caldavUser", ""), self.syncPassword or "", self)
+        if not dialog.exec_():
+            return
+
+        url, username, password = dialog.values()
+        self.app.settings.setValue("caldavUrl", url)
+        self.app.settings.setValue("caldavUser", username)
+        self.syncPassword = password
+
+        if self.syncEngine is not None:
+            self.syncEngine.close()
+        self.syncEngine = kalender_caldav.SyncEngine(url, username, password)
+        self.syncState = kalender_caldav.SyncState.load(kalender_caldav.caldav_state_path(self.path), url)
+        self.syncModel = self.model
+        self.syncPath = self.path
+
+        # The network part runs on a background thread, the result comes
+        # back through a queued signal.
+        self.syncAction.setEnabled(False)
+        self.statusBar().showMessage("Synchronisiere ...")
+        self.syncEngine.start(self.syncState, self.model.document(), self.syncSignals.finished.emit)
+
+    def onSyncFinished(self, result):
+        self.syncAction.setEnabled(True)
+        self.statusBar().clearMessage()
+
+        if isinstance(result, Exception):
+            QMessageBox.critical(self, "Fehler", "Synchronisieren fehlgeschlagen.")
+            print(result)
+            return
+
+        if self.syncModel is not self.model or self.syncPath != self.path:
+            # Another file was opened in the meantime.
+            return
+
+        try:
+            applied = kalender_caldav.apply_sync_result(self.model, self.syncState, result)
+            self.model.save(self.path)
+            self.syncState.save(kalender_caldav.caldav_state_path(self.path))
+        except Exception as err:
+            QMessageBox.critical(self, "Fehler", "Speichern fehlgeschlagen.")
+            print(err)
+            return
+
+        message = u"Synchronisiert: %d empfangen, %d gesendet" % (applied, result.pushed)
+        if result.conflicts:
+            message += u", %d Konflikte" % (len(result.conflicts), )
+        if result.errors:
+            message += u", %d Fehler" % (len(result.errors), )
+        self.statusBar().showMessage(message, 10000)
+
     def onHolidaysToggled(self, checked):
         self.holidayOverlay.enabled = checked
+        self.calendar.invalidate()
         self.calendar.repaint()
 
     def onFerienNiedersachsenToggled(self, checked):
         self.ferienNiedersachsenOverlay.enabled = checked
+        self.calendar.invalidate()
+        self.calendar.repaint()
+
+    def onOccupancyToggled(self, checked):
+        self.occupancyOverlay.enabled = checked
+        self.calendar.invalidate()
         self.calendar.repaint()
 
+    def onOccupancyFilterAction(self):
+        dialog = OccupancyFilterDialog(self.occupancyOverlay, self)
+        if dialog.exec_():
+            self.calendar.invalidate()
+            self.calendar.repaint()
+
+    def onYearsAction(self, action):
+        self.calendar.setYears(action.data())
+
+    def onYearsChanged(self, years):
+        for action in self.yearsActions.actions():
+            action.setChecked(action.data() == years)
+
+    def onAsOfAction(self, checked):
+        if not checked:
+            self.calendar.setAsOf(None)
+            return
+
+        self.asOfAction.setChecked(False)
+
+        history = History(history_path(self.path)) if self.path else None
+        versions = history.versions() if history else []
+        if not versions:
+            QMessageBox.information(self, "Stand vom", u"Für diese Datei wurden noch keine Versionen gespeichert.")
+            return
+
+        dialog = AsOfDialog(parse_date(versions[0][0]), self)
+        if dialog.exec_():
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                self.calendar.setAsOf(dialog.date(), history.modelAt(dialog.date()))
+            except Exception as err:
+                QMessageBox.critical(self, "Fehler", "Laden der Version fehlgeschlagen.")
+                print(err)
+            finally:
+                QApplication.restoreOverrideCursor()
+
+    def onAsOfChanged(self):
+        self.asOfAction.setChecked(self.calendar.asOf is not None)
+        self.createAction.setEnabled(self.calendar.asOf is None)
+        self.copyYearAction.setEnabled(self.calendar.asOf is None)
+        self.freeSlotAction.setEnabled(self.calendar.asOf is None)
+        self.agendaDock.setModel(self.calendar.model)
+        self.onModelChanged()
+
+    def onTagsMenuAboutToShow(self):
+        # Tags in use with their number of entries, checked ones are shown.
+        self.tagsMenu.clear()
+
+        names = self.calendar.tagCounts.names()
+        for name in names:
+            action = self.tagsMenu.addAction("%s (%d)" % (name, self.calendar.tagCounts.count(name)))
+            action.setCheckable(True)
+            action.setChecked(not self.calendar.hiddenTags & tag_mask([name]))
+            action.setData(name)
+
+        if names:
+            self.tagsMenu.addSeparator()
+            self.tagsMenu.addAction("Alle anzeigen")
+        else:
+            self.tagsMenu.addAction("Keine Tags vergeben").setEnabled(False)
+
+    def onTagAction(self, action):
+        if action.data():
+            self.calendar.setHiddenTags(self.calendar.hiddenTags ^ tag_mask([action.data()]))
+        else:
+            self.calendar.setHiddenTags(0)
+
+    def onConflictAction(self, action):
+        self.calendar.setConflictMode(action.data())
+
     def onUndoAction(self):
         self.calendar.model.undo()
 
@@ -625,17 +935,79 @@ class MainWindow(QMainWindow):
     def onModelChanged(self):
         self.undoAction.setEnabled(bool(self.calendar.model.undoStack))
         self.redoAction.setEnabled(bool(self.calendar.model.redoStack))
+        self.statisticsDock.refresh()
+        self.onSelectionChanged()
+
+    def onSelectionChanged(self):
+        summary = self.statistics.summary(
+            self.calendar.selectionStart(), self.calendar.selectionEnd())
+        self.selectionLabel.setText("%d Tage, %d Arbeitstage (%d ohne Ferien), %d belegt" % (
+            summary["days"], summary["workingDays"], summary["workingDaysOutsideVacations"], summary["bookedDays"]))
 
     def onCreateAction(self):
         r = Range()
         r.start = self.calendar.selectionStart()
         r.end = self.calendar.selectionEnd()
-        r.color = random.choice(SOLARIZED_ACCENT_COLORS)
+        r.color = random.choice(ACCENT_COLORS)
 
         dialog = RangeDialog(self.app, r, self)
         dialog.show()
 
+    def onCopyYearAction(self):
+        if self.calendar.asOf is not None:
+            return
+
+        year = year_of(self.calendar.selectionStart())
+        dialog = CopyYearDialog(year, year + 1, self)
+        if not dialog.exec_():
+            return
+
+        source, target, mode, title, color, skipHolidays = dialog.values()
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            # Both years completely, for the entries and for the duplicates.
+            for year in (source, target):
+                self.model.ensureDates(ordinal(month_index(year, 1), 1), ordinal(month_index(year, 12), 31))
+            copies = copy_year(self.calendar.monthIndex, source, target, mode, title, color, skipHolidays)
+            self.model.commitMany(copies)
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        self.statusBar().showMessage(u"%d Einträge nach %d kopiert" % (len(copies), target), 10000)
+        if copies:
+            self.calendar.scrollToMonth(month_index(target, 1))
+
+    def onFreeSlotAction(self):
+        if self.calendar.asOf is not None:
+            return
+
+        dialog = FreeSlotDialog(self.freeSlotValues or (5, self.calendar.selectionStart(), "", None, False), self)
+        if not dialog.exec_():
+            return
+
+        self.freeSlotValues = dialog.values()
+        length, earliest, title, color, vacations = self.freeSlotValues
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            self.model.ensureDates(earliest, earliest + FREE_SLOT_HORIZON)
+            slot = free_slot(self.calendar.monthIndex, length, earliest, title, color, vacations)
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        if slot is None:
+            self.statusBar().showMessage(u"Kein freier Zeitraum in den nächsten %d Jahren" % (FREE_SLOT_HORIZON // 366, ), 10000)
+            return
+
+        # Preselected, so that Enter creates the entry.
+        self.calendar.setSelection(*slot)
+        self.calendar.setFocus()
+        self.statusBar().showMessage(u"Frei vom %s bis %s, Eingabe erstellt den Eintrag" % (
+            qdate_of_ordinal(slot[0]).toString("dd.MM.yyyy"), qdate_of_ordinal(slot[1]).toString("dd.MM.yyyy")), 10000)
+
     def onCalendarAction(self, action):
+        if self.calendar.asOf is not None:
+            return
+
         index = action.data()
         r = self.model.ranges[index]
 
@@ -674,26 +1046,423 @@ class MainWindow(QMainWindow):
             self.app.settings.setValue("windowState", self.saveState())
             self.app.settings.setValue("holidays", str(int(self.holidayOverlay.enabled)))
             self.app.settings.setValue("ferienNiedersachsen", str(int(self.ferienNiedersachsenOverlay.enabled)))
+            self.app.settings.setValue("occupancy", str(int(self.occupancyOverlay.enabled)))
+            self.app.settings.setValue("conflicts", str(self.calendar.conflicts.mode))
+            self.app.settings.setValue("years", str(self.calendar.years))
+            self.app.settings.setValue("hiddenTags", "\n".join(tag_names(self.calendar.hiddenTags)))
 
             if self.path:
                 self.app.settings.setValue("path", self.path)
             else:
                 self.app.settings.remove("path")
 
+            if self.background and not self.quitting:
+                # Stay around for the next launch, with the saved state.
+                self.hide()
+                event.ignore()
+                self.setModel(Model.load(self.path) if self.path else Model())
+                self.hiddenMtime = os.stat(self.path).st_mtime if self.path else None
+                return
+
+            self.calendar.shutdown()
+            self.minimap.shutdown()
+            if self.syncEngine is not None:
+                self.syncEngine.close()
+
             event.accept()
         else:
             event.ignore()
 
 
-class HolidayOverlay(object):
-    def __init__(self):
-        self.brush = QBrush(RED_LIGHT_COLOR)
+class StatisticsDock(QDockWidget):
+    def __init__(self, statistics, parent):
+        super(StatisticsDock, self).__init__("Statistik", parent)
+        self.setObjectName("statisticsDock")
+        self.statistics = statistics
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+
+        self.yearBox = QSpinBox()
+        self.yearBox.setRange(1900, 2199)
+        self.yearBox.setValue(QDate.currentDate().year())
+        self.yearBox.valueChanged.connect(self.refresh)
+        layout.addWidget(self.yearBox)
+
+        self.monthTable = QTableWidget(13, 4)
+        self.monthTable.setHorizontalHeaderLabels(["Tage", "Arbeitstage", "Belegt", "Belegt (Arbeit)"])
+        self.monthTable.setVerticalHeaderLabels(MONTH_NAMES + ["Summe"])
+        self.monthTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.monthTable)
+
+        self.titleTable = QTableWidget(0, 2)
+        self.titleTable.setHorizontalHeaderLabels(["Titel", "Belegt"])
+        self.titleTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.titleTable.verticalHeader().hide()
+        self.titleTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.titleTable)
+
+        self.setWidget(widget)
+
+        self.visibilityChanged.connect(self.refresh)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+
+        year = self.yearBox.value()
+
+        months = self.statistics.months(year)
+        columns = ["days", "workingDays", "bookedDays", "bookedWorkingDays"]
+        for column, key in enumerate(columns):
+            for row in range(12):
+                self.monthTable.setItem(row, column, QTableWidgetItem(str(months[key][row])))
+            self.monthTable.setItem(12, column, QTableWidgetItem(str(months[key].sum())))
+
+        titles = self.statistics.titles(year)
+        self.titleTable.setRowCount(len(titles))
+        for row, (title, days) in enumerate(titles):
+            self.titleTable.setItem(row, 0, QTableWidgetItem(title or "(ohne Titel)"))
+            self.titleTable.setItem(row, 1, QTableWidgetItem(str(days)))
+
+
+AGENDA_FETCH_SIZE = 256
+AGENDA_RESET_SIZE = 1000
+
+AGENDA_COLOR = 0
+AGENDA_START = 1
+AGENDA_END = 2
+AGENDA_TITLE = 3
+AGENDA_TAGS = 4
+
+
+class AgendaModel(QAbstractTableModel):
+    # Rows are kept as a sorted list of sort keys ending with the range id.
+    # Changes of the model are applied by bisecting old and new keys, the
+    # view gets rows in chunks as it scrolls. Rows cover all years, rows of
+    # years that are not loaded are shown from the summaries in the index,
+    # only their notes are read from the year itself.
+    def __init__(self, parent=None):
+        super(AgendaModel, self).__init__(parent)
+        self.model = None
+        self.column = AGENDA_START
+        self.order = Qt.AscendingOrder
+        self.hiddenTags = 0
+        self.keys = []
+        self.fetched = 0
+        self.peeked = {}
+        self.today = datetime.date.today().toordinal()
+        self.pastBrush = QBrush(QColor(128, 128, 128))
+
+    def setModel(self, model):
+        if self.model:
+            self.model.rangesChanged.disconnect(self.applyChanges)
+        self.model = model
+        self.model.rangesChanged.connect(self.applyChanges)
+        self.rebuild()
+
+    def setHiddenTags(self, mask):
+        if mask != self.hiddenTags:
+            self.hiddenTags = mask
+            self.rebuild()
+
+    def setToday(self, date):
+        self.today = date
+        if self.fetched:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.fetched - 1, AGENDA_TAGS))
+
+    def visible(self, r):
+        return not r.deleted and r.start is not None and not r.tags & self.hiddenTags
+
+    def sortKey(self, r):
+        if self.column == AGENDA_COLOR:
+            rgb = qcolor(r.color)
+            return (colorsys.rgb_to_hsv(rgb.redF(), rgb.greenF(), rgb.blueF()), r.start, r.index)
+        elif self.column == AGENDA_END:
+            return (r.end, r.start, r.index)
+        elif self.column == AGENDA_TITLE:
+            return (r.title.casefold(), r.start, r.index)
+        elif self.column == AGENDA_TAGS:
+            return (tag_names(r.tags), r.start, r.index)
+        return (r.start, r.end, r.index)
+
+    def rebuild(self):
+        self.beginResetModel()
+        self.keys = sorted(self.sortKey(r) for r in self.model.summaryRanges() if self.visible(r))
+        self.fetched = min(len(self.keys), AGENDA_FETCH_SIZE)
+        self.peeked = {}
+        self.prefetch(0, self.fetched)
+        self.endResetModel()
+
+    def prefetch(self, first, last):
+        # Rows about to be shown, read together per year.
+        missing = []
+        for row in range(first, last):
+            i = self.keys[self.rowOfPosition(row)][-1]
+            if i not in self.model.ranges and i not in self.peeked:
+                missing.append(i)
+        if missing:
+            self.peeked.update(self.model.peek(missing, summaries=True))
+
+    def rangeOf(self, i):
+        r = self.model.ranges.get(i)
+        if r is None:
+            if i not in self.peeked:
+                self.peeked.update(self.model.peek([i], summaries=True))
+            r = self.peeked[i]
+        return r
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column == self.column and order == self.order:
+            return
+
+        if column == self.column:
+            # Reversing only changes the mapping of rows to keys.
+            self.beginResetModel()
+            self.order = order
+            self.fetched = min(len(self.keys), AGENDA_FETCH_SIZE)
+            self.prefetch(0, self.fetched)
+            self.endResetModel()
+        else:
+            self.column = column
+            self.order = order
+            if self.model is not None:
+                self.rebuild()
+
+    def rowOfPosition(self, position, count=None):
+        if self.order == Qt.AscendingOrder:
+            return position
+        return (len(self.keys) if count is None else count) - 1 - position
+
+    def rangeAt(self, row):
+        return self.rangeOf(self.keys[self.rowOfPosition(row)][-1])
+
+    def rowOfRange(self, r):
+        # Fetches rows up to the range, so an index for it exists.
+        if not self.visible(r):
+            return None
+
+        key = self.sortKey(r)
+        position = bisect.bisect_left(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+
+        row = self.rowOfPosition(position)
+        if row >= self.fetched:
+            self.prefetch(self.fetched, row + 1)
+            self.beginInsertRows(QModelIndex(), self.fetched, row)
+            self.fetched = row + 1
+            self.endInsertRows()
+        return row
+
+    def firstRowFrom(self, date):
+        # Row of the first range ending on or after date, by start.
+        if self.column != AGENDA_START:
+            return None
+
+        position = bisect.bisect_left(self.keys, (date, ))
+        while position < len(self.keys) and self.rangeOf(self.keys[position][-1]).end < date:
+            position += 1
+        if position == len(self.keys):
+            return None
+        return self.rowOfRange(self.rangeOf(self.keys[position][-1]))
+
+    def applyChanges(self, changes):
+        if len(changes) > AGENDA_RESET_SIZE:
+            self.rebuild()
+            return
+
+        for before, after in changes:
+            self.peeked.pop(before.index, None)
+            oldKey = self.sortKey(before) if self.visible(before) else None
+            newKey = self.sortKey(after) if self.visible(after) else None
+
+            if oldKey is not None and oldKey == newKey:
+                row = self.rowOfPosition(bisect.bisect_left(self.keys, oldKey))
+                if row < self.fetched:
+                    self.dataChanged.emit(self.index(row, 0), self.index(row, AGENDA_TAGS))
+                continue
+
+            if oldKey is not None:
+                self.removeKey(oldKey)
+            if newKey is not None:
+                self.insertKey(newKey)
+
+    def removeKey(self, key):
+        position = bisect.bisect_left(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return
+
+        row = self.rowOfPosition(position)
+        if row < self.fetched:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.keys[position]
+            self.fetched -= 1
+            self.endRemoveRows()
+        else:
+            del self.keys[position]
+
+    def insertKey(self, key):
+        position = bisect.bisect_left(self.keys, key)
+        row = self.rowOfPosition(position, len(self.keys) + 1)
+        if row < self.fetched or self.fetched == len(self.keys):
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.keys.insert(position, key)
+            self.fetched += 1
+            self.endInsertRows()
+        else:
+            self.keys.insert(position, key)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.keys)
+
+    def fetchMore(self, parent):
+        count = min(AGENDA_FETCH_SIZE, len(self.keys) - self.fetched)
+        if parent.isValid() or count <= 0:
+            return
+
+        self.prefetch(self.fetched, self.fetched + count)
+        self.beginInsertRows(QModelIndex(), self.fetched, self.fetched + count - 1)
+        self.fetched += count
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else AGENDA_TAGS + 1
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return ["Farbe", "Beginn", "Ende", "Titel", "Tags"][section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.fetched:
+            return None
+
+        r = self.rangeAt(index.row())
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            if column == AGENDA_START:
+                return qdate_of_ordinal(r.start).toString("dd.MM.yyyy")
+            elif column == AGENDA_END:
+                return qdate_of_ordinal(r.end).toString("dd.MM.yyyy")
+            elif column == AGENDA_TITLE:
+                return r.title or "Eintrag %d" % r.index
+            elif column == AGENDA_TAGS:
+                return ", ".join(tag_names(r.tags))
+        elif role == Qt.DecorationRole and column == AGENDA_COLOR:
+            return qcolor(r.color)
+        elif role == Qt.ForegroundRole:
+            if r.end < self.today and not (r.isRecurring() and (r.until is None or r.until >= self.today)):
+                return self.pastBrush
+        elif role == Qt.ToolTipRole:
+            if r.index not in self.model.ranges:
+                r = self.model.peek([r.index])[r.index]
+            if r.notes.strip():
+                return r.notes.strip()
+
+        return None
+
+
+class AgendaDock(QDockWidget):
+    # All entries as a sortable list. The current row and the selection of
+    # the calendar follow each other.
+    def __init__(self, calendar, parent):
+        super(AgendaDock, self).__init__("Agenda", parent)
+        self.setObjectName("agendaDock")
+        self.calendar = calendar
+        self.following = False
+
+        self.agenda = AgendaModel(self)
+
+        self.view = QTableView()
+        self.view.setModel(self.agenda)
+        self.view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.view.setWordWrap(False)
+        self.view.verticalHeader().hide()
+        self.view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.view.verticalHeader().setDefaultSectionSize(self.view.fontMetrics().height() + 6)
+        self.view.horizontalHeader().setSectionResizeMode(AGENDA_COLOR, QHeaderView.ResizeToContents)
+        self.view.horizontalHeader().setSectionResizeMode(AGENDA_TITLE, QHeaderView.Stretch)
+        self.view.horizontalHeader().setSortIndicator(AGENDA_START, Qt.AscendingOrder)
+        self.view.setSortingEnabled(True)
+        self.view.selectionModel().currentRowChanged.connect(self.onCurrentRowChanged)
+        self.setWidget(self.view)
+
+        self.calendar.selectionChanged.connect(self.onCalendarSelectionChanged)
+        self.calendar.hiddenTagsChanged.connect(self.onHiddenTagsChanged)
+
+    def setModel(self, model):
+        self.agenda.setModel(model)
+        self.scrollToDate(self.agenda.today)
+
+    def onHiddenTagsChanged(self):
+        self.agenda.setHiddenTags(self.calendar.hiddenTags)
+
+    def scrollToDate(self, date):
+        row = self.agenda.firstRowFrom(date)
+        if row is not None:
+            self.view.scrollTo(self.agenda.index(row, AGENDA_START), QAbstractItemView.PositionAtTop)
+
+    def onCurrentRowChanged(self, current, previous):
+        if self.following or not current.isValid():
+            return
+
+        r = self.agenda.rangeAt(current.row())
+        self.following = True
+        try:
+            self.calendar.setSelection(r.start, r.end)
+        finally:
+            self.following = False
+
+    def onCalendarSelectionChanged(self):
+        if self.following:
+            return
+
+        # The range with the latest start that covers the selection start.
+        start, end = self.calendar.selectionStart(), self.calendar.selectionEnd()
+        best = None
+        for r in self.calendar.monthIndex.rangesOfMonth(month_and_day(start)[0]):
+            if not self.agenda.visible(r):
+                continue
+            for first, last in r.occurrences(start, end):
+                if first <= start <= last and (best is None or first > best[0]):
+                    best = (first, r)
+                break
+
+        self.following = True
+        try:
+            if best is None:
+                self.view.selectionModel().clear()
+            else:
+                row = self.agenda.rowOfRange(best[1])
+                if row is not None:
+                    index = self.agenda.index(row, AGENDA_TITLE)
+                    self.view.selectionModel().setCurrentIndex(index, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+                    self.view.scrollTo(index)
+        finally:
+            self.following = False
+
+
+class Overlay(object):
+    # Overlays either implement matches() for single days or monthMask()
+    # with one match value per day. Runs of equal values are drawn at once.
+    def __init__(self, brush):
+        self.brush = QBrush(brush)
         self.enabled = True
 
     def matches(self, month, day):
-        return self.enabled and is_holiday(month, day)
+        return False
+
+    def monthMask(self, month):
+        return [self.matches(month, day) for day in range(1, days_of_month(month) + 1)]
 
-    def draw(self, painter, rect):
+    def draw(self, painter, rect, match=True):
         painter.fillRect(rect, self.brush)
 
     def icon(self):
@@ -708,148 +1477,1024 @@ class HolidayOverlay(object):
         return QIcon(pixmap)
 
 
-class FerienNiedersachsen(HolidayOverlay):
+class HolidayOverlay(Overlay):
     def __init__(self):
-        self.brush = QBrush(GREEN_LIGHT_COLOR)
-        self.enabled = True
+        super(HolidayOverlay, self).__init__(RED_LIGHT_COLOR)
 
     def matches(self, month, day):
+        return self.enabled and is_holiday(month, day)
+
+    def monthMask(self, month):
         if not self.enabled:
-            return False
+            return [HOLIDAY_NONE] * days_of_month(month)
+        return holidays_of_month(month)
 
-        year = 1900 + month // 12
-        date = qdate(month, day)
-        match = False
-
-        if year in [2013, 2014]:
-            match |= QDate(2013, 1, 31) <= date <= QDate(2013, 2, 1)  # Winter
-            match |= QDate(2013, 3, 16) <= date <= QDate(2013, 4, 2)  # Ostern
-            match |= (date == QDate(2013, 5, 10)) or (date == QDate(2013, 5, 21))  # Pfingsten
-            match |= QDate(2013, 6, 27) <= date <= QDate(2013, 8, 7)  # Sommer
-            match |= QDate(2013, 10, 4) <= date <= QDate(2013, 10, 18)  # Herbst
-            match |= QDate(2013, 12, 23) <= date <= QDate(2014, 1, 3)  # Weihnachten
-
-        if year in [2014, 2015]:
-            match |= QDate(2014, 1, 30) <= date <= QDate(2014, 1, 31)  # Winter
-            match |= (QDate(2014, 4, 3) <= date <= QDate(2014, 4, 22)) or (date == QDate(2014, 5, 2))  # Ostern
-            match |= (date == QDate(2014, 5, 30)) or (date == QDate(2014, 6, 10))  # Pfingsten
-            match |= QDate(2014, 7, 31) <= date <= QDate(2014, 9, 10)  # Sommer
-            match |= QDate(2014, 10, 27) <= date <= QDate(2014, 11, 8)  # Herbst
-            match |= QDate(2014, 12, 22) <= date <= QDate(2015, 1, 5)  # Weihnachten
-
-        if year in [2015, 2016]:
-            match |= QDate(2015, 2, 2) <= date <= QDate(2015, 2, 3)  # Winter
-            match |= QDate(2015, 3, 25) <= date <= QDate(2014, 4, 10)  # Ostern
-            match |= (date == QDate(2015, 5, 15)) or (date == QDate(2015, 5, 26))  # Pfingsten
-            match |= QDate(2015, 7, 23) <= date <= QDate(2015, 9, 2)  # Sommer
-            match |= QDate(2015, 10, 19) <= date <= QDate(2015, 10, 31)  # Herbst
-            match |= QDate(2015, 12, 23) <= date <= QDate(2016, 1, 6)  # Weihnachten
-
-        if year in [2016, 2017]:
-            match |= QDate(2016, 1, 28) <= date <= QDate(2016, 1, 29)  # Winter
-            match |= QDate(2016, 3, 18) <= date <= QDate(2016, 4, 2)  # Ostern
-            match |= (date == QDate(2016, 5, 6)) or (date == QDate(2016, 5, 17))  # Pfingsten
-            match |= QDate(2016, 6, 23) <= date <= QDate(2016, 8, 3)  # Sommer
-            match |= QDate(2016, 10, 3) <= date <= QDate(2016, 10, 15)  # Herbst
-            match |= QDate(2016, 12, 21) <= date <= QDate(2017, 1, 6)  # Weihnachten
-
-        if year in [2017, 2018]:
-            match |= QDate(2017, 1, 30) <= date <= QDate(2017, 1, 31)  # Winter
-            match |= QDate(2017, 4, 10) <= date <= QDate(2017, 4, 22)  # Ostern
-            match |= (date == QDate(2017, 5, 26)) or (date == QDate(2017, 6, 6))  # Pfingsten
-            match |= QDate(2017, 6, 22) <= date <= QDate(2017, 8, 2)  # Sommer
-            match |= QDate(2017, 10, 2) <= date <= QDate(2017, 10, 13)  # Herbst
-            match |= date == QDate(2017, 10, 30)  # Brückentag
-            match |= date == QDate(2017, 10, 31)  # Reformationstag
-            match |= QDate(2017, 12, 22) <= date <= QDate(2018, 1, 5)  # Weihnachten
-
-        if year in [2018, 2019]:
-            match |= QDate(2018, 2, 1) <= date <= QDate(2018, 2, 2)  # Winter
-            match |= QDate(2018, 3, 19) <= date <= QDate(2018, 4, 3)  # Ostern
-            match |= date in [QDate(2018, 4, 30), QDate(2018, 5, 11), QDate(2018, 5, 22)]  # Pfingsten
-            match |= QDate(2018, 6, 28) <= date <= QDate(2018, 8, 8)  # Sommer
-            match |= QDate(2018, 10, 1) <= date <= QDate(2018, 10, 12)  # Herbst
-            match |= QDate(2018, 12, 24) <= date <= QDate(2019, 1, 4)  # Weihnachten
-
-        if year in [2019, 2020]:
-            match |= QDate(2019, 1, 31) <= date <= QDate(2019, 2, 1)  # Winter
-            match |= QDate(2019, 4, 8) <= date <= QDate(2019, 4, 23)  # Ostern
-            match |= date in [QDate(2019, 5, 31), QDate(2019, 6, 11)]  # Pfingsten
-            match |= QDate(2019, 7, 4) <= date <= QDate(2019, 8, 14)  # Sommer
-            match |= QDate(2019, 10, 4) <= date <= QDate(2019, 10, 18)  # Herbst
-            match |= QDate(2019, 12, 23) <= date <= QDate(2020, 1, 6)  # Weihnachten
-
-        if year in [2020, 2021]:
-            match |= QDate(2020, 2, 3) <= date <= QDate(2020, 2, 4)  # Winter
-            match |= QDate(2020, 3, 30) <= date <= QDate(2010, 4, 14)  # Ostern
-            match |= date in [QDate(2020, 5, 22), QDate(2020, 6, 2)]  # Pfingsten
-            match |= QDate(2020, 7, 16) <= date <= QDate(2020, 8, 26)  # Sommer
-            match |= QDate(2020, 10, 12) <= date <= QDate(2020, 10, 23)  # Herbst
-            match |= QDate(2020, 12, 23) <= date <= QDate(2021, 1, 8)  # Weihnachten
-
-        if year in [2021, 2022]:
-            match |= QDate(2021, 2, 1) <= date <= QDate(2021, 2, 2)  # Winter
-            match |= QDate(2021, 3, 29) <= date <= QDate(2021, 4, 9)  # Ostern
-            match |= date in [QDate(2021, 5, 14), QDate(2021, 5, 25)]  # Pfingsten
-            match |= QDate(2021, 7, 22) <= date <= QDate(2021, 9, 1)  # Sommer
-            match |= QDate(2021, 10, 18) <= date <= QDate(2021, 10, 29)  # Herbst
-            match |= QDate(2021, 12, 23) <= date <= QDate(2022, 1, 7)  # Weihnachten
-
-        return match
 
+class OccupancyOverlay(Overlay):
+    def __init__(self):
+        super(OccupancyOverlay, self).__init__(QColor(108, 113, 196, 150))
+        self.brushes = [QBrush(QColor(108, 113, 196, 150 * level // OCCUPANCY_LEVELS)) for level in range(OCCUPANCY_LEVELS + 1)]
+        self.enabled = False
 
-class VariantAnimation(QVariantAnimation):
-    def updateCurrentValue(self, value):
-        pass
+        self.title = ""
+        self.color = None
 
+        self.model = None
+        self.occupancy = Occupancy()
 
-MOUSE_DOWN_NONE = 0
-MOUSE_DOWN_MONTH = 1
-MOUSE_DOWN_DAY = 2
-MOUSE_DOWN_LEFT = 3
-MOUSE_DOWN_RIGHT = 4
-MOUSE_DOWN_TODAY = 5
-MOUSE_DOWN_NEW = 6
+    def setModel(self, model):
+        if self.model:
+            self.model.rangesChanged.disconnect(self.occupancy.apply)
+            self.model.residentChanged.disconnect(self.occupancy.apply)
+        self.model = model
+        self.model.rangesChanged.connect(self.occupancy.apply)
+        self.model.residentChanged.connect(self.occupancy.apply)
+        self.occupancy.reset(model.ranges.values())
 
+    def setFilter(self, title, color):
+        self.title = title.strip().lower()
+        self.color = color
 
-class CalendarWidget(QWidget):
+        accept = None
+        if self.title or self.color is not None:
+            accept = self.accepts
 
-    createClicked = Signal()
+        if self.model:
+            self.model.rangesChanged.disconnect(self.occupancy.apply)
+            self.model.residentChanged.disconnect(self.occupancy.apply)
+        self.occupancy = Occupancy(accept)
+        if self.model:
+            self.model.rangesChanged.connect(self.occupancy.apply)
+            self.model.residentChanged.connect(self.occupancy.apply)
+            self.occupancy.reset(self.model.ranges.values())
 
-    def __init__(self, app, parent=None):
-        super(CalendarWidget, self).__init__(parent)
-        self.app = app
+    def accepts(self, r):
+        if self.title and r.title.lower() != self.title:
+            return False
+        if self.color is not None and r.color != self.color:
+            return False
+        return True
 
-        self.setFocusPolicy(Qt.StrongFocus)
+    def matches(self, month, day):
+        return self.enabled and self.occupancy.count(ordinal(month, day))
 
-        self.targetOffset = float(QDate.currentDate().year() - 1900) * 12
-        self.offset = self.targetOffset
+    def monthMask(self, month):
+        if not self.enabled:
+            return [0] * days_of_month(month)
+        return [min(count, OCCUPANCY_LEVELS) for count in self.occupancy.countsOfMonth(month)]
 
-        self.overlays = []
-        self.model = None
-        self.setModel(Model())
+    def draw(self, painter, rect, match=True):
+        painter.fillRect(rect, self.brushes[min(match, OCCUPANCY_LEVELS)])
 
-        self.selection_end = QDate.currentDate()
-        self.selection_start = self.selection_end
-        self.mouse_down = MOUSE_DOWN_NONE
 
-        self.animation = VariantAnimation(self)
-        self.animation.setEasingCurve(QEasingCurve(QEasingCurve.InOutQuad))
-        self.animation.valueChanged.connect(self.onAnimate)
-        self.animation.setDuration(1000)
-        self.animationEnabled = False
+class ReminderScheduler(QObject):
+    # One timer, armed for the next due reminder or the next midnight,
+    # whichever comes first.
+    dayChanged = Signal(int)
+    remind = Signal(object)
 
-        self.actions = QActionGroup(self)
+    def __init__(self, parent=None):
+        super(ReminderScheduler, self).__init__(parent)
+        self.model = None
+        self.today = datetime.date.today().toordinal()
+        self.reminders = Reminders()
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.onTimeout)
 
     def setModel(self, model):
+        # Reminders are only due around today, the model never evicts
+        # those years, so the loaded ranges are enough.
         if self.model:
-            self.model.modelChanged.disconnect(self.update)
+            self.model.rangesChanged.disconnect(self.onRangesChanged)
+            self.model.residentChanged.disconnect(self.onRangesChanged)
         self.model = model
-        self.model.modelChanged.connect(self.update)
-        self.update()
+        self.model.ensureDates(self.today, self.today + 1)
+        self.model.rangesChanged.connect(self.onRangesChanged)
+        self.model.residentChanged.connect(self.onRangesChanged)
+        self.reminders.reset(model.ranges.values(), self.today)
+        self.arm()
+
+    def onRangesChanged(self, changes):
+        self.reminders.apply(changes)
+        self.arm()
+
+    def arm(self):
+        nextDay = self.reminders.nextDay()
+        if nextDay is not None and nextDay <= self.today:
+            self.timer.start(0)
+            return
 
-    def onLeftClicked(self):
-        self.animationEnabled = False
+        # Reminders are due at midnight, so that is the latest wake up.
+        now = QDateTime.currentDateTime()
+        midnight = QDateTime(now.date().addDays(1), QTime(0, 0))
+        self.timer.start(max(0, now.msecsTo(midnight)) + 100)
+
+    def onTimeout(self):
+        today = datetime.date.today().toordinal()
+        if today != self.today:
+            self.today = today
+            if self.model:
+                self.model.ensureDates(today, today + 1)
+            self.dayChanged.emit(today)
+
+        due = self.reminders.due(today)
+        if due:
+            self.remind.emit(due)
+
+        self.arm()
+
+
+class AsOfDialog(QDialog):
+    def __init__(self, first, parent):
+        super(AsOfDialog, self).__init__(parent)
+
+        self.setWindowTitle("Stand vom")
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        layout = QGridLayout(self)
+
+        layout.addWidget(QLabel("Stand vom:"), 0, 0)
+        self.dateBox = QDateEdit()
+        self.dateBox.setDisplayFormat("dd.MM.yyyy")
+        self.dateBox.setCalendarPopup(True)
+        self.dateBox.setDateRange(qdate_of_ordinal(first), QDate.currentDate())
+        self.dateBox.setDate(QDate.currentDate())
+        layout.addWidget(self.dateBox, 0, 1)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
+        buttons.rejected.connect(self.reject)
+        buttons.accepted.connect(self.accept)
+        layout.addWidget(buttons, 1, 0, 1, 2)
+
+    def date(self):
+        return ordinal_of_qdate(self.dateBox.date())
+
+
+class CalDAVDialog(QDialog):
+    def __init__(self, url, username, password, parent):
+        super(CalDAVDialog, self).__init__(parent)
+
+        self.setWindowTitle("Synchronisieren (CalDAV)")
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        layout = QGridLayout(self)
+
+        layout.addWidget(QLabel("Kalender-URL:"), 0, 0)
+        self.urlBox = QLineEdit(url)
+        self.urlBox.setPlaceholderText("https://server/calendars/benutzer/kalender/")
+        self.urlBox.setMinimumWidth(360)
+        layout.addWidget(self.urlBox, 0, 1)
+
+        layout.addWidget(QLabel("Benutzer:"), 1, 0)
+        self.userBox = QLineEdit(username)
+        layout.addWidget(self.userBox, 1, 1)
+
+        layout.addWidget(QLabel("Passwort:"), 2, 0)
+        self.passwordBox = QLineEdit(password)
+        self.passwordBox.setEchoMode(QLineEdit.Password)
+        layout.addWidget(self.passwordBox, 2, 1)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
+        buttons.rejected.connect(self.reject)
+        buttons.accepted.connect(self.onSave)
+        layout.addWidget(buttons, 3, 0, 1, 2)
+
+    def onSave(self):
+        if not self.urlBox.text().strip().startswith(("http://", "https://")):
+            QMessageBox.warning(self, "Synchronisieren (CalDAV)", u"Bitte eine http- oder https-Adresse angeben.")
+            return
+        self.accept()
+
+    def values(self):
+        return self.urlBox.text().strip(), self.userBox.text().strip(), self.passwordBox.text()
+
+
+class CopyYearDialog(QDialog):
+    def __init__(self, source, target, parent):
+        super(CopyYearDialog, self).__init__(parent)
+
+        self.setWindowTitle("Jahr kopieren")
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        layout = QGridLayout(self)
+
+        layout.addWidget(QLabel("Von Jahr:"), 0, 0)
+        self.sourceBox = QSpinBox()
+        self.sourceBox.setRange(1900, 2199)
+        self.sourceBox.setValue(source)
+        layout.addWidget(self.sourceBox, 0, 1)
+
+        layout.addWidget(QLabel("Nach Jahr:"), 1, 0)
+        self.targetBox = QSpinBox()
+        self.targetBox.setRange(1900, 2199)
+        self.targetBox.setValue(target)
+        layout.addWidget(self.targetBox, 1, 1)
+
+        self.sameDateBox = QRadioButton("Gleiches Datum")
+        self.sameDateBox.setChecked(True)
+        layout.addWidget(self.sameDateBox, 2, 1)
+        self.sameWeekdayBox = QRadioButton("Gleicher Wochentag")
+        layout.addWidget(self.sameWeekdayBox, 3, 1)
+
+        layout.addWidget(QLabel("Titel:"), 4, 0)
+        self.titleBox = QLineEdit()
+        self.titleBox.setPlaceholderText("Alle Titel")
+        layout.addWidget(self.titleBox, 4, 1)
+
+        self.colorCheckBox = QCheckBox("Nur Farbe:")
+        layout.addWidget(self.colorCheckBox, 5, 0)
+        self.colorBox = ColorButton(qcolor(ACCENT_COLORS[0]))
+        layout.addWidget(self.colorBox, 5, 1, Qt.AlignLeft)
+
+        self.holidayBox = QCheckBox(u"Sonn- und Feiertage überspringen")
+        self.holidayBox.setChecked(True)
+        layout.addWidget(self.holidayBox, 6, 0, 1, 2)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
+        buttons.rejected.connect(self.reject)
+        buttons.accepted.connect(self.onSave)
+        layout.addWidget(buttons, 7, 0, 1, 2)
+
+    def onSave(self):
+        if self.sourceBox.value() == self.targetBox.value():
+            QMessageBox.warning(self, "Jahr kopieren", u"Bitte zwei verschiedene Jahre wählen.")
+            return
+        self.accept()
+
+    def values(self):
+        return (
+            self.sourceBox.value(),
+            self.targetBox.value(),
+            COPY_SAME_WEEKDAY if self.sameWeekdayBox.isChecked() else COPY_SAME_DATE,
+            self.titleBox.text(),
+            rgb_of_qcolor(self.colorBox.color()) if self.colorCheckBox.isChecked() else None,
+            self.holidayBox.isChecked())
+
+
+class FreeSlotDialog(QDialog):
+    def __init__(self, values, parent):
+        super(FreeSlotDialog, self).__init__(parent)
+        length, earliest, title, color, vacations = values
+
+        self.setWindowTitle(u"Freien Zeitraum suchen")
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        layout = QGridLayout(self)
+
+        layout.addWidget(QLabel("Arbeitstage:"), 0, 0)
+        self.lengthBox = QSpinBox()
+        self.lengthBox.setRange(1, 250)
+        self.lengthBox.setValue(length)
+        layout.addWidget(self.lengthBox, 0, 1)
+
+        layout.addWidget(QLabel(u"Frühestens:"), 1, 0)
+        self.earliestBox = QDateEdit()
+        self.earliestBox.setDisplayFormat("dd.MM.yyyy")
+        self.earliestBox.setCalendarPopup(True)
+        self.earliestBox.setDate(qdate_of_ordinal(earliest))
+        layout.addWidget(self.earliestBox, 1, 1)
+
+        layout.addWidget(QLabel("Belegt durch:"), 2, 0)
+        self.titleBox = QLineEdit()
+        self.titleBox.setPlaceholderText("Alle Titel")
+        self.titleBox.setText(title)
+        layout.addWidget(self.titleBox, 2, 1)
+
+        self.colorCheckBox = QCheckBox("Nur Farbe:")
+        self.colorCheckBox.setChecked(color is not None)
+        layout.addWidget(self.colorCheckBox, 3, 0)
+        self.colorBox = ColorButton(qcolor(color if color is not None else ACCENT_COLORS[0]))
+        layout.addWidget(self.colorBox, 3, 1, Qt.AlignLeft)
+
+        self.vacationBox = QCheckBox("Schulferien meiden")
+        self.vacationBox.setChecked(vacations)
+        layout.addWidget(self.vacationBox, 4, 0, 1, 2)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
+        buttons.rejected.connect(self.reject)
+        buttons.accepted.connect(self.accept)
+        layout.addWidget(buttons, 5, 0, 1, 2)
+
+    def values(self):
+        return (
+            self.lengthBox.value(),
+            ordinal_of_qdate(self.earliestBox.date()),
+            self.titleBox.text(),
+            rgb_of_qcolor(self.colorBox.color()) if self.colorCheckBox.isChecked() else None,
+            self.vacationBox.isChecked())
+
+
+class OccupancyFilterDialog(QDialog):
+    def __init__(self, overlay, parent):
+        super(OccupancyFilterDialog, self).__init__(parent)
+        self.overlay = overlay
+
+        self.setWindowTitle("Belegung filtern")
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        layout = QGridLayout(self)
+
+        layout.addWidget(QLabel("Titel:"), 0, 0)
+        self.titleBox = QLineEdit()
+        self.titleBox.setPlaceholderText("Alle Titel")
+        self.titleBox.setText(overlay.title)
+        layout.addWidget(self.titleBox, 0, 1)
+
+        self.colorCheckBox = QCheckBox("Nur Farbe:")
+        self.colorCheckBox.setChecked(overlay.color is not None)
+        layout.addWidget(self.colorCheckBox, 1, 0)
+        self.colorBox = ColorButton(qcolor(overlay.color if overlay.color is not None else ACCENT_COLORS[0]))
+        layout.addWidget(self.colorBox, 1, 1, Qt.AlignLeft)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
+        buttons.rejected.connect(self.reject)
+        buttons.accepted.connect(self.onSave)
+        layout.addWidget(buttons, 2, 0, 1, 2)
+
+    def onSave(self):
+        color = rgb_of_qcolor(self.colorBox.color()) if self.colorCheckBox.isChecked() else None
+        self.overlay.setFilter(self.titleBox.text(), color)
+        self.accept()
+
+
+class FerienNiedersachsen(Overlay):
+    def __init__(self):
+        super(FerienNiedersachsen, self).__init__(GREEN_LIGHT_COLOR)
+
+    def matches(self, month, day):
+        return self.enabled and is_vacation(month, day)
+
+    def monthMask(self, month):
+        if not self.enabled:
+            return [False] * days_of_month(month)
+        return vacations_of_month(month)
+
+
+THUMBNAIL_COLUMN_WIDTH = 4
+THUMBNAIL_ROW_HEIGHT = 2
+THUMBNAIL_CACHE_SIZE = 64
+
+
+def render_year_thumbnail(year, ranges):
+    # Runs on worker threads, so only QImage and the Qt-free core are used.
+    image = QImage(12 * THUMBNAIL_COLUMN_WIDTH, 31 * THUMBNAIL_ROW_HEIGHT, QImage.Format_ARGB32_Premultiplied)
+    image.fill(Qt.transparent)
+    painter = QPainter(image)
+
+    for month in range(year * 12, year * 12 + 12):
+        x = (month % 12) * THUMBNAIL_COLUMN_WIDTH
+        painter.fillRect(QRect(x, 0, THUMBNAIL_COLUMN_WIDTH, days_of_month(month) * THUMBNAIL_ROW_HEIGHT), Qt.white)
+        for day, holiday in enumerate(holidays_of_month(month)):
+            if holiday:
+                painter.fillRect(QRect(x, day * THUMBNAIL_ROW_HEIGHT, THUMBNAIL_COLUMN_WIDTH, THUMBNAIL_ROW_HEIGHT), RED_LIGHT_COLOR)
+
+    first, last = ordinal(year * 12, 1), ordinal(year * 12 + 11, 31)
+    for r in ranges:
+        if r.deleted:
+            continue
+        for start, end in r.occurrences(first, last):
+            fromMonth, fromDay = month_and_day(max(start, first))
+            toMonth, toDay = month_and_day(min(end, last))
+            for month in range(fromMonth, toMonth + 1):
+                top = fromDay if month == fromMonth else 1
+                bottom = toDay if month == toMonth else days_of_month(month)
+                painter.fillRect(QRect(
+                    (month % 12) * THUMBNAIL_COLUMN_WIDTH + THUMBNAIL_COLUMN_WIDTH // 2, (top - 1) * THUMBNAIL_ROW_HEIGHT,
+                    THUMBNAIL_COLUMN_WIDTH // 2, (bottom - top + 1) * THUMBNAIL_ROW_HEIGHT), qcolor(r.color))
+
+    painter.end()
+    return image
+
+
+class SyncSignals(QObject):
+    finished = Signal(object)
+
+
+class ThumbnailSignals(QObject):
+    finished = Signal(int, int, QImage)
+
+
+class ThumbnailTask(QRunnable):
+    # Tasks are released by their widget, not by the pool. Qt deletes
+    # finished runnables with the pool mutex held, which deadlocks with a
+    # GUI thread that holds the interpreter lock while starting a task.
+    def __init__(self, year, generation, ranges, signals):
+        super(ThumbnailTask, self).__init__()
+        self.setAutoDelete(False)
+        self.year = year
+        self.generation = generation
+        self.ranges = ranges
+        self.signals = signals
+
+    def run(self):
+        self.signals.finished.emit(self.year, self.generation, render_year_thumbnail(self.year, self.ranges))
+
+
+class MinimapWidget(QWidget):
+    def __init__(self, calendar, parent=None):
+        super(MinimapWidget, self).__init__(parent)
+        self.calendar = calendar
+        self.calendar.offsetChanged.connect(self.update)
+        self.calendar.hiddenTagsChanged.connect(self.invalidate)
+
+        self.thumbnailSize = QSize(12 * THUMBNAIL_COLUMN_WIDTH * 2, 31 * THUMBNAIL_ROW_HEIGHT)
+        self.spacing = 8
+        self.shift = 0
+
+        self.images = collections.OrderedDict()
+        self.stale = set()
+        self.pending = set()
+        self.generations = collections.defaultdict(int)
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.tasks = {}
+        self.retiredTasks = []
+        self.signals = ThumbnailSignals()
+        self.signals.finished.connect(self.onThumbnailFinished)
+
+        self.model = None
+
+    def setModel(self, model):
+        if self.model:
+            self.model.rangesChanged.disconnect(self.onRangesChanged)
+            self.model.residentChanged.disconnect(self.onRangesChanged)
+        self.model = model
+        self.model.rangesChanged.connect(self.onRangesChanged)
+        self.model.residentChanged.connect(self.onRangesChanged)
+        self.invalidate()
+
+    def invalidate(self):
+        for year in self.images:
+            self.generations[year] += 1
+        for year in self.pending:
+            self.generations[year] += 1
+        self.images.clear()
+        self.stale.clear()
+        self.update()
+
+    def onRangesChanged(self, changes):
+        # Only the years an entry covered before or after the change are
+        # rendered again, recurring entries without end touch all years.
+        years = set()
+        for before, after in changes:
+            for r in (before, after):
+                if r.deleted or r.start is None:
+                    continue
+                if r.isRecurring() and r.until is None:
+                    years.update(self.images)
+                    years.update(self.pending)
+                elif r.isRecurring():
+                    years.update(range(year_of(r.start) - 1900, year_of(r.until + r.end - r.start) - 1900 + 1))
+                else:
+                    years.update(range(year_of(r.start) - 1900, year_of(r.end) - 1900 + 1))
+
+        for year in years:
+            self.generations[year] += 1
+            if year in self.images:
+                self.stale.add(year)
+
+        self.update()
+
+    def visibleYears(self):
+        count = max(1, self.width() // (self.thumbnailSize.width() + self.spacing))
+        first = int(self.calendar.targetOffset) // 12 + self.shift - count // 2
+        for i in range(count):
+            yield self.spacing // 2 + i * (self.thumbnailSize.width() + self.spacing), first + i
+
+    def requestThumbnail(self, year):
+        if year in self.pending:
+            return
+
+        # Only the ranges of the year, those of years not loaded from the
+        # summaries in the index, so distant years are not drawn empty.
+        first, last = ordinal(year * 12, 1), ordinal(year * 12 + 11, 31)
+        ranges = sorted(
+            (r for r in self.model.rangesBetween(first, last) if not r.tags & self.calendar.hiddenTags),
+            key=lambda r: r.index)
+
+        self.pending.add(year)
+        self.tasks[year] = ThumbnailTask(year, self.generations[year], ranges, self.signals)
+        self.pool.start(self.tasks[year])
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+
+    def onThumbnailFinished(self, year, generation, image):
+        self.pending.discard(year)
+
+        self.retiredTasks.append(self.tasks.pop(year, None))
+        if not self.pool.activeThreadCount():
+            del self.retiredTasks[:]
+
+        if generation == self.generations[year]:
+            self.images[year] = image
+            self.images.move_to_end(year)
+            self.stale.discard(year)
+            while len(self.images) > THUMBNAIL_CACHE_SIZE:
+                self.images.popitem(last=False)
+
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        current = int(self.calendar.offset + 0.5) // 12
+
+        for x, year in self.visibleYears():
+            rect = QRect(x, 4, self.thumbnailSize.width(), self.thumbnailSize.height())
+
+            image = self.images.get(year)
+            if image is not None:
+                self.images.move_to_end(year)
+                painter.drawImage(rect, image)
+            else:
+                painter.fillRect(rect, self.palette().base())
+
+            if image is None or year in self.stale:
+                self.requestThumbnail(year)
+
+            if year == current:
+                painter.setPen(QPen(SOLARIZED_BASE_COLOR, 2))
+            else:
+                painter.setPen(QPen(Qt.gray))
+            painter.drawRect(rect.adjusted(-1, -1, 1, 1))
+
+            painter.setPen(QPen(self.palette().windowText().color()))
+            painter.drawText(QRect(x, rect.bottom() + 4, rect.width(), self.height() - rect.bottom() - 4), Qt.AlignHCenter | Qt.AlignTop, str(1900 + year))
+
+    def mousePressEvent(self, event):
+        for x, year in self.visibleYears():
+            if x <= event.x() <= x + self.thumbnailSize.width():
+                self.calendar.scrollToMonth(year * 12)
+                break
+
+    def wheelEvent(self, event):
+        self.shift -= event.angleDelta().y() // 120
+        self.update()
+
+    def sizeHint(self):
+        return QSize(10 * (self.thumbnailSize.width() + self.spacing), self.thumbnailSize.height() + 4 + self.fontMetrics().height() + 8)
+
+    def minimumSizeHint(self):
+        return self.sizeHint()
+
+
+def range_radius(columnWidth, rowHeight):
+    return max(6, min(rowHeight * 0.5, columnWidth * 0.25) - 2) / 2
+
+def range_segments(columnWidth, rowHeight, height, iterated_golden_ratio, start, end):
+    # Vertical line segments of an entry, x relative to the month column.
+    from_month, from_day = month_and_day(start)
+    to_month, to_day = month_and_day(end)
+
+    from_y = 40 + 20 + rowHeight * (from_day - 0.5)
+    to_y = 40 + 20 + rowHeight * (to_day - 0.5)
+    x = 5 + (columnWidth - 10) * iterated_golden_ratio
+
+    for month in range(from_month, to_month + 1):
+        yield month, x, from_y if month == from_month else 0, to_y if month == to_month else height
+
+def draw_range(painter, segments, radius, color, conflict=False):
+    # Segments are (x, top, bottom, has start, has end) in painter coordinates.
+    painter.setBrush(QBrush(color))
+    painter.setPen(QPen(color, max(2.0, radius * 0.8)))
+
+    ends = []
+    for x, top, bottom, hasStart, hasEnd in segments:
+        if hasStart:
+            painter.drawEllipse(QPointF(x, top), radius, radius)
+            ends.append((x, top))
+
+        if hasEnd:
+            painter.drawEllipse(QPointF(x, bottom), radius, radius)
+            ends.append((x, bottom))
+
+        painter.drawLine(QPointF(x, top), QPointF(x, bottom))
+
+    # Mark overlapping entries with a ring around both ends.
+    if conflict:
+        painter.save()
+        painter.setBrush(Qt.NoBrush)
+        for x, y in ends:
+            painter.setPen(QPen(Qt.white, 2))
+            painter.drawEllipse(QPointF(x, y), radius + 1, radius + 1)
+            painter.setPen(QPen(Qt.red, 2))
+            painter.drawEllipse(QPointF(x, y), radius + 3, radius + 3)
+        painter.restore()
+
+def density_limit(threshold, columnWidth, rowHeight):
+    # Entries a column may hold before it is aggregated, 0 disables it.
+    if not threshold:
+        return None
+    return max(threshold, int((columnWidth - 10) / (2 * range_radius(columnWidth, rowHeight))))
+
+def draw_density(painter, month, columnWidth, rowHeight, ranges, hidden, exclude=None):
+    # Stacked bars of the entries per day, one band per color, so the number
+    # of draw calls is bounded by days and colors instead of entries.
+    # Returns the number of entries in the month.
+    first = ordinal(month, 1)
+    days = days_of_month(month)
+    last = first + days - 1
+
+    diffs = {}
+    count = 0
+    for r in ranges:
+        if r.deleted or r.index == exclude or r.tags & hidden:
+            continue
+        occurrences = r.occurrences(first, last)
+        if not occurrences:
+            continue
+        count += 1
+        diff = diffs.setdefault(r.color, [0] * (days + 1))
+        for start, end in occurrences:
+            diff[max(start, first) - first] += 1
+            diff[min(end, last) - first + 1] -= 1
+
+    rows = sorted(((list(itertools.accumulate(diff))[:-1], color) for color, diff in diffs.items()), key=lambda row: (-sum(row[0]), row[1]))
+    if len(rows) > DENSITY_COLORS:
+        other = [sum(counts) for counts in zip(*(counts for counts, color in rows[DENSITY_COLORS - 1:]))]
+        rows = rows[:DENSITY_COLORS - 1] + [(other, DENSITY_OTHER_COLOR)]
+
+    peak = max([sum(counts) for counts in zip(*(counts for counts, color in rows))] or [0])
+    if not peak:
+        return count
+
+    unit = (columnWidth - 10) / peak
+    offsets = [0] * days
+    painter.save()
+    painter.setRenderHint(QPainter.Antialiasing, False)
+    painter.setPen(Qt.NoPen)
+    for counts, color in rows:
+        fill = qcolor(color)
+        fill.setAlpha(200)
+        painter.setBrush(fill)
+
+        # One rectangle per run of days with the same bar.
+        day = 0
+        while day < days:
+            end = day + 1
+            while end < days and counts[end] == counts[day] and offsets[end] == offsets[day]:
+                end += 1
+            if counts[day]:
+                painter.drawRect(QRectF(
+                    5 + offsets[day] * unit, 40 + 20 + day * rowHeight + 2,
+                    counts[day] * unit, (end - day) * rowHeight - 3))
+            day = end
+
+        for day in range(days):
+            offsets[day] += counts[day]
+    painter.restore()
+
+    return count
+
+def draw_badge(painter, columnWidth, rowHeight, text):
+    painter.save()
+    rect = painter.boundingRect(QRectF(0, 0, columnWidth, rowHeight), Qt.AlignCenter, text)
+    rect = QRectF(columnWidth - rect.width() - 12, 40 + 20 + 2, rect.width() + 8, max(rect.height(), rowHeight - 4))
+    painter.setPen(Qt.NoPen)
+    painter.setBrush(SOLARIZED_BASE_COLOR)
+    painter.drawRoundedRect(rect, rect.height() / 2, rect.height() / 2)
+    painter.setPen(QPen(Qt.white))
+    painter.drawText(rect, Qt.AlignCenter, text)
+    painter.restore()
+
+def render_month_tile(month, columnWidth, rowHeight, height, font, runs, ranges, conflicting, hidden, exclude=None, aggregate=False):
+    # Grid, overlays, day names and entries of one month column. Runs on
+    # worker threads, so it only touches its arguments.
+    image = QImage(int(math.ceil(columnWidth)) + 1, height, QImage.Format_ARGB32_Premultiplied)
+    image.fill(Qt.transparent)
+
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setRenderHint(QPainter.TextAntialiasing)
+
+    # Draw white background.
+    painter.fillRect(QRectF(0, 40 + 20, columnWidth, days_of_month(month) * rowHeight), Qt.white)
+
+    # Draw horizontal lines.
+    first = ordinal(month, 1)
+    sundays = sundays_of_month(month)
+    for day in range(1, days_of_month(month) + 1):
+        yEnd = 40 + 20 + day * rowHeight
+        if day in sundays:
+            painter.setPen(QPen(Qt.gray, 2))
+        else:
+            painter.setPen(QPen(Qt.gray))
+        painter.drawLine(QPointF(1, yEnd), QPointF(columnWidth, yEnd))
+
+    # Draw overlays.
+    for overlay, day, count, match in runs:
+        yStart = 40 + 20 + (day - 1) * rowHeight
+        overlay.draw(painter, QRect(0, yStart, columnWidth + 1, count * rowHeight + 1), match)
+
+    # Draw day numbers and weekday names.
+    font = QFont(font)
+    font.setPointSizeF(min(rowHeight * 0.6, font.pointSizeF()))
+    painter.setFont(font)
+    painter.setPen(QPen(Qt.gray))
+    xAlign = min(rowHeight / 20.0, 1.0) * 25
+    weekday = first_weekday(month)
+    for day in range(1, days_of_month(month) + 1):
+        if rowHeight > 22 or day % 2 == 0:
+            yStart = 40 + 20 + (day - 1) * rowHeight
+            painter.drawText(QRectF(0, yStart, xAlign, rowHeight), Qt.AlignVCenter | Qt.AlignRight, str(day))
+
+            name = WEEKDAY_NAMES[(weekday + day - 2) % 7 + 1]
+            if columnWidth > 120:
+                painter.drawText(QRectF(xAlign + 10, yStart, columnWidth - xAlign - 10, rowHeight), Qt.AlignVCenter, name)
+            elif columnWidth > 70:
+                painter.drawText(QRectF(xAlign + 10, yStart, columnWidth - xAlign - 10, rowHeight), Qt.AlignVCenter, name[:2])
+
+    # Draw entries, or their density if there are too many.
+    if aggregate:
+        draw_badge(painter, columnWidth, rowHeight, str(draw_density(painter, month, columnWidth, rowHeight, ranges, hidden, exclude)))
+        painter.end()
+        return image
+
+    last = first + days_of_month(month) - 1
+    radius = range_radius(columnWidth, rowHeight)
+    for r in ranges:
+        if r.deleted or r.index == exclude or r.tags & hidden:
+            continue
+        golden = (GOLDEN_RATIO_CONJUGATE * r.index) % 1
+        for start, end in r.occurrences(first, last):
+            from_month = month_and_day(start)[0]
+            to_month = month_and_day(end)[0]
+            segments = [
+                (x, top, bottom, segmentMonth == from_month, segmentMonth == to_month)
+                for segmentMonth, x, top, bottom in range_segments(columnWidth, rowHeight, height, golden, start, end)
+                if segmentMonth == month]
+            draw_range(painter, segments, radius, qcolor(r.color), r.index in conflicting)
+
+    painter.end()
+    return image
+
+
+class TileSignals(QObject):
+    finished = Signal(int, int, QImage)
+
+
+class MonthTileTask(QRunnable):
+    # Released by the widget like ThumbnailTask.
+    def __init__(self, ticket, month, key, font, runs, ranges, conflicting, hidden, aggregate, pending, signals):
+        super(MonthTileTask, self).__init__()
+        self.setAutoDelete(False)
+        self.ticket = ticket
+        self.month = month
+        self.key = key
+        self.font = font
+        self.runs = runs
+        self.ranges = ranges
+        self.conflicting = conflicting
+        self.hidden = hidden
+        self.aggregate = aggregate
+        self.pending = pending
+        self.signals = signals
+
+    def run(self):
+        # Skip tiles that were requested again in the meantime.
+        if self.pending.get(self.month, (None, ))[0] != self.ticket:
+            self.signals.finished.emit(self.month, self.ticket, QImage())
+            return
+
+        columnWidth, rowHeight, height = self.key
+        image = render_month_tile(self.month, columnWidth, rowHeight, height, self.font, self.runs, self.ranges, self.conflicting, self.hidden, aggregate=self.aggregate)
+        self.signals.finished.emit(self.month, self.ticket, image)
+
+
+TILE_CACHE_SIZE = 24
+
+
+class VariantAnimation(QVariantAnimation):
+    def updateCurrentValue(self, value):
+        pass
+
+
+MOUSE_DOWN_NONE = 0
+MOUSE_DOWN_MONTH = 1
+MOUSE_DOWN_DAY = 2
+MOUSE_DOWN_LEFT = 3
+MOUSE_DOWN_RIGHT = 4
+MOUSE_DOWN_TODAY = 5
+MOUSE_DOWN_NEW = 6
+
+DRAG_MOVE = 0
+DRAG_START = 1
+DRAG_END = 2
+
+
+class CalendarWidget(QWidget):
+
+    createClicked = Signal()
+    selectionChanged = Signal()
+    yearsChanged = Signal(int)
+    offsetChanged = Signal()
+    asOfChanged = Signal()
+    hiddenTagsChanged = Signal()
+
+    def __init__(self, app, parent=None):
+        super(CalendarWidget, self).__init__(parent)
+        self.app = app
+
+        self.setFocusPolicy(Qt.StrongFocus)
+
+        self.targetOffset = float(QDate.currentDate().year() - 1900) * 12
+        self.offset = self.targetOffset
+
+        self.years = 1
+        self.overviewImages = {}
+        self.overlayRunCache = {}
+
+        self.monthIndex = MonthIndex()
+        self.tiles = collections.OrderedDict()
+        self.pendingTiles = {}
+        self.tileGeneration = 0
+        self.tileTicket = 0
+        self.tileConflicts = None
+        self.tilePool = QThreadPool(self)
+        self.tilePool.setMaxThreadCount(2)
+        self.tileTasks = {}
+        self.retiredTileTasks = []
+        self.tileSignals = TileSignals()
+        self.tileSignals.finished.connect(self.onTileFinished)
+        self.hitIndex = {}
+        self.hitIndexKey = None
+        self.segmentWindow = None
+        self.segmentTimer = QTimer(self)
+        self.segmentTimer.setSingleShot(True)
+        self.segmentTimer.setInterval(50)
+        self.segmentTimer.timeout.connect(self.loadSegments)
+        self.densityThreshold = DENSITY_THRESHOLD
+        self.denseMonths = {}
+        self.expandedMonth = None
+        self.setMouseTracking(True)
+
+        self.dragIndex = None
+        self.dragMode = DRAG_MOVE
+        self.dragOrigin = None
+        self.dragPreview = None
+        self.dragBackground = None
+        self.dragTiles = None
+
+        self.overlays = []
+        self.conflicts = Conflicts()
+        self.tagCounts = TagCounts()
+        self.hiddenTags = 0
+        self.model = None
+        self.setModel(Model())
+
+        self.asOf = None
+        self.liveModel = None
+
+        self.today = datetime.date.today().toordinal()
+        self.selection_end = self.today
+        self.selection_start = self.selection_end
+        self.lastSelection = (self.selection_start, self.selection_end)
+        self.mouse_down = MOUSE_DOWN_NONE
+
+        self.animation = VariantAnimation(self)
+        self.animation.setEasingCurve(QEasingCurve(QEasingCurve.InOutQuad))
+        self.animation.valueChanged.connect(self.onAnimate)
+        self.animation.setDuration(1000)
+        self.animationEnabled = False
+
+        self.actions = QActionGroup(self)
+
+    def setModel(self, model):
+        if self.model:
+            self.model.modelChanged.disconnect(self.onModelChanged)
+            self.model.rangesChanged.disconnect(self.onRangesChanged)
+            self.model.residentChanged.disconnect(self.onRangesChanged)
+            self.model.rangesChanged.disconnect(self.conflicts.apply)
+            self.model.rangesChanged.disconnect(self.monthIndex.apply)
+            self.model.residentChanged.disconnect(self.monthIndex.apply)
+            self.model.rangesChanged.disconnect(self.tagCounts.apply)
+        self.model = model
+        self.model.modelChanged.connect(self.onModelChanged)
+        self.model.rangesChanged.connect(self.onRangesChanged)
+        self.model.residentChanged.connect(self.onRangesChanged)
+        # Conflicts and tags are over all years, the month index only over
+        # the loaded ones.
+        self.model.rangesChanged.connect(self.conflicts.apply)
+        self.model.rangesChanged.connect(self.monthIndex.apply)
+        self.model.residentChanged.connect(self.monthIndex.apply)
+        self.model.rangesChanged.connect(self.tagCounts.apply)
+        ranges = list(model.summaryRanges())
+        self.conflicts.reset(ranges)
+        self.monthIndex.reset(model.ranges.values())
+        self.tagCounts.reset(ranges)
+        self.segmentWindow = None
+        self.requestSegments()
+        self.invalidate()
+
+    def setAsOf(self, date, model=None):
+        # Show a past version read-only, None returns to the live model.
+        if self.asOf is None:
+            self.liveModel = self.model
+
+        if self.dragIndex is not None:
+            self.finishDrag(False)
+
+        self.asOf = date
+        self.setModel(model if date is not None else self.liveModel)
+        if date is None:
+            self.liveModel = None
+
+        self.asOfChanged.emit()
+
+    def setHiddenTags(self, mask):
+        if mask == self.hiddenTags:
+            return
+
+        self.hiddenTags = mask
+        self.invalidate()
+        self.hiddenTagsChanged.emit()
+
+    def setToday(self, date):
+        if date != self.today:
+            self.today = date
+            self.update()
+
+    def setYears(self, years):
+        if years == self.years:
+            return
+
+        self.years = years
+        self.columnWidth = self.calculateColumnWidth()
+        self.requestSegments()
+        self.update()
+        self.yearsChanged.emit(years)
+
+    def setDensityThreshold(self, threshold):
+        if threshold != self.densityThreshold:
+            self.densityThreshold = threshold
+            self.invalidate()
+
+    def isDense(self, month, ranges):
+        limit = density_limit(self.densityThreshold, self.columnWidth, self.rowHeight)
+        dense = limit is not None and sum(1 for r in ranges if not r.tags & self.hiddenTags) > limit
+        self.denseMonths[month] = dense
+        return dense and month != self.expandedMonth
+
+    def setExpandedMonth(self, month):
+        # A dense month is drawn entry by entry while hovered. Only the two
+        # affected tiles are rendered again, the old images stay until then.
+        if month == self.expandedMonth:
+            return
+
+        for changed in (self.expandedMonth, month):
+            self.pendingTiles.pop(changed, None)
+            tile = self.tiles.get(changed)
+            if tile is not None:
+                self.tiles[changed] = (None, ) + tile[1:]
+
+        self.expandedMonth = month
+        self.update()
+
+    def addOverlay(self, overlay):
+        self.overlays.append(overlay)
+        self.invalidate()
+
+    def invalidate(self):
+        self.overviewImages.clear()
+        self.hitIndex = {}
+        self.onModelChanged()
+
+    def onModelChanged(self):
+        # Tiles of older generations are still shown until replaced. Year
+        # images and hit segments were already dropped where ranges changed.
+        self.tileGeneration += 1
+        self.tileConflicts = None
+        self.overlayRunCache.clear()
+        self.denseMonths.clear()
+        self.update()
+
+    def onRangesChanged(self, changes):
+        # Only the months a range covered before or after the change,
+        # recurring ranges touch all of them.
+        for before, after in changes:
+            for r in (before, after):
+                if r.deleted or r.start is None:
+                    continue
+                if r.isRecurring():
+                    self.overviewImages.clear()
+                    self.hitIndex = {}
+                    return
+                for month in range(month_and_day(r.start)[0], month_and_day(r.end)[0] + 1):
+                    self.hitIndex.pop(month, None)
+                    self.overviewImages.pop(month // 12, None)
+
+    def setConflictMode(self, mode):
+        self.conflicts.mode = mode
+        self.conflicts.reset(self.model.summaryRanges())
+        self.invalidate()
+
+    def onLeftClicked(self):
+        self.animationEnabled = False
 
         self.targetOffset -= 12
 
@@ -873,7 +2518,7 @@ class CalendarWidget(QWidget):
     def onTodayClicked(self):
         self.animationEnabled = False
 
-        self.targetOffset = float((QDate.currentDate().year() - 1900) * 12)
+        self.targetOffset = float((year_of(self.today) - 1900) * 12)
 
         self.animation.setStartValue(self.offset)
         self.animation.setEndValue(self.targetOffset)
@@ -882,14 +2527,40 @@ class CalendarWidget(QWidget):
         self.animationEnabled = True
 
     def onNewClicked(self):
-        self.createClicked.emit()
+        if self.asOf is None:
+            self.createClicked.emit()
 
     def onAnimate(self, value):
         if not self.animationEnabled:
             return
 
         self.offset = value
+        self.dropDragBackground()
+        self.requestSegments()
         self.repaint()
+        self.offsetChanged.emit()
+
+    def scrollToMonth(self, month):
+        self.animationEnabled = False
+
+        self.targetOffset = float(month)
+
+        self.animation.setStartValue(self.offset)
+        self.animation.setEndValue(self.targetOffset)
+        self.animation.start()
+
+        self.animationEnabled = True
+
+    def setSelection(self, start, end):
+        self.selection_start = start
+        self.selection_end = end
+
+        month = month_and_day(start)[0]
+        if not int(self.targetOffset) <= month < int(self.targetOffset) + 12 * self.years:
+            self.scrollToMonth(month - month % 12)
+
+        self.update()
+        self.notifySelection()
 
     def inSelection(self, date):
         return self.selectionStart() <= date <= self.selectionEnd()
@@ -900,7 +2571,15 @@ class CalendarWidget(QWidget):
     def selectionEnd(self):
         return max(self.selection_start, self.selection_end)
 
+    def notifySelection(self):
+        selection = (self.selectionStart(), self.selectionEnd())
+        if selection != self.lastSelection:
+            self.lastSelection = selection
+            self.selectionChanged.emit()
+
     def calculateColumnWidth(self):
+        if self.years > 1:
+            return max(self.width() / (12.0 * self.years), 2.0)
         return min(max(self.width() / 12.0, 40.0), 125.0)
 
     def calculateRowHeight(self):
@@ -914,19 +2593,47 @@ class CalendarWidget(QWidget):
             x = (month - self.offset) * self.columnWidth
             yield x, month
 
+    def visibleDates(self):
+        months = [month for x, month in self.visibleMonths()]
+        return ordinal(months[0], 1), ordinal(months[-1], days_of_month(months[-1]))
+
     def resizeEvent(self, event):
         self.rowHeight = self.calculateRowHeight()
         self.columnWidth = self.calculateColumnWidth()
+        self.dropDragBackground()
+        self.requestSegments()
+
+    def requestSegments(self):
+        # Reading and evicting years changes the model, so it happens once
+        # the visible months stopped changing, never while painting.
+        self.segmentTimer.start()
+
+    def loadSegments(self):
+        # Years next to the visible ones are read on demand, others are
+        # only given up when the visible years change. A hidden widget has
+        # no visible months, showing it resizes it and asks again.
+        if not self.isVisible():
+            return
+
+        first, last = self.visibleDates()
+        window = (first - 366, last + 366)
+        self.model.ensureDates(window[0], window[1], evict=window != self.segmentWindow)
+        self.segmentWindow = window
 
     def paintEvent(self, event):
         painter = QPainter(self)
+
+        if self.years > 1:
+            self.paintOverview(painter)
+            return
+
+        if self.dragBackground is not None:
+            self.paintDrag(painter)
+            return
+
         painter.setRenderHint(QPainter.Antialiasing)
         painter.setRenderHint(QPainter.TextAntialiasing)
 
-        # Draw white background.
-        for x, month in self.visibleMonths():
-            painter.fillRect(QRect(x, 40 + 20, self.columnWidth, days_of_month(month) * self.rowHeight), QBrush(Qt.white))
-
         for x, month in self.visibleMonths():
             # Draw year header.
             if month % 12 == 0:
@@ -964,8 +2671,13 @@ class CalendarWidget(QWidget):
                 painter.drawText(QRect(x + 120, 0, self.columnWidth * 12 - 32 * 2, 40), Qt.AlignVCenter, str(1900 + month // 12))
                 painter.restore()
 
-                # Draw new pixmap.
-                if self.mouse_down == MOUSE_DOWN_NEW:
+                # Draw new pixmap, or the date of a past version.
+                if self.asOf is not None:
+                    painter.save()
+                    painter.setPen(QPen(Qt.red))
+                    painter.drawText(QRect(x + 200, 0, self.columnWidth * 12 - 200, 40), Qt.AlignVCenter, "Stand vom %s" % (qdate_of_ordinal(self.asOf).toString("dd.MM.yyyy"), ))
+                    painter.restore()
+                elif self.mouse_down == MOUSE_DOWN_NEW:
                     painter.drawPixmap(QRect(x + 200, 5, 146, 30), self.app.newDownPixmap, QRect(0, 0, 146, 30))
                 else:
                     painter.drawPixmap(QRect(x + 200, 5, 146, 30), self.app.newPixmap, QRect(0, 0, 146, 30))
@@ -982,106 +2694,369 @@ class CalendarWidget(QWidget):
             self.style().drawControl(QStyle.CE_Header, opt, painter, self)
             painter.restore()
 
-            painter.save()
-
-            for day in range(1, days_of_month(month) + 1):
-                date = qdate(month, day)
-
-                # Draw horizontal lines.
-                yStart = 40 + 20 + (day - 1) * self.rowHeight
-                yEnd = yStart + self.rowHeight
-                if date.dayOfWeek() == 7:
-                    painter.setPen(QPen(Qt.gray, 2))
-                else:
-                    painter.setPen(QPen(Qt.gray))
-                painter.drawLine(x + 1, yEnd, x + self.columnWidth, yEnd)
-
-                # Draw overlays.
-                for overlay in self.overlays:
-                    if overlay.matches(month, day):
-                        overlay.draw(painter, QRect(x, yStart, self.columnWidth + 1, self.rowHeight + 1))
-
-                # Draw selection.
-                if self.inSelection(date):
-                    painter.fillRect(QRect(x, yStart, self.columnWidth + 1, self.rowHeight + 1), BLUE_LIGHT_COLOR)
-
-                # Draw selection end.
-                if date == self.selection_end:
-                    painter.setPen(QPen(SOLARIZED_BASE_COLOR, 2))
-                    painter.drawRect(QRect(x + 2, yStart + 2, self.columnWidth - 4, self.rowHeight - 4))
-
-                # Draw day numbers.
-                if self.rowHeight > 22 or day % 2 == 0:
-                    font = self.font()
-                    font.setPointSizeF(min(self.rowHeight * 0.6, font.pointSizeF()))
-                    painter.setFont(font)
-                    xAlign = min(self.rowHeight / 20.0, 1.0) * 25
-                    painter.drawText(QRect(x, yStart, xAlign, self.rowHeight), Qt.AlignVCenter | Qt.AlignRight, str(day))
-
-                    # Draw weekday names.
-                    if self.columnWidth > 120:
-                        painter.drawText(QRect(x + xAlign + 10, yStart, self.columnWidth - xAlign - 10, self.rowHeight), Qt.AlignVCenter, WEEKDAY_NAMES[date.dayOfWeek()])
-                    elif self.columnWidth > 70:
-                        painter.drawText(QRect(x + xAlign + 10, yStart, self.columnWidth - xAlign - 10, self.rowHeight), Qt.AlignVCenter, WEEKDAY_NAMES[date.dayOfWeek()][:2])
-
-            painter.restore()
+        self.paintTiles(painter)
 
+        for x, month in self.visibleMonths():
             # Draw vertical lines.
             painter.save()
+            bottom = 40 + 20 + self.rowHeight * max(days_of_month(month), days_of_month(month - 1))
             if month % 12 == 0:
                 painter.setPen(QPen(Qt.gray))
-                painter.drawLine(x - 2, 0, x - 2, 40 + 20 + self.rowHeight * max(days_of_month(month), days_of_month(month - 1)) - 1)
+                painter.drawLine(x - 2, 0, x - 2, bottom - 1)
                 painter.setPen(QPen(self.palette().window().color(), 2))
-                painter.drawLine(x, 0, x, 40 + 20 + self.rowHeight * max(days_of_month(month), days_of_month(month - 1)))
+                painter.drawLine(x, 0, x, bottom)
                 painter.setPen(QPen(Qt.gray))
-                painter.drawLine(x + 1, 0, x + 1, 40 + 20 + self.rowHeight * max(days_of_month(month), days_of_month(month - 1)) - 1)
+                painter.drawLine(x + 1, 0, x + 1, bottom - 1)
             else:
                 painter.setPen(QPen(Qt.gray))
-                painter.drawLine(x, 40 + 20, x, 40 + 20 + self.rowHeight * max(days_of_month(month), days_of_month(month - 1)) - 1)
+                painter.drawLine(x, 40 + 20, x, bottom - 1)
             painter.restore()
 
-        # Draw ranges.
-        painter.save()
-        for key in sorted(self.model.ranges):
-            r = self.model.ranges[key]
-            if not r.deleted:
-                self.drawRange(painter, (GOLDEN_RATIO_CONJUGATE * r.index) % 1, r.start, r.end, r.color)
-        painter.restore()
+        # Draw selection.
+        start, end = self.selectionStart(), self.selectionEnd()
+        endMonth, endDay = month_and_day(self.selection_end)
+        for x, month in self.visibleMonths():
+            monthFirst = ordinal(month, 1)
+            first = max(monthFirst, start)
+            last = min(monthFirst + days_of_month(month) - 1, end)
+            if first <= last:
+                yStart = 40 + 20 + (first - monthFirst) * self.rowHeight
+                painter.fillRect(QRect(x, yStart, self.columnWidth + 1, (last - first + 1) * self.rowHeight + 1), BLUE_LIGHT_COLOR)
+
+            # Draw selection end.
+            if month == endMonth:
+                yStart = 40 + 20 + (endDay - 1) * self.rowHeight
+                painter.setPen(QPen(SOLARIZED_BASE_COLOR, 2))
+                painter.setBrush(Qt.NoBrush)
+                painter.drawRect(QRect(x + 2, yStart + 2, self.columnWidth - 4, self.rowHeight - 4))
 
         # Mark current day.
-        now = datetime.date.today()
-        month = (now.year - 1900) * 12 + now.month - 1
+        month, day = month_and_day(self.today)
         x = (month - self.offset) * self.columnWidth
-        self.drawRaisedRect(painter, QRect(x, 40 + 20 + (now.day - 1) * self.rowHeight, self.columnWidth, self.rowHeight), Qt.red)
+        self.drawRaisedRect(painter, QRect(x, 40 + 20 + (day - 1) * self.rowHeight, self.columnWidth, self.rowHeight), Qt.red)
+
+    def overlayRuns(self, month):
+        # (overlay, first day, number of days, match) for runs of equal
+        # matches, computed once per month until an overlay changes.
+        runs = self.overlayRunCache.get(month)
+        if runs is not None:
+            return runs
+
+        runs = []
+        for overlay in self.overlays:
+            mask = overlay.monthMask(month)
+            day = 0
+            while day < len(mask):
+                end = day + 1
+                if mask[day]:
+                    while end < len(mask) and mask[end] == mask[day]:
+                        end += 1
+                    runs.append((overlay, day + 1, end - day, mask[day]))
+                day = end
+
+        if len(self.overlayRunCache) >= 240:
+            self.overlayRunCache.clear()
+        self.overlayRunCache[month] = runs
+        return runs
+
+    def tileKey(self):
+        return self.columnWidth, self.rowHeight, self.height()
+
+    def tileMonths(self):
+        # Visible months without those only needed for the year header.
+        for x, month in self.visibleMonths():
+            if x + self.columnWidth >= 0:
+                yield x, month
 
-    def drawRange(self, painter, iterated_golden_ratio, start, end, color):
-        from_month = (start.year() - 1900) * 12 + start.month() - 1
-        from_day = start.day()
+    def requestTile(self, month):
+        key = self.tileKey()
+        pending = self.pendingTiles.get(month)
+        if pending and pending[1:] == (self.tileGeneration, key):
+            return
 
-        to_month = (end.year() - 1900) * 12 + end.month() - 1
-        to_day = end.day()
+        if self.tileConflicts is None:
+            self.tileConflicts = frozenset(self.conflicts.conflicting)
+
+        self.tileTicket += 1
+        self.pendingTiles[month] = (self.tileTicket, self.tileGeneration, key)
+        ranges = self.monthIndex.rangesOfMonth(month)
+        task = MonthTileTask(
+            self.tileTicket, month, key, self.font(), self.overlayRuns(month),
+            ranges, self.tileConflicts, self.hiddenTags, self.isDense(month, ranges), self.pendingTiles, self.tileSignals)
+        self.tileTasks[self.tileTicket] = task
+        self.tilePool.start(task)
+
+    def onTileFinished(self, month, ticket, image):
+        self.retiredTileTasks.append(self.tileTasks.pop(ticket, None))
+        if not self.tilePool.activeThreadCount():
+            del self.retiredTileTasks[:]
+
+        pending = self.pendingTiles.get(month)
+        if pending is None or pending[0] != ticket:
+            return
 
-        radius = max(6, min(self.rowHeight * 0.5, self.columnWidth * 0.25) - 2) / 2
+        del self.pendingTiles[month]
+        self.tiles[month] = (pending[1], pending[2], image)
+        self.tiles.move_to_end(month)
+        while len(self.tiles) > len(list(self.tileMonths())) + 24 + TILE_CACHE_SIZE:
+            self.tiles.popitem(last=False)
 
-        painter.setBrush(QBrush(color))
-        painter.setPen(QPen(color, max(2.0, radius * 0.8)))
+        if self.tilesReady():
+            self.dropDragBackground()
+
+        self.update()
+
+    def renderTiles(self, months, exclude=None):
+        # Synchronous rendering, used for the background of a drag.
+        key = self.tileKey()
+        tiles = {}
+        for month in months:
+            ranges = self.monthIndex.rangesOfMonth(month)
+            tiles[month] = (self.tileGeneration, key, render_month_tile(
+                month, self.columnWidth, self.rowHeight, self.height(), self.font(), self.overlayRuns(month),
+                ranges, frozenset(self.conflicts.conflicting), self.hiddenTags, exclude, self.isDense(month, ranges)))
+        return tiles
+
+    def shutdown(self):
+        self.pendingTiles.clear()
+        self.tilePool.clear()
+        self.tilePool.waitForDone()
+
+    def paintTiles(self, painter):
+        # Only finished tiles are composited, missing ones are requested
+        # from the pool and drawn as blank cells for now.
+        key = self.tileKey()
+        months = []
+        for x, month in self.tileMonths():
+            months.append(month)
+            tile = (self.dragTiles or {}).get(month) or self.tiles.get(month)
+            if tile is None:
+                painter.fillRect(QRect(x, 40 + 20, self.columnWidth, days_of_month(month) * self.rowHeight), QBrush(Qt.white))
+                self.requestTile(month)
+                continue
+
+            generation, tileKey, image = tile
+            if tileKey == key:
+                painter.drawImage(QPointF(x, 0), image)
+            else:
+                painter.drawImage(QRectF(x, 0, self.columnWidth + 1, self.height()), image)
+
+            if month in self.tiles:
+                self.tiles.move_to_end(month)
+            if (generation, tileKey) != (self.tileGeneration, key):
+                self.requestTile(month)
+
+        # Prepare the previous and the next year.
+        for month in list(range(months[0] - 12, months[0])) + list(range(months[-1] + 1, months[-1] + 13)):
+            tile = self.tiles.get(month)
+            if tile is None or tile[:2] != (self.tileGeneration, key):
+                self.requestTile(month)
+
+    def paintDrag(self, painter):
+        # Only the dragged entry changes, everything else comes from the
+        # background grabbed when the drag started.
+        painter.drawPixmap(0, 0, self.dragBackground)
+        painter.setRenderHint(QPainter.Antialiasing)
+
+        if self.dragIndex is None:
+            for x, month in self.tileMonths():
+                self.requestTile(month)
+
+        first, last = self.visibleDates()
+        r = self.dragPreview
+        for start, end in r.occurrences(first, last):
+            self.drawRange(painter, (GOLDEN_RATIO_CONJUGATE * r.index) % 1, start, end, qcolor(r.color), self.conflicts.isConflicting(r.index))
+
+    def dragRect(self):
+        r = self.dragPreview or self.model.ranges[self.dragIndex]
+        if r.isRecurring():
+            return self.rect()
+
+        x0 = (month_and_day(r.start)[0] - self.offset) * self.columnWidth
+        x1 = (month_and_day(r.end)[0] + 1 - self.offset) * self.columnWidth
+        return QRect(x0 - 1, 0, x1 - x0 + 2, self.height())
+
+    def startDrag(self, pos):
+        self.dropDragBackground()
+
+        hit = self.rangeAt(pos)
+        if hit is None or self.asOf is not None:
+            return
+
+        r, start, end = hit
+        month = self.monthForX(pos.x())
+        date = ordinal(month, self.dayForY(month, pos.y()))
+
+        self.dragIndex = r.index
+        self.dragOrigin = date
+        if start != end and date == start:
+            self.dragMode = DRAG_START
+        elif start != end and date == end:
+            self.dragMode = DRAG_END
+        else:
+            self.dragMode = DRAG_MOVE
+
+    def dragTo(self, pos):
+        month = self.monthForX(pos.x())
+        delta = ordinal(month, self.dayForY(month, pos.y())) - self.dragOrigin
+
+        r = self.model.ranges[self.dragIndex]
+        if self.dragMode == DRAG_START:
+            start, end = min(r.start + delta, r.end), r.end
+        elif self.dragMode == DRAG_END:
+            start, end = r.start, max(r.end + delta, r.start)
+        else:
+            start, end = r.start + delta, r.end + delta
+
+        preview = self.dragPreview or r
+        if (start, end) == (preview.start, preview.end):
+            return
+
+        if self.dragPreview is None:
+            # Only the months showing the entry need tiles without it.
+            first, last = self.visibleDates()
+            months = set()
+            for occurrenceStart, occurrenceEnd in r.occurrences(first, last):
+                months.update(range(month_and_day(max(occurrenceStart, first))[0], month_and_day(min(occurrenceEnd, last))[0] + 1))
+
+            self.dragPreview = r.copy()
+            self.dragTiles = self.renderTiles(months, exclude=r.index)
+            self.dragBackground = self.grab()
+            self.dragTiles = None
+
+        oldRect = self.dragRect()
+        self.dragPreview.start = start
+        self.dragPreview.end = end
+        self.update(oldRect.united(self.dragRect()))
+
+    def finishDrag(self, commit=True):
+        preview = self.dragPreview
+        r = self.model.ranges[self.dragIndex]
+
+        self.dragIndex = None
+        self.update()
 
-        from_y = 40 + 20 + self.rowHeight * (from_day - 0.5)
-        to_y = 40 + 20 + self.rowHeight * (to_day - 0.5)
+        # The whole drag is a single undo step. The preview stays until
+        # the tiles showing the result are rendered.
+        if commit and preview and (preview.start, preview.end) != (r.start, r.end):
+            self.model.commit(preview)
+        else:
+            self.dropDragBackground()
 
-        for month in range(from_month, to_month + 1):
-            x = (month - self.offset) * self.columnWidth + 5 + (self.columnWidth - 10) * iterated_golden_ratio
+    def dropDragBackground(self):
+        if self.dragIndex is None and self.dragBackground is not None:
+            self.dragPreview = None
+            self.dragBackground = None
+            self.update()
 
-            if month == from_month:
-                painter.drawEllipse(QPoint(x, from_y), radius, radius)
-                painter.drawLine(x, from_y, x, to_y if month == to_month else self.height())
+    def tilesReady(self):
+        key = self.tileKey()
+        for x, month in self.tileMonths():
+            tile = self.tiles.get(month)
+            if tile is None or tile[:2] != (self.tileGeneration, key):
+                return False
+        return True
 
-            if month == to_month:
-                painter.drawEllipse(QPoint(x, to_y), radius, radius)
-                painter.drawLine(x, from_y if month == from_month else 0, x, to_y)
+    def paintOverview(self, painter):
+        # Every visible year is one cached image scaled into place, so the
+        # cost of a frame depends on the number of years, not on the days.
+        height = 31 * self.rowHeight
+        firstYear = int(self.offset) // 12 - 1
+        lastYear = int(self.offset + self.width() / self.columnWidth) // 12
+
+        font = self.font()
+        font.setBold(True)
+        painter.setFont(font)
+
+        for year in range(firstYear, lastYear + 1):
+            x = (year * 12 - self.offset) * self.columnWidth
+            painter.drawImage(QRectF(x, 40 + 20, self.columnWidth * 12, height), self.overviewImage(year))
+
+            painter.setPen(QPen(Qt.gray))
+            painter.drawLine(x, 0, x, 40 + 20 + height)
+            painter.setPen(QPen())
+            painter.drawText(QRect(x + 5, 0, self.columnWidth * 12 - 10, 40 + 20), Qt.AlignVCenter, str(1900 + year))
+
+        # Draw selection as one bar per month.
+        startMonth, startDay = month_and_day(self.selectionStart())
+        endMonth, endDay = month_and_day(self.selectionEnd())
+        first = max(startMonth, int(self.offset) - 12)
+        last = min(endMonth, int(self.offset + self.width() / self.columnWidth))
+        for month in range(first, last + 1):
+            fromDay = startDay if month == startMonth else 1
+            toDay = endDay if month == endMonth else days_of_month(month)
+            x = (month - self.offset) * self.columnWidth
+            painter.fillRect(QRectF(x, 40 + 20 + (fromDay - 1) * self.rowHeight, self.columnWidth, (toDay - fromDay + 1) * self.rowHeight), BLUE_LIGHT_COLOR)
+
+        # Mark current day.
+        month, day = month_and_day(self.today)
+        x = (month - self.offset) * self.columnWidth
+        painter.setPen(QPen(Qt.red, 2))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(QRectF(x - 1, 40 + 20 + (day - 1) * self.rowHeight - 1, self.columnWidth + 2, self.rowHeight + 2))
+
+    def overviewImage(self, year):
+        # One pixel per day and two per month: the left one shows the
+        # overlays, the right one the entries merged into spans per color.
+        image = self.overviewImages.get(year)
+        if image is not None:
+            return image
+
+        image = QImage(12 * 2, 31, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+
+        for month in range(year * 12, year * 12 + 12):
+            x = (month % 12) * 2
+            days = days_of_month(month)
+            painter.fillRect(QRect(x, 0, 2, days), Qt.white)
+            for overlay, day, count, match in self.overlayRuns(month):
+                overlay.draw(painter, QRect(x, day - 1, 2, count), match)
+
+            # A difference array per color, the color of the latest entry
+            # is drawn last.
+            first = ordinal(month, 1)
+            diffs = collections.OrderedDict()
+            for r in self.monthIndex.rangesOfMonth(month):
+                if r.tags & self.hiddenTags:
+                    continue
+                for start, end in r.occurrences(first, first + days - 1):
+                    diff = diffs.pop(r.color, None) or [0] * (days + 1)
+                    diffs[r.color] = diff
+                    diff[max(start, first) - first] += 1
+                    diff[min(end, first + days - 1) - first + 1] -= 1
+
+            for color, diff in diffs.items():
+                count, top = 0, None
+                for day, delta in enumerate(diff):
+                    count += delta
+                    if count and top is None:
+                        top = day
+                    elif not count and top is not None:
+                        painter.fillRect(QRect(x + 1, top, 1, day - top), qcolor(color))
+                        top = None
+
+        painter.end()
 
-            if month != to_month and month != from_month:
-                painter.drawLine(x, 0, x, self.height())
+        if len(self.overviewImages) >= 64:
+            self.overviewImages.clear()
+        self.overviewImages[year] = image
+        return image
+
+    def rangeRadius(self):
+        return range_radius(self.columnWidth, self.rowHeight)
+
+    def rangeSegments(self, iterated_golden_ratio, start, end):
+        return range_segments(self.columnWidth, self.rowHeight, self.height(), iterated_golden_ratio, start, end)
+
+    def drawRange(self, painter, iterated_golden_ratio, start, end, color, conflict=False):
+        from_month = month_and_day(start)[0]
+        to_month = month_and_day(end)[0]
+
+        segments = [
+            ((month - self.offset) * self.columnWidth + x, top, bottom, month == from_month, month == to_month)
+            for month, x, top, bottom in self.rangeSegments(iterated_golden_ratio, start, end)]
+        draw_range(painter, segments, self.rangeRadius(), color, conflict)
 
     def drawRaisedRect(self, painter, rect, color):
         # Draw rect.
@@ -1128,48 +3103,126 @@ class CalendarWidget(QWidget):
     def keyPressEvent(self, event):
         if event.key() in (Qt.Key_Down, Qt.Key_Up, Qt.Key_Left, Qt.Key_Right, Qt.Key_PageUp, Qt.Key_PageDown, Qt.Key_Home):
             # Move selection end.
+            month, day = month_and_day(self.selection_end)
             if event.key() == Qt.Key_Down:
-                self.selection_end = self.selection_end.addDays(1)
+                self.selection_end += 1
             elif event.key() == Qt.Key_Up:
-                self.selection_end = self.selection_end.addDays(-1)
+                self.selection_end -= 1
             elif event.key() == Qt.Key_Left:
-                self.selection_end = self.selection_end.addMonths(-1)
+                self.selection_end = add_months(self.selection_end, -1)
             elif event.key() == Qt.Key_Right:
-                self.selection_end = self.selection_end.addMonths(1)
+                self.selection_end = add_months(self.selection_end, 1)
             elif event.key() == Qt.Key_PageUp:
-                self.selection_end = QDate(self.selection_end.year(), self.selection_end.month(), 1)
+                self.selection_end = ordinal(month, 1)
             elif event.key() == Qt.Key_PageDown:
-                self.selection_end = QDate(
-                    self.selection_end.year(),
-                    self.selection_end.month(),
-                    days_of_month((self.selection_end.year() - 1900) * 12 + self.selection_end.month() - 1))
+                self.selection_end = ordinal(month, days_of_month(month))
             elif event.key() == Qt.Key_Home:
-                self.selection_end = QDate.currentDate()
+                self.selection_end = self.today
 
             # Also move selection start, unless modifier pressed.
             if not (event.modifiers() & Qt.ShiftModifier):
                 self.selection_start = self.selection_end
 
             # Scroll into view.
-            while self.selection_end < qdate(self.targetOffset, 1):
+            while self.selection_end < ordinal(int(self.targetOffset), 1):
                 self.onLeftClicked()
-            while self.selection_end > qdate(self.targetOffset + 11, days_of_month(self.targetOffset + 11)):
+            while self.selection_end >= ordinal(int(self.targetOffset) + 12 * self.years, 1):
                 self.onRightClicked()
 
             self.repaint()
+            self.notifySelection()
         elif event.key() in (Qt.Key_Enter, Qt.Key_Return):
             self.onNewClicked()
+        elif event.key() == Qt.Key_Escape and self.dragIndex is not None:
+            self.finishDrag(commit=False)
 
         return super(CalendarWidget, self).keyPressEvent(event)
 
+    def hitSegments(self, month):
+        # Segments of one month column from its bucket of the month index,
+        # sorted by x so a pointer position is resolved with a bisection.
+        # Months are built when the pointer first enters them and dropped
+        # when one of their ranges changes.
+        key = (self.columnWidth, self.rowHeight, self.height(), self.hiddenTags)
+        if self.hitIndexKey != key:
+            self.hitIndex = {}
+            self.hitIndexKey = key
+
+        segments = self.hitIndex.get(month)
+        if segments is not None:
+            return segments
+
+        segments = []
+        first = ordinal(month, 1)
+        for r in self.monthIndex.rangesOfMonth(month):
+            if r.tags & self.hiddenTags:
+                continue
+            golden = (GOLDEN_RATIO_CONJUGATE * r.index) % 1
+            for start, end in r.occurrences(first, first + days_of_month(month) - 1):
+                for segmentMonth, x, top, bottom in self.rangeSegments(golden, start, end):
+                    if segmentMonth == month:
+                        segments.append((x, top, bottom, r.index, start, end))
+        segments.sort()
+
+        if len(self.hitIndex) >= 240:
+            self.hitIndex = {}
+        self.hitIndex[month] = segments
+        return segments
+
+    def rangeAt(self, pos):
+        if self.years > 1 or pos.y() <= 40 + 20:
+            return None
+
+        month = self.monthForX(pos.x())
+        x = pos.x() - (month - self.offset) * self.columnWidth
+        y = pos.y()
+        tolerance = self.rangeRadius() + 2
+
+        segments = self.hitSegments(month)
+        best = None
+        for i in range(bisect.bisect_left(segments, (x - tolerance, )), len(segments)):
+            segmentX, top, bottom, index, start, end = segments[i]
+            if segmentX > x + tolerance:
+                break
+            if top - tolerance <= y <= bottom + tolerance:
+                if best is None or abs(segmentX - x) < abs(best[0] - x):
+                    best = segments[i]
+
+        if best is None:
+            return None
+        return self.model.ranges[best[3]], best[4], best[5]
+
+    def updateToolTip(self, event):
+        hit = self.rangeAt(event.pos())
+        if hit is None:
+            QToolTip.hideText()
+            self.unsetCursor()
+            return
+
+        if self.asOf is None:
+            self.setCursor(Qt.SizeAllCursor)
+
+        r, start, end = hit
+        lines = [r.title or "Eintrag %d" % r.index]
+        if start == end:
+            lines.append(qdate_of_ordinal(start).toString("dd.MM.yyyy"))
+        else:
+            lines.append(u"%s – %s" % (qdate_of_ordinal(start).toString("dd.MM.yyyy"), qdate_of_ordinal(end).toString("dd.MM.yyyy")))
+        if r.tags:
+            lines.append(", ".join(tag_names(r.tags)))
+        if r.notes.strip():
+            lines.append(r.notes.strip().splitlines()[0])
+
+        QToolTip.showText(event.globalPos(), "\n".join(lines), self)
+
     def monthForX(self, x):
         return int(self.offset + x / self.columnWidth)
 
     def dayForY(self, month, y):
-        return max(1, min((y - 40 - 20) // self.rowHeight + 1, days_of_month(month)))
+        return int(max(1, min((y - 40 - 20) // self.rowHeight + 1, days_of_month(month))))
 
     def mouseDoubleClickEvent(self, event):
-        if 40 + 20 < event.y():
+        if 40 + 20 < event.y() and self.asOf is None:
             self.loadContextActions()
             if len(self.actions.actions()):
                 self.showContextMenu(event.pos())
@@ -1182,7 +3235,14 @@ class CalendarWidget(QWidget):
 
         month = self.monthForX(event.x())
 
-        if 5 <= event.y() <= 35:
+        if self.years > 1 and event.y() < 40 + 20:
+            # Zoom into the clicked year.
+            self.targetOffset = self.offset = float(month - month % 12)
+            self.requestSegments()
+            self.setYears(1)
+            self.offsetChanged.emit()
+            return
+        elif 5 <= event.y() <= 35:
             x = (event.x() - self.offset * self.columnWidth) % (self.columnWidth * 12)
             if 5 <= x <= 35:
                 self.mouse_down = MOUSE_DOWN_LEFT
@@ -1199,34 +3259,52 @@ class CalendarWidget(QWidget):
         elif 40 < event.y() < 40 + 20:
             self.mouse_down = MOUSE_DOWN_MONTH
             if not event.modifiers() & Qt.ShiftModifier:
-                self.selection_start = qdate(month, 1)
-            self.selection_end = qdate(month, days_of_month(month))
+                self.selection_start = ordinal(month, 1)
+            self.selection_end = ordinal(month, days_of_month(month))
             self.repaint()
         elif 40 + 20 < event.y():
             self.mouse_down = MOUSE_DOWN_DAY
-            self.selection_end = qdate(month, self.dayForY(month, event.y()))
+            self.selection_end = ordinal(month, self.dayForY(month, event.y()))
             if not event.modifiers() & Qt.ShiftModifier:
                 self.selection_start = self.selection_end
+                self.startDrag(event.pos())
         else:
             self.mouse_down = MOUSE_DOWN_NONE
 
+        self.notifySelection()
+
         return super(CalendarWidget, self).mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
-        if event.button() == Qt.RightButton:
+        if not event.buttons() & Qt.LeftButton:
+            month = self.monthForX(event.x())
+            if self.years == 1 and event.y() > 40 + 20 and self.denseMonths.get(month):
+                self.setExpandedMonth(month)
+            else:
+                self.setExpandedMonth(None)
+            self.updateToolTip(event)
+            return
+
+        if self.dragIndex is not None:
+            self.dragTo(event.pos())
             return
 
+        self.updateSelection(event)
+
+    def updateSelection(self, event):
         month = self.monthForX(event.x())
 
         if 40 < event.y() < 40 + 20:
-            self.selection_end = qdate(month, days_of_month(month))
+            self.selection_end = ordinal(month, days_of_month(month))
             if not event.modifiers() & Qt.ShiftModifier and self.mouse_down not in [MOUSE_DOWN_MONTH, MOUSE_DOWN_DAY]:
-                self.selection_start = qdate(month, 1)
+                self.selection_start = ordinal(month, 1)
             self.update()
         elif 40 + 20 < event.y():
-            self.selection_end = qdate(month, self.dayForY(month, event.y()))
+            self.selection_end = ordinal(month, self.dayForY(month, event.y()))
             self.update()
 
+        self.notifySelection()
+
     def loadContextActions(self):
         # Clear.
         while self.actions.actions():
@@ -1235,12 +3313,10 @@ class CalendarWidget(QWidget):
         # Fill action group with entries in the selection.
         for key in sorted(self.model.ranges):
             r = self.model.ranges[key]
-            if r.deleted:
+            if r.deleted or r.tags & self.hiddenTags:
                 continue
 
-            if r.end < self.selectionStart():
-                continue
-            if r.start > self.selectionEnd():
+            if not r.occurrences(self.selectionStart(), self.selectionEnd()):
                 continue
 
             if r.title:
@@ -1255,12 +3331,15 @@ class CalendarWidget(QWidget):
             painter = QPainter(pixmap)
             painter.setRenderHint(QPainter.Antialiasing)
             painter.setPen(Qt.NoPen)
-            painter.setBrush(r.color)
+            painter.setBrush(qcolor(r.color))
             painter.drawEllipse(0, 0, 24, 24)
             painter.end()
             action.setIcon(QIcon(pixmap))
 
     def showContextMenu(self, pos):
+        if self.asOf is not None:
+            return
+
         menu = QMenu()
         action = menu.addAction("Eintrag erstellen")
         action.triggered.connect(self.onNewClicked)
@@ -1272,13 +3351,24 @@ class CalendarWidget(QWidget):
 
         menu.exec_(self.mapToGlobal(pos))
 
+    def leaveEvent(self, event):
+        if self.dragIndex is None:
+            self.setExpandedMonth(None)
+        return super(CalendarWidget, self).leaveEvent(event)
+
     def mouseReleaseEvent(self, event):
         repaint = False
 
+        if self.dragIndex is not None and event.button() == Qt.LeftButton:
+            self.mouse_down = MOUSE_DOWN_NONE
+            self.finishDrag()
+            self.notifySelection()
+            return
+
         if event.button() == Qt.RightButton and 40 + 20 < event.y():
             # Handle right clicks.
             month = self.monthForX(event.x())
-            date = qdate(month, self.dayForY(month, event.y()))
+            date = ordinal(month, self.dayForY(month, event.y()))
 
             if not self.inSelection(date):
                 self.selection_start = date
@@ -1290,7 +3380,7 @@ class CalendarWidget(QWidget):
             self.showContextMenu(event.pos())
         else:
             # Update the selection.
-            self.mouseMoveEvent(event)
+            self.updateSelection(event)
             repaint = True
 
         # Handle button clicks.
@@ -1312,14 +3402,98 @@ class CalendarWidget(QWidget):
         if repaint:
             self.repaint()
 
+        self.notifySelection()
+
     def sizeHint(self):
         return QSize(40 * 12, 40 + 20 + 10 * 31 + 10)
 
 
 if __name__ == "__main__":
-    app = Application(sys.argv)
-
-    mainWindow = MainWindow(app)
-    mainWindow.show()
+    parser = argparse.ArgumentParser(description=u"Gibt einen Überblick über die Termine eines Jahres.")
+    parser.add_argument("path", nargs="?", metavar="JSON", help=u"Kalender öffnen, in einem bereits laufenden Fenster falls vorhanden")
+    parser.add_argument("--date", metavar="JJJJ-MM-TT", help=u"Zu einem Datum springen, Beginn der Teamübersicht")
+    parser.add_argument("--new-instance", action="store_true", help="Neues Fenster statt des bereits laufenden verwenden")
+    parser.add_argument("--background", action="store_true", help=u"Unsichtbar vorstarten, damit spätere Aufrufe sofort öffnen")
+    parser.add_argument("--import-ics", nargs=2, metavar=("ICS", "JSON"), help="iCalendar-Datei in einen Kalender importieren")
+    parser.add_argument("--export-ics", nargs=2, metavar=("JSON", "ICS"), help="Kalender als iCalendar-Datei exportieren")
+    parser.add_argument("--report", metavar="JSON", help="Arbeitstage und belegte Tage eines Jahres ausgeben")
+    parser.add_argument("--year", type=int, default=datetime.date.today().year, help="Jahr des Berichts (Standard: aktuelles Jahr)")
+    parser.add_argument("--team", metavar="VERZEICHNIS", help=u"Freie Personen pro Tag über alle Kalender eines Verzeichnisses ausgeben")
+    parser.add_argument("--days", type=int, default=28, help=u"Tage der Teamübersicht (Standard: 28)")
+    parser.add_argument("--serve", nargs="+", metavar="JSON", help="Kalender ohne Fenster lesend als JSON-Dienst bereitstellen")
+    parser.add_argument("--port", type=int, default=8080, help="Port des Dienstes auf localhost (Standard: 8080)")
+    parser.add_argument("--socket", metavar="PATH", help="Dienst auf einem Unix-Socket statt auf einem Port bereitstellen")
+    parser.add_argument("--caldav-sync", nargs=2, metavar=("JSON", "URL"), help="Kalender mit einer CalDAV-Sammlung abgleichen (Zugangsdaten in der URL)")
+    parser.add_argument("--caldav-stand-in", type=int, metavar="PORT", help="Lokalen CalDAV-Testserver im Speicher starten")
+    args, qtArgs = parser.parse_known_args()
+
+    if args.report:
+        print_report(Model.load(args.report), args.year, sys.stdout)
+        sys.exit(0)
+
+    if args.team:
+        import kalender_team
+        first = parse_date(args.date) if args.date else datetime.date.today().toordinal()
+        team = kalender_team.Team(args.team).load()
+        kalender_team.print_availability(team, first, first + max(args.days, 1) - 1, sys.stdout)
+        sys.exit(1 if team.errors else 0)
+
+    if args.serve:
+        import kalender_service
+        kalender_service.serve(args.serve, port=args.port, socketPath=args.socket)
+        sys.exit(0)
+
+    if args.caldav_sync:
+        path, url = args.caldav_sync
+        applied, result = kalender_caldav.sync_file(path, url)
+        print("%d empfangen, %d gesendet, %d Konflikte" % (applied, result.pushed, len(result.conflicts)))
+        for error in result.errors:
+            print(error)
+        sys.exit(1 if result.errors else 0)
+
+    if args.caldav_stand_in is not None:
+        server = kalender_caldav.StandInServer(args.caldav_stand_in)
+        print(server.url())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.import_ics:
+        ics, path = args.import_ics
+        model = Model.load(path) if os.path.exists(path) else Model()
+        skipped = []
+        with io.open(ics, "r", encoding="utf-8-sig") as handle:
+            imported = model.commitBatches(read_ics(handle, skipped))
+        model.save(path)
+        print(u"%d importiert, %d übersprungen" % (imported, len(skipped)))
+        for title, reason in skipped:
+            print("%s: %s" % (title or "Ohne Titel", reason))
+        sys.exit(1 if skipped else 0)
+
+    if args.export_ics:
+        path, ics = args.export_ics
+        with io.open(ics, "w", encoding="utf-8", newline="") as handle:
+            write_ics(Model.load(path), handle)
+        sys.exit(0)
+
+    app = Application(sys.argv[:1] + qtArgs)
+    app.setQuitOnLastWindowClosed(not args.background)
+
+    mainWindow = MainWindow(app, args.background)
+
+    if not args.new_instance:
+        instanceServer = kalender_instance.InstanceServer(app)
+        instanceServer.requested.connect(mainWindow.onInstanceRequest)
+        instanceServer.listen()
+
+    if args.path or args.date:
+        mainWindow.onInstanceRequest({"path": os.path.abspath(args.path) if args.path else None, "date": args.date})
+    elif not args.background:
+        mainWindow.show()
 
     app.exec_()
+
+    if not args.new_instance:
+        instanceServer.close()
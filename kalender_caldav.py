@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+
+# Incremental two-way sync of a calendar file with a CalDAV collection.
+# Only the collection ctag, the sync token and the etags of the items are
+# compared, so unchanged items are never transferred. Network access runs
+# on a background thread, the result is applied to the model as a single
+# batch commit by the caller.
+
+import base64
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import io
+import json
+import os
+import queue
+import threading
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+
+from kalender_core import *
+
+
+DAV = "{DAV:}"
+CALDAV = "{urn:ietf:params:xml:ns:caldav}"
+CALENDARSERVER = "{http://calendarserver.org/ns/}"
+
+MULTIGET_BATCH_SIZE = 50
+
+PREFER_REMOTE = "remote"
+PREFER_LOCAL = "local"
+
+
+class CalDAVError(Exception):
+    pass
+
+
+class SyncTokenInvalid(CalDAVError):
+    pass
+
+
+def caldav_state_path(path):
+    return os.path.splitext(path)[0] + ".caldav"
+
+def parse_multistatus(data):
+    # (path, {property tag: element}, status) for every response.
+    result = []
+    for response in ElementTree.fromstring(data).iter(DAV + "response"):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(response.findtext(DAV + "href").strip()).path)
+        props = {}
+        for propstat in response.findall(DAV + "propstat"):
+            if " 200 " in propstat.findtext(DAV + "status", ""):
+                for prop in propstat.find(DAV + "prop"):
+                    props[prop.tag] = prop
+        result.append((path, props, response.findtext(DAV + "status", "")))
+    return result
+
+def range_of_calendar_data(text):
+    # UID and range of the master event, overrides of single occurrences
+    # are not represented in the model. The color is None if the event
+    # does not carry one.
+    for event in read_ics_events(io.StringIO(text)):
+        names = set(name for name, params, value in event)
+        if "RECURRENCE-ID" in names:
+            continue
+
+        try:
+            r = range_from_ics_event(event)
+        except ValueError:
+            r = None
+        if r is None:
+            return None, None, None
+
+        uid = next(value for name, params, value in event if name == "UID") if "UID" in names else None
+        color = r.color if names & set(["COLOR", "X-KALENDER-COLOR"]) else None
+        return uid, r, color
+
+    return None, None, None
+
+def calendar_data_of_range(r, uid):
+    handle = io.StringIO()
+    write_ics_events([(r, uid)], handle)
+    return handle.getvalue()
+
+
+class ConnectionPool(object):
+    # At most size connections to one server. Idle connections are kept
+    # alive for the next request.
+    def __init__(self, url, username=None, password=None, size=4, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+
+        username = username or urllib.parse.unquote(parts.username or "")
+        password = password or urllib.parse.unquote(parts.password or "")
+        self.headers = {}
+        if username:
+            credentials = ("%s:%s" % (username, password)).encode("utf-8")
+            self.headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        allHeaders = dict(self.headers)
+        allHeaders.update(headers or {})
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = self.connect()
+
+            # A kept alive connection may have been closed by the server,
+            # requests are idempotent, so they are sent once more.
+            for attempt in range(2):
+                try:
+                    connection.request(method, urllib.parse.quote(path), body, allHeaders)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    if attempt:
+                        raise
+                    connection = self.connect()
+
+            self.idle.put(connection)
+            return response.status, response.msg, data
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+class CalDAVClient(object):
+    def __init__(self, url, username=None, password=None, poolSize=4):
+        self.pool = ConnectionPool(url, username, password, poolSize)
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+        self.path = path if path.endswith("/") else path + "/"
+
+    def check(self, status, data, *expected):
+        if status not in expected:
+            raise CalDAVError("HTTP %d: %s" % (status, data[:200].decode("utf-8", "replace")))
+
+    def collectionTags(self):
+        # ctag and sync token of the collection.
+        status, headers, data = self.pool.request("PROPFIND", self.path, (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:propfind xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/">'
+            '<d:prop><cs:getctag/><d:sync-token/></d:prop>'
+            '</d:propfind>'), {"Depth": "0", "Content-Type": "application/xml; charset=utf-8"})
+        self.check(status, data, 207)
+
+        for path, props, _ in parse_multistatus(data):
+            ctag = props.get(CALENDARSERVER + "getctag")
+            token = props.get(DAV + "sync-token")
+            return (ctag.text if ctag is not None else None), (token.text if token is not None else None)
+        return None, None
+
+    def etags(self):
+        # Path and etag of every item in the collection.
+        status, headers, data = self.pool.request("PROPFIND", self.path, (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:propfind xmlns:d="DAV:"><d:prop><d:getetag/></d:prop></d:propfind>'),
+            {"Depth": "1", "Content-Type": "application/xml; charset=utf-8"})
+        self.check(status, data, 207)
+
+        etags = {}
+        for path, props, _ in parse_multistatus(data):
+            if path.rstrip("/") != self.path.rstrip("/") and DAV + "getetag" in props:
+                etags[path] = props[DAV + "getetag"].text
+        return etags
+
+    def syncCollection(self, token):
+        # Changed paths with their etags and removed paths since the token.
+        status, headers, data = self.pool.request("REPORT", self.path, (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:sync-collection xmlns:d="DAV:">'
+            '<d:sync-token>%s</d:sync-token><d:sync-level>1</d:sync-level>'
+            '<d:prop><d:getetag/></d:prop>'
+            '</d:sync-collection>') % (xml_escape(token or ""), ),
+            {"Content-Type": "application/xml; charset=utf-8"})
+        if status in (403, 409) and b"valid-sync-token" in data:
+            raise SyncTokenInvalid()
+        self.check(status, data, 207)
+
+        changed, removed = {}, set()
+        for path, props, responseStatus in parse_multistatus(data):
+            if " 404 " in responseStatus:
+                removed.add(path)
+            elif DAV + "getetag" in props:
+                changed[path] = props[DAV + "getetag"].text
+        return ElementTree.fromstring(data).findtext(DAV + "sync-token"), changed, removed
+
+    def multiget(self, paths):
+        # Etag and calendar data of the given items, batches run in
+        # parallel on the pool.
+        paths = sorted(paths)
+        batches = [paths[i:i + MULTIGET_BATCH_SIZE] for i in range(0, len(paths), MULTIGET_BATCH_SIZE)]
+
+        result = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            for items in executor.map(self.multigetBatch, batches):
+                result.update(items)
+        return result
+
+    def multigetBatch(self, paths):
+        status, headers, data = self.pool.request("REPORT", self.path, (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<c:calendar-multiget xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">'
+            '<d:prop><d:getetag/><c:calendar-data/></d:prop>%s'
+            '</c:calendar-multiget>') % ("".join("<d:href>%s</d:href>" % (xml_escape(urllib.parse.quote(path)), ) for path in paths), ),
+            {"Depth": "1", "Content-Type": "application/xml; charset=utf-8"})
+        self.check(status, data, 207)
+
+        items = {}
+        for path, props, _ in parse_multistatus(data):
+            if CALDAV + "calendar-data" in props:
+                items[path] = (props[DAV + "getetag"].text if DAV + "getetag" in props else None, props[CALDAV + "calendar-data"].text or "")
+        return items
+
+    def put(self, path, text, etag=None):
+        # Returns the new etag, None if the server did not send one and
+        # False if the item changed on the server in the meantime.
+        headers = {"Content-Type": "text/calendar; charset=utf-8"}
+        if etag:
+            headers["If-Match"] = etag
+        else:
+            headers["If-None-Match"] = "*"
+
+        status, headers, data = self.pool.request("PUT", path, text, headers)
+        if status == 412:
+            return False
+        self.check(status, data, 200, 201, 204)
+        return headers.get("ETag")
+
+    def delete(self, path, etag=None):
+        status, headers, data = self.pool.request("DELETE", path, None, {"If-Match": etag} if etag else {})
+        if status == 412:
+            return False
+        self.check(status, data, 200, 204, 404)
+        return True
+
+    def close(self):
+        self.pool.close()
+
+
+def xml_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+class SyncState(object):
+    # What was last exchanged with the server, per range id the path, the
+    # etag and the entry as in the calendar file.
+    def __init__(self):
+        self.url = None
+        self.ctag = None
+        self.syncToken = None
+        self.items = {}
+
+    def save(self, path):
+        with open(path, "w") as handle:
+            json.dump({
+                "url": self.url,
+                "ctag": self.ctag,
+                "syncToken": self.syncToken,
+                "items": self.items,
+            }, handle)
+
+    @classmethod
+    def load(cls, path, url):
+        # A state of another collection does not apply.
+        state = cls()
+        state.url = url
+        if os.path.exists(path):
+            with open(path, "r") as handle:
+                document = json.load(handle)
+            if document.get("url") == url:
+                state.ctag = document.get("ctag")
+                state.syncToken = document.get("syncToken")
+                state.items = document.get("items", {})
+        return state
+
+
+SyncUpdate = collections.namedtuple("SyncUpdate", ["key", "path", "etag", "uid", "entry"])
+
+
+class SyncResult(object):
+    def __init__(self, document):
+        self.document = document
+        self.updates = []
+        self.items = {}
+        self.ctag = None
+        self.syncToken = None
+        self.pushed = 0
+        self.conflicts = []
+        self.errors = []
+
+
+def remote_changes(client, state):
+    # Paths with etags that changed on the server and removed paths.
+    known = dict((item["path"], item["etag"]) for item in state.items.values())
+
+    ctag, token = client.collectionTags()
+    if ctag is not None and ctag == state.ctag and token == state.syncToken:
+        return ctag, token, {}, set()
+
+    try:
+        if not token:
+            raise SyncTokenInvalid()
+        token, changed, removed = client.syncCollection(state.syncToken)
+    except SyncTokenInvalid:
+        changed = client.etags()
+        removed = set(path for path in known if path not in changed)
+
+    changed = dict((path, etag) for path, etag in changed.items() if etag is None or known.get(path) != etag)
+    removed &= set(known)
+    return ctag, token, changed, removed
+
+def sync(client, state, document, prefer=PREFER_REMOTE):
+    # Runs on a worker thread. document is a snapshot of Model.document()
+    # taken by the caller; nothing of the live model is touched here.
+    result = SyncResult(document)
+    items = dict((key, dict(item)) for key, item in state.items.items())
+    keyOfPath = dict((item["path"], key) for key, item in items.items())
+
+    result.ctag, result.syncToken, changed, removed = remote_changes(client, state)
+
+    # Remote side per range id: an entry or None when removed.
+    remote = {}
+    newRemote = []
+    for path, (etag, text) in client.multiget(changed).items():
+        uid, r, color = range_of_calendar_data(text)
+        if r is None:
+            continue
+
+        key = keyOfPath.get(path)
+        if key is None:
+            newRemote.append(SyncUpdate(None, path, etag, uid, entry_of_range(r)))
+            continue
+
+        # Keep the local color of events edited on devices without colors.
+        if color is None:
+            r.color = parse_color(items[key]["entry"]["color"])
+
+        entry = entry_of_range(r)
+        if entry == items[key]["entry"]:
+            # Our own change coming back, or nothing we represent.
+            items[key]["etag"] = etag
+        else:
+            remote[key] = (path, etag, uid, entry)
+
+    for path in removed:
+        remote[keyOfPath[path]] = (path, None, items[keyOfPath[path]]["uid"], None)
+
+    # Local side per range id.
+    local = {}
+    for key in document:
+        if key not in items or items[key]["entry"] != document[key]:
+            local[key] = document[key]
+    for key in items:
+        if key not in document:
+            local[key] = None
+
+    # Conflicts are resolved per range id.
+    for key in set(local) & set(remote):
+        result.conflicts.append(key)
+        if prefer == PREFER_REMOTE:
+            del local[key]
+        else:
+            path, etag, uid, entry = remote.pop(key)
+            if etag is not None:
+                items[key]["etag"] = etag
+            elif local[key] is not None:
+                # Removed on the server, the local version is created again.
+                items[key]["etag"] = None
+
+    for key, (path, etag, uid, entry) in remote.items():
+        result.updates.append(SyncUpdate(key, path, etag, uid, entry))
+        if entry is None:
+            items.pop(key, None)
+        else:
+            items[key] = {"path": path, "etag": etag, "uid": uid, "entry": entry}
+    result.updates.extend(newRemote)
+
+    # Push local changes in parallel on the pool.
+    def push(key):
+        entry = local[key]
+        item = items.get(key)
+        if entry is None:
+            return key, item, client.delete(item["path"], item["etag"])
+
+        if item is None:
+            uid = "%s@kalender" % (uuid.uuid4().hex, )
+            item = {"path": client.path + uid + ".ics", "etag": None, "uid": uid}
+        r = range_of_entry(entry)
+        r.index = int(key)
+        return key, item, client.put(item["path"], calendar_data_of_range(r, item["uid"]), item["etag"])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=client.pool.size) as executor:
+        futures = [executor.submit(push, key) for key in local]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                key, item, outcome = future.result()
+            except (CalDAVError, OSError, http.client.HTTPException) as err:
+                result.errors.append(str(err))
+                continue
+
+            if outcome is False:
+                # Changed on the server after it was listed, the next sync
+                # sees it and resolves it.
+                result.conflicts.append(key)
+            elif local[key] is None:
+                items.pop(key, None)
+                result.pushed += 1
+            else:
+                item = dict(item, etag=outcome, entry=local[key])
+                items[key] = item
+                result.pushed += 1
+
+    # After own writes the ctag is outdated, the next sync asks for the
+    # changes since the token and skips the own ones by their etags.
+    if result.pushed:
+        result.ctag = None
+
+    result.items = items
+    return result
+
+def apply_sync_result(model, state, result):
+    # Remote changes become one batch commit. Ranges edited locally while
+    # the sync was running are left alone, the next sync pushes them. Only
+    # the years of updated ranges are loaded, by the commit.
+    ranges = []
+    nextId = model.nextId()
+    currents = model.peek(int(update.key) for update in result.updates if update.key is not None)
+
+    state.items = result.items
+    for update in result.updates:
+        if update.key is not None:
+            current = currents.get(int(update.key))
+            if current is not None and current.deleted:
+                current = None
+            if (entry_of_range(current) if current else None) != result.document.get(update.key):
+                continue
+
+            r = Range()
+            r.index = int(update.key)
+            if update.entry is None:
+                r.deleted = True
+            else:
+                r = range_of_entry(update.entry)
+                r.index = int(update.key)
+        else:
+            r = range_of_entry(update.entry)
+            r.index = nextId
+            nextId += 1
+            state.items[str(r.index)] = {"path": update.path, "etag": update.etag, "uid": update.uid, "entry": update.entry}
+
+        ranges.append(r)
+
+    state.ctag = result.ctag
+    state.syncToken = result.syncToken
+
+    if ranges:
+        model.commitMany(ranges)
+    return len(ranges)
+
+
+class SyncEngine(object):
+    # One sync at a time on a background thread. finished is called with
+    # the SyncResult or the exception on that thread.
+    def __init__(self, url, username=None, password=None, prefer=PREFER_REMOTE, poolSize=4):
+        self.url = url
+        self.client = CalDAVClient(url, username, password, poolSize)
+        self.prefer = prefer
+        self.thread = None
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, state, document, finished):
+        def run():
+            try:
+                outcome = sync(self.client, state, document, self.prefer)
+            except Exception as err:
+                outcome = err
+            finished(outcome)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.client.close()
+
+def sync_file(path, url, username=None, password=None, prefer=PREFER_REMOTE):
+    # One synchronous sync of a calendar file, used by the command line.
+    model = Model.load(path) if os.path.exists(path) else Model()
+    state = SyncState.load(caldav_state_path(path), url)
+
+    engine = SyncEngine(url, username, password, prefer)
+    try:
+        result = sync(engine.client, state, model.document(), prefer)
+    finally:
+        engine.close()
+
+    applied = apply_sync_result(model, state, result)
+    model.save(path)
+    state.save(caldav_state_path(path))
+    return applied, result
+
+
+class StandInCollection(object):
+    # In-memory CalDAV collection with etags, a ctag and sync tokens, to
+    # test the sync without a real server.
+    def __init__(self, path="/calendars/kalender/"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = {}
+        self.revision = 0
+        self.changes = {}
+
+    def token(self, revision=None):
+        return "http://kalender/sync/%d" % (self.revision if revision is None else revision, )
+
+    def change(self, path, text):
+        # Called with the lock held.
+        self.revision += 1
+        self.changes[path] = self.revision
+        if text is None:
+            self.items.pop(path, None)
+        else:
+            self.items[path] = ('"%d"' % (self.revision, ), text)
+
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def multistatus(self, responses, extra=""):
+        body = ['<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" '
+                'xmlns:c="urn:ietf:params:xml:ns:caldav" xmlns:cs="http://calendarserver.org/ns/">']
+        for path, props, status in responses:
+            body.append("<d:response><d:href>%s</d:href>" % (xml_escape(urllib.parse.quote(path)), ))
+            if status:
+                body.append("<d:status>HTTP/1.1 %s</d:status>" % (status, ))
+            else:
+                body.append("<d:propstat><d:prop>%s</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat>" % ("".join(props), ))
+            body.append("</d:response>")
+        body.append(extra)
+        body.append("</d:multistatus>")
+        self.reply(207, "".join(body).encode("utf-8"), {"Content-Type": "application/xml; charset=utf-8"})
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+
+    def itemProps(self, path, data=False):
+        etag, text = self.server.collection.items[path]
+        props = ["<d:getetag>%s</d:getetag>" % (xml_escape(etag), )]
+        if data:
+            props.append("<c:calendar-data>%s</c:calendar-data>" % (xml_escape(text), ))
+        return props
+
+    def do_PROPFIND(self):
+        self.body()
+        collection = self.server.collection
+        path = urllib.parse.unquote(self.path)
+        with collection.lock:
+            if path == collection.path and self.headers.get("Depth", "0") == "0":
+                self.multistatus([(path, [
+                    "<cs:getctag>%d</cs:getctag>" % (collection.revision, ),
+                    "<d:sync-token>%s</d:sync-token>" % (collection.token(), )], None)])
+            elif path == collection.path:
+                self.multistatus([(item, self.itemProps(item), None) for item in sorted(collection.items)])
+            else:
+                self.reply(404)
+
+    def do_REPORT(self):
+        request = ElementTree.fromstring(self.body())
+        collection = self.server.collection
+        with collection.lock:
+            if request.tag == DAV + "sync-collection":
+                token = request.findtext(DAV + "sync-token") or ""
+                if token and not token.startswith(collection.token(0)[:-1]):
+                    return self.reply(403, b'<d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>')
+                since = int(token.rsplit("/", 1)[1]) if token else 0
+                if since > collection.revision:
+                    return self.reply(403, b'<d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>')
+
+                responses = []
+                for path, revision in sorted(collection.changes.items()):
+                    if revision > since:
+                        if path in collection.items:
+                            responses.append((path, self.itemProps(path), None))
+                        elif token:
+                            responses.append((path, [], "404 Not Found"))
+                self.multistatus(responses, "<d:sync-token>%s</d:sync-token>" % (collection.token(), ))
+            elif request.tag == CALDAV + "calendar-multiget":
+                responses = []
+                for href in request.iter(DAV + "href"):
+                    path = urllib.parse.unquote(href.text)
+                    if path in collection.items:
+                        responses.append((path, self.itemProps(path, True), None))
+                    else:
+                        responses.append((path, [], "404 Not Found"))
+                self.multistatus(responses)
+            else:
+                self.reply(400)
+
+    def do_GET(self):
+        collection = self.server.collection
+        with collection.lock:
+            item = collection.items.get(urllib.parse.unquote(self.path))
+        if item is None:
+            return self.reply(404)
+        self.reply(200, item[1].encode("utf-8"), {"Content-Type": "text/calendar; charset=utf-8", "ETag": item[0]})
+
+    def preconditionFailed(self, path):
+        item = self.server.collection.items.get(path)
+        if self.headers.get("If-None-Match") == "*" and item is not None:
+            return True
+        return "If-Match" in self.headers and (item is None or item[0] != self.headers["If-Match"])
+
+    def do_PUT(self):
+        text = self.body().decode("utf-8")
+        collection = self.server.collection
+        path = urllib.parse.unquote(self.path)
+        with collection.lock:
+            if not path.startswith(collection.path):
+                return self.reply(403)
+            if self.preconditionFailed(path):
+                return self.reply(412)
+            created = path not in collection.items
+            collection.change(path, text)
+            etag = collection.items[path][0]
+        self.reply(201 if created else 204, b"", {"ETag": etag})
+
+    def do_DELETE(self):
+        self.body()
+        collection = self.server.collection
+        path = urllib.parse.unquote(self.path)
+        with collection.lock:
+            if path not in collection.items:
+                return self.reply(404)
+            if self.preconditionFailed(path):
+                return self.reply(412)
+            collection.change(path, None)
+        self.reply(204)
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, collection=None):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), StandInRequestHandler)
+        self.collection = collection or StandInCollection()
+
+    def url(self):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], self.collection.path)
@@ -0,0 +1,1968 @@
+# -*- coding: utf-8 -*-
+
+# Data model, persistence and calendar arithmetic without any Qt dependency.
+# Dates are proleptic Gregorian ordinals (datetime.date.toordinal()), colors
+# are 0xRRGGBB integers.
+
+import datetime
+import os
+import bisect
+import collections
+import heapq
+import itertools
+import random
+import json
+import re
+import threading
+
+
+MONTH_NAMES = ["Januar", "Februar", u"März", "April", "Mai", "Juni", "Juli",
+               "August", "September", "Oktober", "November", "Dezember"]
+
+WEEKDAY_NAMES = ["Sonntag", "Montag", "Dienstag", "Mittwoch", "Donnerstag",
+                 "Freitag", "Samstag", "Sonntag"]
+
+
+ACCENT_COLORS = [
+    0xb58900,  # Yellow
+    0xcb4b16,  # Orange
+    0xdc322f,  # Red
+    0xd33682,  # Magenta
+    0x6c71c4,  # Violet
+    0x268bd2,  # Blue
+    0x2aa198,  # Cyan
+    0x859900,  # Green
+]
+
+
+def month_index(year, month):
+    return (year - 1900) * 12 + month - 1
+
+def month_length(month):
+    if month % 12 == 1:
+        year = 1900 + month // 12
+        return 29 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 28
+    return [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month % 12]
+
+
+# Calendar kernel: flat tables per month index from 1900 to 2199, so the
+# paint and selection paths answer month questions with a list lookup.
+# Months outside fall back to datetime.
+KERNEL_MONTHS = (2200 - 1900) * 12
+
+MONTH_DAYS = [month_length(month) for month in range(KERNEL_MONTHS)]
+MONTH_FIRST = [datetime.date(1900 + month // 12, month % 12 + 1, 1).toordinal() for month in range(KERNEL_MONTHS)]
+MONTH_WEEKDAY = [(first - 1) % 7 + 1 for first in MONTH_FIRST]
+MONTH_SUNDAYS = [tuple(range((7 - weekday) % 7 + 1, days + 1, 7)) for weekday, days in zip(MONTH_WEEKDAY, MONTH_DAYS)]
+
+KERNEL_FIRST = MONTH_FIRST[0]
+KERNEL_END = MONTH_FIRST[-1] + MONTH_DAYS[-1]
+
+def days_of_month(month):
+    if 0 <= month < KERNEL_MONTHS:
+        return MONTH_DAYS[month]
+    return month_length(month)
+
+def ordinal(month, day):
+    if 0 <= month < KERNEL_MONTHS:
+        return MONTH_FIRST[month] + day - 1
+    return datetime.date(1900 + month // 12, month % 12 + 1, day).toordinal()
+
+def month_and_day(date):
+    if KERNEL_FIRST <= date < KERNEL_END:
+        month = bisect.bisect_right(MONTH_FIRST, date) - 1
+        return month, date - MONTH_FIRST[month] + 1
+    date = datetime.date.fromordinal(date)
+    return month_index(date.year, date.month), date.day
+
+def first_weekday(month):
+    # Weekday of the first day, Monday is 1 and Sunday is 7.
+    if 0 <= month < KERNEL_MONTHS:
+        return MONTH_WEEKDAY[month]
+    return day_of_week(ordinal(month, 1))
+
+def sundays_of_month(month):
+    if 0 <= month < KERNEL_MONTHS:
+        return MONTH_SUNDAYS[month]
+    return tuple(range((7 - first_weekday(month)) % 7 + 1, days_of_month(month) + 1, 7))
+
+def year_of(date):
+    return datetime.date.fromordinal(date).year
+
+def day_of_week(date):
+    # Monday is 1 and Sunday is 7, like QDate.dayOfWeek().
+    return (date - 1) % 7 + 1
+
+def add_months(date, months):
+    month, day = month_and_day(date)
+    month += months
+    return ordinal(month, min(day, days_of_month(month)))
+
+def parse_date(text):
+    return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10])).toordinal()
+
+def format_date(date):
+    return datetime.date.fromordinal(date).isoformat()
+
+def parse_color(text):
+    return int(text.lstrip("#")[:6], 16)
+
+def format_color(rgb):
+    return "#%06x" % (rgb, )
+
+
+def easter_sunday(year):
+    g = year % 19
+    c = year // 100
+    h = (c - (c // 4) - ((8 * c + 13) // 25) + 19 * g + 15) % 30
+    i = h - (h // 28) * (1 - (h // 28) * (29 // (h + 1)) * ((21 - g) // 11))
+    day = i - ((year + (year // 4) + i + 2 - c + (c // 4)) % 7) + 28
+    if day > 31:
+        return (year - 1900) * 12 + 3, day - 31
+    else:
+        return (year - 1900) * 12 + 2, day
+
+
+HOLIDAY_NONE = 0
+HOLIDAY_NEWYEAR = 1
+HOLIDAY_GOOD_FRIDAY = 2
+HOLIDAY_EASTER_MONDAY = 4
+HOLIDAY_MAY_1 = 8
+HOLIDAY_ASCENSION = 16
+HOLIDAY_PENTECOST = 32
+HOLIDAY_TAG_DER_DEUTSCHEN_EINHEIT = 64
+HOLIDAY_CHRISTMAS = 128
+HOLIDAY_SUNDAY = 256
+HOLIDAY_REFORMATIONSTAG = 512
+
+HOLIDAY_NAMES = {
+    HOLIDAY_NEWYEAR: "Neujahr",
+    HOLIDAY_GOOD_FRIDAY: "Karfreitag",
+    HOLIDAY_EASTER_MONDAY: "Ostermontag",
+    HOLIDAY_MAY_1: "Tag der Arbeit",
+    HOLIDAY_ASCENSION: "Christi Himmelfahrt",
+    HOLIDAY_PENTECOST: "Pfingsten",
+    HOLIDAY_TAG_DER_DEUTSCHEN_EINHEIT: "Tag der Deutschen Einheit",
+    HOLIDAY_CHRISTMAS: "Weihnachten",
+    HOLIDAY_SUNDAY: "Sonntag",
+    HOLIDAY_REFORMATIONSTAG: "Reformationstag",
+}
+
+# Holidays relative to Easter Sunday, in days.
+EASTER_HOLIDAYS = [
+    (-2, HOLIDAY_GOOD_FRIDAY),
+    (1, HOLIDAY_EASTER_MONDAY),
+    (39, HOLIDAY_ASCENSION),
+    (49, HOLIDAY_PENTECOST),
+]
+
+# Holidays on fixed dates, as (month of year, day).
+FIXED_HOLIDAYS = [
+    (1, 1, HOLIDAY_NEWYEAR),
+    (5, 1, HOLIDAY_MAY_1),
+    (10, 3, HOLIDAY_TAG_DER_DEUTSCHEN_EINHEIT),
+    (10, 31, HOLIDAY_REFORMATIONSTAG),
+    (12, 25, HOLIDAY_CHRISTMAS),
+    (12, 26, HOLIDAY_CHRISTMAS),
+]
+
+def is_holiday(month, day):
+    holiday = HOLIDAY_NONE
+
+    easter = ordinal(*easter_sunday(1900 + month // 12))
+    date = ordinal(month, day)
+
+    if day_of_week(date) == 7:
+        holiday |= HOLIDAY_SUNDAY
+
+    for offset, flag in EASTER_HOLIDAYS:
+        if date - offset == easter:
+            holiday |= flag
+
+    for holidayMonth, holidayDay, flag in FIXED_HOLIDAYS:
+        if month % 12 + 1 == holidayMonth and day == holidayDay:
+            holiday |= flag
+
+    return holiday
+
+def holidays_of_month(month):
+    # Same flags as is_holiday for every day of the month at once.
+    first = ordinal(month, 1)
+    holidays = [HOLIDAY_NONE] * days_of_month(month)
+
+    for day in sundays_of_month(month):
+        holidays[day - 1] |= HOLIDAY_SUNDAY
+
+    easter = ordinal(*easter_sunday(1900 + month // 12))
+    for offset, flag in EASTER_HOLIDAYS:
+        if 0 <= easter + offset - first < len(holidays):
+            holidays[easter + offset - first] |= flag
+
+    for holidayMonth, holidayDay, flag in FIXED_HOLIDAYS:
+        if month % 12 + 1 == holidayMonth:
+            holidays[holidayDay - 1] |= flag
+
+    return holidays
+
+
+FERIEN_NIEDERSACHSEN = [
+    # 2013/2014
+    ((2013, 1, 31), (2013, 2, 1)),  # Winter
+    ((2013, 3, 16), (2013, 4, 2)),  # Ostern
+    ((2013, 5, 10), (2013, 5, 10)),  # Pfingsten
+    ((2013, 5, 21), (2013, 5, 21)),  # Pfingsten
+    ((2013, 6, 27), (2013, 8, 7)),  # Sommer
+    ((2013, 10, 4), (2013, 10, 18)),  # Herbst
+    ((2013, 12, 23), (2014, 1, 3)),  # Weihnachten
+    # 2014/2015
+    ((2014, 1, 30), (2014, 1, 31)),  # Winter
+    ((2014, 4, 3), (2014, 4, 22)),  # Ostern
+    ((2014, 5, 2), (2014, 5, 2)),  # Ostern
+    ((2014, 5, 30), (2014, 5, 30)),  # Pfingsten
+    ((2014, 6, 10), (2014, 6, 10)),  # Pfingsten
+    ((2014, 7, 31), (2014, 9, 10)),  # Sommer
+    ((2014, 10, 27), (2014, 11, 8)),  # Herbst
+    ((2014, 12, 22), (2015, 1, 5)),  # Weihnachten
+    # 2015/2016
+    ((2015, 2, 2), (2015, 2, 3)),  # Winter
+    ((2015, 3, 25), (2015, 4, 10)),  # Ostern
+    ((2015, 5, 15), (2015, 5, 15)),  # Pfingsten
+    ((2015, 5, 26), (2015, 5, 26)),  # Pfingsten
+    ((2015, 7, 23), (2015, 9, 2)),  # Sommer
+    ((2015, 10, 19), (2015, 10, 31)),  # Herbst
+    ((2015, 12, 23), (2016, 1, 6)),  # Weihnachten
+    # 2016/2017
+    ((2016, 1, 28), (2016, 1, 29)),  # Winter
+    ((2016, 3, 18), (2016, 4, 2)),  # Ostern
+    ((2016, 5, 6), (2016, 5, 6)),  # Pfingsten
+    ((2016, 5, 17), (2016, 5, 17)),  # Pfingsten
+    ((2016, 6, 23), (2016, 8, 3)),  # Sommer
+    ((2016, 10, 3), (2016, 10, 15)),  # Herbst
+    ((2016, 12, 21), (2017, 1, 6)),  # Weihnachten
+    # 2017/2018
+    ((2017, 1, 30), (2017, 1, 31)),  # Winter
+    ((2017, 4, 10), (2017, 4, 22)),  # Ostern
+    ((2017, 5, 26), (2017, 5, 26)),  # Pfingsten
+    ((2017, 6, 6), (2017, 6, 6)),  # Pfingsten
+    ((2017, 6, 22), (2017, 8, 2)),  # Sommer
+    ((2017, 10, 2), (2017, 10, 13)),  # Herbst
+    ((2017, 10, 30), (2017, 10, 30)),  # Brückentag
+    ((2017, 10, 31), (2017, 10, 31)),  # Reformationstag
+    ((2017, 12, 22), (2018, 1, 5)),  # Weihnachten
+    # 2018/2019
+    ((2018, 2, 1), (2018, 2, 2)),  # Winter
+    ((2018, 3, 19), (2018, 4, 3)),  # Ostern
+    ((2018, 4, 30), (2018, 4, 30)),  # Pfingsten
+    ((2018, 5, 11), (2018, 5, 11)),  # Pfingsten
+    ((2018, 5, 22), (2018, 5, 22)),  # Pfingsten
+    ((2018, 6, 28), (2018, 8, 8)),  # Sommer
+    ((2018, 10, 1), (2018, 10, 12)),  # Herbst
+    ((2018, 12, 24), (2019, 1, 4)),  # Weihnachten
+    # 2019/2020
+    ((2019, 1, 31), (2019, 2, 1)),  # Winter
+    ((2019, 4, 8), (2019, 4, 23)),  # Ostern
+    ((2019, 5, 31), (2019, 5, 31)),  # Pfingsten
+    ((2019, 6, 11), (2019, 6, 11)),  # Pfingsten
+    ((2019, 7, 4), (2019, 8, 14)),  # Sommer
+    ((2019, 10, 4), (2019, 10, 18)),  # Herbst
+    ((2019, 12, 23), (2020, 1, 6)),  # Weihnachten
+    # 2020/2021
+    ((2020, 2, 3), (2020, 2, 4)),  # Winter
+    ((2020, 3, 30), (2020, 4, 14)),  # Ostern
+    ((2020, 5, 22), (2020, 5, 22)),  # Pfingsten
+    ((2020, 6, 2), (2020, 6, 2)),  # Pfingsten
+    ((2020, 7, 16), (2020, 8, 26)),  # Sommer
+    ((2020, 10, 12), (2020, 10, 23)),  # Herbst
+    ((2020, 12, 23), (2021, 1, 8)),  # Weihnachten
+    # 2021/2022
+    ((2021, 2, 1), (2021, 2, 2)),  # Winter
+    ((2021, 3, 29), (2021, 4, 9)),  # Ostern
+    ((2021, 5, 14), (2021, 5, 14)),  # Pfingsten
+    ((2021, 5, 25), (2021, 5, 25)),  # Pfingsten
+    ((2021, 7, 22), (2021, 9, 1)),  # Sommer
+    ((2021, 10, 18), (2021, 10, 29)),  # Herbst
+    ((2021, 12, 23), (2022, 1, 7)),  # Weihnachten
+]
+
+FERIEN_NIEDERSACHSEN_ORDINALS = sorted(
+    (datetime.date(*start).toordinal(), datetime.date(*end).toordinal())
+    for start, end in FERIEN_NIEDERSACHSEN)
+
+FERIEN_NIEDERSACHSEN_STARTS = [start for start, end in FERIEN_NIEDERSACHSEN_ORDINALS]
+
+def is_vacation(month, day):
+    date = ordinal(month, day)
+    i = bisect.bisect_right(FERIEN_NIEDERSACHSEN_STARTS, date)
+    return any(start <= date <= end for start, end in FERIEN_NIEDERSACHSEN_ORDINALS[max(0, i - 2):i])
+
+def vacations_of_month(month):
+    first = ordinal(month, 1)
+    last = first + days_of_month(month) - 1
+    vacations = [False] * days_of_month(month)
+
+    i = bisect.bisect_right(FERIEN_NIEDERSACHSEN_STARTS, last)
+    while i > 0 and FERIEN_NIEDERSACHSEN_ORDINALS[i - 1][1] >= first:
+        start, end = FERIEN_NIEDERSACHSEN_ORDINALS[i - 1]
+        for date in range(max(start, first), min(end, last) + 1):
+            vacations[date - first] = True
+        i -= 1
+
+    return vacations
+
+
+class Notifier(object):
+    # Minimal stand-in for a Qt signal, so that models stay picklable.
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        self.slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in list(self.slots):
+            slot(*args)
+
+
+REPEAT_NONE = 0
+REPEAT_WEEKLY = 1
+REPEAT_MONTHLY = 2
+REPEAT_YEARLY = 3
+
+REPEAT_NAMES = ["Keine", u"Wöchentlich", "Monatlich", u"Jährlich"]
+
+
+# Tag names are interned once per process, every tag is one bit of
+# Range.tags, so visibility and search filters are a single bitwise test.
+# The bits mean nothing in another process, pickled ranges carry names.
+TAG_NAMES = []
+TAG_IDS = {}
+TAG_LOCK = threading.Lock()
+
+def tag_id(name):
+    i = TAG_IDS.get(name)
+    if i is not None:
+        return i
+
+    # Imports and reloads of the query service intern tags in threads.
+    with TAG_LOCK:
+        if name not in TAG_IDS:
+            TAG_NAMES.append(name)
+            TAG_IDS[name] = len(TAG_NAMES) - 1
+        return TAG_IDS[name]
+
+def tag_mask(names):
+    mask = 0
+    for name in names:
+        name = name.strip()
+        if name:
+            mask |= 1 << tag_id(name)
+    return mask
+
+def tag_names(mask):
+    return [name for i, name in enumerate(TAG_NAMES) if mask >> i & 1]
+
+
+class Range(object):
+    def __init__(self):
+        self.index = None
+        self.deleted = False
+        self.title = ""
+        self.notes = ""
+        self.start = None
+        self.end = None
+        self.color = 0
+        self.repeat = REPEAT_NONE
+        self.interval = 1
+        self.until = None
+        self.exceptions = []
+        self.tags = 0
+
+        self.occurrenceKey = None
+        self.occurrenceCache = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["tags"] = tag_names(self.tags)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tags = tag_mask(state["tags"])
+
+    def copy(self):
+        r = Range()
+        r.index = self.index
+        r.deleted = self.deleted
+        r.title = self.title
+        r.notes = self.notes
+        r.start = self.start
+        r.end = self.end
+        r.color = self.color
+        r.repeat = self.repeat
+        r.interval = self.interval
+        r.until = self.until
+        r.exceptions = list(self.exceptions)
+        r.tags = self.tags
+        return r
+
+    def isRecurring(self):
+        return self.repeat != REPEAT_NONE
+
+    def nthStart(self, n):
+        if self.repeat == REPEAT_WEEKLY:
+            return self.start + 7 * self.interval * n
+        elif self.repeat == REPEAT_MONTHLY:
+            return add_months(self.start, self.interval * n)
+        elif self.repeat == REPEAT_YEARLY:
+            return add_months(self.start, 12 * self.interval * n)
+        else:
+            return self.start
+
+    def firstIndexOfYear(self, year):
+        start = datetime.date.fromordinal(self.start)
+        if self.repeat == REPEAT_WEEKLY:
+            days = datetime.date(year, 1, 1).toordinal() - self.start
+            step = 7 * self.interval
+        elif self.repeat == REPEAT_MONTHLY:
+            days = (year - start.year) * 12 - start.month + 1
+            step = self.interval
+        else:
+            days = year - start.year
+            step = self.interval
+
+        return max(0, -(-days // step))
+
+    def occurrencesOfYear(self, year):
+        # Drop cached expansions when the rule changed.
+        key = (self.start, self.end, self.repeat, self.interval, self.until,
+               tuple(sorted(self.exceptions)))
+        if key != self.occurrenceKey:
+            self.occurrenceKey = key
+            self.occurrenceCache = {}
+
+        if year in self.occurrenceCache:
+            return self.occurrenceCache[year]
+
+        duration = self.end - self.start
+        exceptions = set(self.exceptions)
+        last = datetime.date(year, 12, 31).toordinal()
+        occurrences = []
+
+        n = self.firstIndexOfYear(year)
+        while True:
+            start = self.nthStart(n)
+            if start > last:
+                break
+            if self.until is not None and start > self.until:
+                break
+            if start not in exceptions:
+                occurrences.append((start, start + duration))
+            n += 1
+
+        self.occurrenceCache[year] = occurrences
+        return occurrences
+
+    def occurrences(self, first, last):
+        if not self.isRecurring():
+            if self.start <= last and self.end >= first:
+                return [(self.start, self.end)]
+            else:
+                return []
+
+        # Only expand the years that can overlap the window.
+        result = []
+        fromYear = year_of(max(first - (self.end - self.start), self.start))
+        for year in range(fromYear, year_of(last) + 1):
+            for start, end in self.occurrencesOfYear(year):
+                if start <= last and end >= first:
+                    result.append((start, end))
+        return result
+
+
+SEGMENT_RANGE_BUDGET = 100000
+
+COMMIT_BATCH_SIZE = 5000
+
+
+class Model(object):
+
+    def __init__(self):
+        self.modelChanged = Notifier()
+        self.rangesChanged = Notifier()
+        # Years being loaded or evicted, only views of the loaded years
+        # follow these, indexes over all ranges only follow rangesChanged.
+        self.residentChanged = Notifier()
+
+        self.ranges = {}
+        self.modified = False
+
+        self.undoStack = []
+        self.redoStack = []
+
+        self.history = None
+
+        # Year segments of a partitioned file. Ranges are stored in the
+        # segment of their start year, recurring ones in the main file.
+        # Without segmentPath all ranges are in memory.
+        self.segmentPath = None
+        self.segmentOf = {}
+        self.segmentIds = {}
+        self.segmentBounds = {}
+        self.loadedSegments = collections.OrderedDict()
+        self.dirtySegments = set()
+        self.savedRecurring = {}
+        # Per saved year (id, start, end, title, color, tags) of every
+        # range, stored in the main file. Indexes over all years are built
+        # from these instead of reading the years that are not loaded.
+        self.segmentSummaries = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["modelChanged"]
+        del state["rangesChanged"]
+        del state["residentChanged"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.modelChanged = Notifier()
+        self.rangesChanged = Notifier()
+        self.residentChanged = Notifier()
+
+    def nextId(self):
+        return max(itertools.chain(self.ranges.keys(), self.segmentOf.keys(), [0])) + 1
+
+    def ensureSegments(self, years):
+        if self.segmentPath is None:
+            return False
+
+        years = set(year for year in years if year in self.segmentIds)
+        for year in years:
+            if year in self.loadedSegments:
+                self.loadedSegments.move_to_end(year)
+
+        missing = sorted(year for year in years if year not in self.loadedSegments)
+        if not missing:
+            return False
+
+        changes = []
+        for year in missing:
+            for r in self.readSegment(year):
+                before = self.ranges.get(r.index)
+                changes.append((before if before is not None else deleted_range(r.index), r))
+                self.ranges[r.index] = r
+            self.loadedSegments[year] = True
+
+        self.residentChanged.emit(changes)
+        self.modelChanged.emit()
+        return True
+
+    def ensureDates(self, first, last, evict=False):
+        # Loads every year with ranges between the two days. With evict
+        # other years may be dropped, only the view should ask for that,
+        # so that consumers do not take turns evicting each other's years.
+        if self.segmentPath is None:
+            return False
+
+        years = [year for year, (start, end) in self.segmentBounds.items() if start <= last and end >= first]
+        loaded = self.ensureSegments(years)
+        if evict:
+            self.evict(years)
+        return loaded
+
+    def ensureSegmentsOf(self, ranges):
+        # Years a change touches are loaded before it is applied.
+        if self.segmentPath is None:
+            return
+        years = set()
+        for r in ranges:
+            years.add(self.segmentOf.get(r.index))
+            if not r.deleted and r.start is not None:
+                years.add(segment_of_range(r))
+        self.ensureSegments(years)
+
+    def loadAll(self):
+        self.ensureSegments(list(self.segmentIds))
+
+    def evict(self, keep=()):
+        # Drops unmodified years, least recently used first, while more than
+        # SEGMENT_RANGE_BUDGET ranges are loaded. The years around today
+        # always stay.
+        loaded = sum(len(self.segmentIds.get(year, ())) for year in self.loadedSegments)
+        if loaded <= SEGMENT_RANGE_BUDGET:
+            return
+
+        year = datetime.date.today().year
+        pinned = set(keep) | self.dirtySegments | set([year - 1, year, year + 1])
+
+        changes = []
+        for year in list(self.loadedSegments):
+            if loaded <= SEGMENT_RANGE_BUDGET:
+                break
+            if year in pinned:
+                continue
+
+            for i in self.segmentIds.get(year, ()):
+                r = self.ranges.pop(i, None)
+                if r is not None:
+                    changes.append((r, deleted_range(i)))
+            del self.loadedSegments[year]
+            loaded -= len(self.segmentIds.get(year, ()))
+
+        if changes:
+            self.residentChanged.emit(changes)
+            self.modelChanged.emit()
+
+    def readSegment(self, year):
+        with open(segment_path(self.segmentPath, year), "r") as handle:
+            document = json.load(handle)
+        ranges = []
+        for key in document:
+            r = range_of_entry(document[key])
+            r.index = int(key)
+            ranges.append(r)
+        self.segmentSummaries[year] = [summary_of_range(r) for r in sorted(ranges, key=lambda r: r.index)]
+        return ranges
+
+    def summaryRanges(self):
+        # Like allRanges, but years not loaded come from their summaries,
+        # without notes. Only files saved before summaries existed are read.
+        for r in list(self.ranges.values()):
+            yield r
+        if self.segmentPath is None:
+            return
+        for year in sorted(self.segmentIds):
+            if year not in self.loadedSegments:
+                for r in self.summaryOf(year):
+                    if r.index not in self.ranges:
+                        yield r
+
+    def summaryOf(self, year):
+        if year not in self.segmentSummaries:
+            self.readSegment(year)
+        return [range_of_summary(summary) for summary in self.segmentSummaries[year]]
+
+    def rangesBetween(self, first, last):
+        # Ranges touching the days and all recurring ones, years not loaded
+        # from their summaries.
+        def touches(r):
+            return not r.deleted and r.start is not None and (r.isRecurring() or (r.start <= last and r.end >= first))
+
+        if self.segmentPath is None:
+            return [r for r in self.ranges.values() if touches(r)]
+
+        result = [r for r in self.ranges.values() if r.isRecurring() and touches(r)]
+        for year, (start, end) in sorted(self.segmentBounds.items()):
+            if start > last or end < first:
+                continue
+            elif year in self.loadedSegments:
+                ranges = [self.ranges[i] for i in self.segmentIds.get(year, ()) if i in self.ranges]
+            else:
+                ranges = self.summaryOf(year)
+            result.extend(r for r in ranges if touches(r))
+        return result
+
+    def allRanges(self):
+        # Every range, years not loaded are read one at a time without
+        # keeping them in memory.
+        for r in list(self.ranges.values()):
+            yield r
+        if self.segmentPath is None:
+            return
+        for year in sorted(self.segmentIds):
+            if year not in self.loadedSegments:
+                for r in self.readSegment(year):
+                    if r.index not in self.ranges:
+                        yield r
+
+    def peek(self, indices, summaries=False):
+        # Ranges by id without loading their years. With summaries those of
+        # years not loaded come without notes, but without reading a file.
+        indices = set(indices)
+        result = {}
+        years = set()
+        for i in indices:
+            if i in self.ranges:
+                result[i] = self.ranges[i]
+            elif i in self.segmentOf:
+                years.add(self.segmentOf[i])
+        for year in sorted(years):
+            for r in self.summaryOf(year) if summaries else self.readSegment(year):
+                if r.index in indices and r.index not in result:
+                    result[r.index] = r
+        return result
+
+    def track(self, before, after):
+        # Segment membership of one change.
+        if self.segmentPath is None:
+            return
+
+        if not before.deleted and before.start is not None:
+            year = self.segmentOf.pop(before.index, None)
+            if year is not None:
+                self.segmentIds[year].discard(before.index)
+                self.dirtySegments.add(year)
+
+        if not after.deleted and after.start is not None:
+            year = segment_of_range(after)
+            if year is not None:
+                self.segmentOf[after.index] = year
+                self.segmentIds.setdefault(year, set()).add(after.index)
+                self.loadedSegments[year] = True
+                self.dirtySegments.add(year)
+                bounds = self.segmentBounds.setdefault(year, [after.start, after.end])
+                bounds[0] = min(bounds[0], after.start)
+                bounds[1] = max(bounds[1], after.end)
+
+    def commit(self, r):
+        self.commitMany([r])
+
+    def commitMany(self, ranges):
+        # All ranges become a single undo step and a single notification.
+        ranges = list(ranges)
+        self.ensureSegmentsOf(ranges)
+
+        actions = []
+        changes = []
+        nextId = self.nextId()
+
+        try:
+            for r in ranges:
+                if r.index:
+                    i = r.index
+                    nextId = max(nextId, i + 1)
+                else:
+                    i = nextId
+                    nextId += 1
+
+                if i in self.ranges:
+                    restoreAction = self.ranges[i]
+                    actions.append(restoreAction)
+                else:
+                    deleteAction = Range()
+                    deleteAction.index = i
+                    deleteAction.deleted = True
+                    actions.append(deleteAction)
+
+                self.ranges[i] = r.copy()
+                self.ranges[i].index = i
+                changes.append((actions[-1], self.ranges[i]))
+        finally:
+            # Keep partially consumed batches undoable.
+            for before, after in changes:
+                self.track(before, after)
+
+            if actions:
+                self.undoStack.append(actions)
+                self.redoStack = []
+
+                self.modified = True
+
+                self.rangesChanged.emit(changes)
+                self.modelChanged.emit()
+
+    def commitBatches(self, ranges, size=None):
+        # Long streams such as imports are committed in batches, so that
+        # neither the stream nor a single notification holds all of them.
+        # The batches still become one undo step.
+        ranges = iter(ranges)
+        depth = len(self.undoStack)
+        count = 0
+        try:
+            while True:
+                batch = list(itertools.islice(ranges, size or COMMIT_BATCH_SIZE))
+                if not batch:
+                    break
+                self.commitMany(batch)
+                count += len(batch)
+        finally:
+            if len(self.undoStack) > depth + 1:
+                self.undoStack[depth:] = [list(itertools.chain.from_iterable(self.undoStack[depth:]))]
+        return count
+
+    def undo(self):
+        if not self.undoStack:
+            return
+
+        actions = self.undoStack.pop()
+        self.ensureSegmentsOf(actions)
+
+        restoreActions = []
+        changes = []
+        for action in reversed(actions):
+            restoreActions.append(self.ranges[action.index])
+            self.ranges[action.index] = action.copy()
+            changes.append((restoreActions[-1], self.ranges[action.index]))
+            self.track(*changes[-1])
+        self.redoStack.append(restoreActions)
+
+        self.rangesChanged.emit(changes)
+        self.modelChanged.emit()
+
+    def redo(self):
+        if not self.redoStack:
+            return
+
+        actions = self.redoStack.pop()
+        self.ensureSegmentsOf(actions)
+
+        restoreActions = []
+        changes = []
+        for action in reversed(actions):
+            restoreActions.append(self.ranges[action.index])
+            self.ranges[action.index] = action.copy()
+            changes.append((restoreActions[-1], self.ranges[action.index]))
+            self.track(*changes[-1])
+        self.undoStack.append(restoreActions)
+
+        self.rangesChanged.emit(changes)
+        self.modelChanged.emit()
+
+    def document(self):
+        # The whole document, years not loaded are read without loading them.
+        document = {}
+        for r in self.allRanges():
+            if not r.deleted:
+                document[str(r.index)] = entry_of_range(r)
+        return document
+
+    @classmethod
+    def fromDocument(cls, document):
+        model = cls()
+        for key in document:
+            r = range_of_entry(document[key])
+            r.index = int(key)
+            model.ranges[r.index] = r
+        return model
+
+    def save(self, path):
+        # Only years changed since the last save are written again, the
+        # main file holds the index of the years and the recurring ranges.
+        if self.history is None or self.history.path != history_path(path):
+            self.history = History(history_path(path))
+
+        if self.segmentPath != path:
+            # A new layout writes every year.
+            self.loadAll()
+            document = self.document()
+            self.partition(path)
+        else:
+            document = None
+
+        before, after = {}, {}
+        for year in sorted(self.dirtySegments):
+            segmentPath = segment_path(path, year)
+            if document is None and os.path.exists(segmentPath):
+                with open(segmentPath, "r") as handle:
+                    before.update(json.load(handle))
+
+            segment = {}
+            for i in sorted(self.segmentIds.get(year, ())):
+                segment[str(i)] = entry_of_range(self.ranges[i])
+            after.update(segment)
+
+            if segment:
+                if not os.path.isdir(segment_directory(path)):
+                    os.makedirs(segment_directory(path))
+                with open(segmentPath, "w") as handle:
+                    json.dump(segment, handle)
+                self.segmentBounds[year] = [
+                    min(self.ranges[i].start for i in self.segmentIds[year]),
+                    max(self.ranges[i].end for i in self.segmentIds[year])]
+                self.segmentSummaries[year] = [summary_of_range(self.ranges[i]) for i in sorted(self.segmentIds[year])]
+            else:
+                if os.path.exists(segmentPath):
+                    os.remove(segmentPath)
+                self.segmentIds.pop(year, None)
+                self.segmentBounds.pop(year, None)
+                self.segmentSummaries.pop(year, None)
+                self.loadedSegments.pop(year, None)
+
+        # Files of older versions get their summaries once.
+        for year in self.segmentIds:
+            if year not in self.segmentSummaries:
+                self.readSegment(year)
+
+        recurring = {}
+        for r in self.ranges.values():
+            if not r.deleted and r.isRecurring():
+                recurring[str(r.index)] = entry_of_range(r)
+        before.update(self.savedRecurring)
+        after.update(recurring)
+
+        with open(path, "w") as handle:
+            json.dump({
+                "format": "segments",
+                "recurring": recurring,
+                "segments": dict((str(year), {
+                    "first": format_date(self.segmentBounds[year][0]),
+                    "last": format_date(self.segmentBounds[year][1]),
+                    "ids": sorted(self.segmentIds[year]),
+                    "summary": [entry_of_summary(summary) for summary in self.segmentSummaries[year]],
+                }) for year in self.segmentIds),
+            }, handle)
+
+        self.savedRecurring = recurring
+        self.dirtySegments = set()
+        self.modified = False
+
+        # Record the new version next to the file.
+        if document is not None:
+            self.history.append(document)
+        else:
+            self.history.appendChanges(document_delta(before, after), self.storedDocument)
+
+    def partition(self, path):
+        # Starts a new layout in which every year is written.
+        self.segmentPath = path
+        self.segmentOf = {}
+        self.segmentIds = {}
+        self.segmentBounds = {}
+        self.segmentSummaries = {}
+        self.loadedSegments = collections.OrderedDict()
+        self.savedRecurring = {}
+
+        for r in self.ranges.values():
+            self.track(deleted_range(r.index), r)
+
+        # Years of an earlier file with the same name.
+        if os.path.isdir(segment_directory(path)):
+            for name in os.listdir(segment_directory(path)):
+                year, extension = os.path.splitext(name)
+                if extension == ".json" and year.isdigit() and int(year) not in self.segmentIds:
+                    os.remove(os.path.join(segment_directory(path), name))
+
+    def storedDocument(self):
+        # The saved document, years not loaded are read without keeping
+        # them in memory.
+        document = dict(self.savedRecurring)
+        for year in self.segmentIds:
+            if year in self.loadedSegments:
+                for i in self.segmentIds[year]:
+                    document[str(i)] = entry_of_range(self.ranges[i])
+            else:
+                with open(segment_path(self.segmentPath, year), "r") as handle:
+                    document.update(json.load(handle))
+        return document
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as handle:
+            document = json.load(handle)
+        if document.get("format") == "segments":
+            return cls.fromSegments(path, document)
+        return cls.fromDocument(document)
+
+    @classmethod
+    def fromSegments(cls, path, index):
+        # Only the recurring ranges and the years around today are read.
+        model = cls.fromDocument(index["recurring"])
+        model.segmentPath = path
+        model.savedRecurring = index["recurring"]
+        for year in index["segments"]:
+            segment = index["segments"][year]
+            model.segmentIds[int(year)] = set(segment["ids"])
+            for i in segment["ids"]:
+                model.segmentOf[i] = int(year)
+            model.segmentBounds[int(year)] = [parse_date(segment["first"]), parse_date(segment["last"])]
+            if "summary" in segment:
+                model.segmentSummaries[int(year)] = [summary_of_entry(entry) for entry in segment["summary"]]
+
+        year = datetime.date.today().year
+        model.ensureSegments([year - 1, year, year + 1])
+        return model
+
+
+def entry_of_range(r):
+    entry = {
+        "title": r.title,
+        "notes": r.notes,
+        "start": format_date(r.start),
+        "end": format_date(r.end),
+        "color": format_color(r.color),
+    }
+
+    if r.isRecurring():
+        entry["repeat"] = r.repeat
+        entry["interval"] = r.interval
+        entry["exceptions"] = [format_date(d) for d in r.exceptions]
+        if r.until is not None:
+            entry["until"] = format_date(r.until)
+
+    if r.tags:
+        entry["tags"] = tag_names(r.tags)
+
+    return entry
+
+def range_of_entry(entry):
+    r = Range()
+    r.title = entry["title"]
+    r.notes = entry["notes"]
+    r.start = parse_date(entry["start"])
+    r.end = parse_date(entry["end"])
+    r.color = parse_color(entry["color"])
+    r.repeat = entry.get("repeat", REPEAT_NONE)
+    r.interval = entry.get("interval", 1)
+    r.exceptions = [parse_date(d) for d in entry.get("exceptions", [])]
+    if "until" in entry:
+        r.until = parse_date(entry["until"])
+    r.tags = tag_mask(entry.get("tags", []))
+    return r
+
+def summary_of_range(r):
+    return (r.index, r.start, r.end, r.title, r.color, r.tags)
+
+def range_of_summary(summary):
+    r = Range()
+    r.index, r.start, r.end, r.title, r.color, r.tags = summary
+    return r
+
+def entry_of_summary(summary):
+    index, start, end, title, color, tags = summary
+    return [index, format_date(start), format_date(end), title, format_color(color), tag_names(tags)]
+
+def summary_of_entry(entry):
+    index, start, end, title, color, tags = entry
+    return (index, parse_date(start), parse_date(end), title, parse_color(color), tag_mask(tags))
+
+def deleted_range(index):
+    r = Range()
+    r.index = index
+    r.deleted = True
+    return r
+
+def segment_of_range(r):
+    return None if r.isRecurring() else year_of(r.start)
+
+def segment_directory(path):
+    return os.path.splitext(path)[0] + ".segments"
+
+def segment_path(path, year):
+    return os.path.join(segment_directory(path), "%d.json" % (year, ))
+
+def history_path(path):
+    return os.path.splitext(path)[0] + ".history"
+
+def document_delta(before, after):
+    # Changed and added entries, None for removed ones.
+    delta = {}
+    for key in after:
+        if before.get(key) != after[key]:
+            delta[key] = after[key]
+    for key in before:
+        if key not in after:
+            delta[key] = None
+    return delta
+
+def apply_document_delta(document, delta):
+    for key in delta:
+        if delta[key] is None:
+            document.pop(key, None)
+        else:
+            document[key] = delta[key]
+
+
+HISTORY_SNAPSHOT_INTERVAL = 32
+
+
+class History(object):
+    # Append-only log of saved versions, one line per version:
+    #
+    #   <time> snapshot 0 <document>
+    #   <time> delta <depth> <changed entries>
+    #
+    # depth counts the deltas since the last snapshot, so any version is
+    # rebuilt from one snapshot and at most HISTORY_SNAPSHOT_INTERVAL - 1
+    # deltas. The JSON of skipped versions is never parsed.
+    def __init__(self, path):
+        self.path = path
+        self.last = None
+        self.depth = None
+
+    def versions(self):
+        # (time, depth, offset) of every version, oldest first.
+        versions = []
+        if not os.path.exists(self.path):
+            return versions
+
+        offset = 0
+        with open(self.path, "rb") as handle:
+            for line in handle:
+                time, kind, depth, data = line.split(b" ", 3)
+                versions.append((time.decode("ascii"), int(depth), offset))
+                offset += len(line)
+        return versions
+
+    def documentOf(self, versions, i):
+        if i < 0:
+            return None
+
+        depth = versions[i][1]
+        document = {}
+        with open(self.path, "rb") as handle:
+            handle.seek(versions[i - depth][2])
+            for _ in range(depth + 1):
+                _, kind, _, data = handle.readline().split(b" ", 3)
+                if kind == b"snapshot":
+                    document = json.loads(data.decode("utf-8"))
+                else:
+                    apply_document_delta(document, json.loads(data.decode("utf-8")))
+        return document
+
+    def documentAt(self, date):
+        # The last version saved on or before the given day.
+        versions = self.versions()
+        i = bisect.bisect_right([time for time, depth, offset in versions], format_date(date) + "T23:59:59") - 1
+        return self.documentOf(versions, i)
+
+    def modelAt(self, date):
+        document = self.documentAt(date)
+        if document is None:
+            return None
+        return Model.fromDocument(document)
+
+    def append(self, document, time=None):
+        if self.last is None:
+            versions = self.versions()
+            self.last = self.documentOf(versions, len(versions) - 1)
+
+        delta = document_delta(self.last, document) if self.last is not None else None
+        self.appendChanges(delta, lambda: document, time)
+        self.last = dict(document)
+
+    def appendChanges(self, delta, document, time=None):
+        # Only the changed entries are needed, document is called for the
+        # whole document when a snapshot is due.
+        if self.depth is None:
+            versions = self.versions()
+            self.depth = versions[-1][1] if versions else -1
+
+        if delta is None or self.depth < 0 or self.depth + 1 >= HISTORY_SNAPSHOT_INTERVAL:
+            kind, depth, data = "snapshot", 0, document()
+        else:
+            if not delta:
+                return
+            kind, depth, data = "delta", self.depth + 1, delta
+
+        if time is None:
+            time = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+        with open(self.path, "ab") as handle:
+            handle.write(("%s %s %d %s\n" % (time, kind, depth, json.dumps(data, sort_keys=True))).encode("utf-8"))
+
+        self.depth = depth
+        self.last = None
+
+
+class Occupancy(object):
+    # Number of ranges covering each day. Non-recurring ranges are kept in a
+    # difference array per year, prefix sums are built lazily per year.
+    def __init__(self, accept=None):
+        self.accept = accept
+        self.diffs = {}
+        self.counts = {}
+        self.recurring = {}
+
+    def reset(self, ranges):
+        self.diffs = {}
+        self.counts = {}
+        self.recurring = {}
+        for r in ranges:
+            self.add(r, 1)
+
+    def apply(self, changes):
+        for before, after in changes:
+            self.add(before, -1)
+            self.add(after, 1)
+
+    def add(self, r, delta):
+        if r.deleted or (self.accept and not self.accept(r)):
+            return
+
+        if r.isRecurring():
+            if delta > 0:
+                self.recurring[r.index] = r
+            else:
+                self.recurring.pop(r.index, None)
+            self.counts = {}
+            return
+
+        for year in range(year_of(r.start), year_of(r.end) + 1):
+            first = datetime.date(year, 1, 1).toordinal()
+            last = datetime.date(year, 12, 31).toordinal()
+            if year not in self.diffs:
+                self.diffs[year] = [0] * (last - first + 2)
+            diff = self.diffs[year]
+            diff[max(r.start, first) - first] += delta
+            diff[min(r.end, last) - first + 1] -= delta
+            self.counts.pop(year, None)
+
+    def countsOfYear(self, year):
+        if year in self.counts:
+            return self.counts[year]
+
+        first = datetime.date(year, 1, 1).toordinal()
+        last = datetime.date(year, 12, 31).toordinal()
+        diff = list(self.diffs.get(year, ())) or [0] * (last - first + 2)
+
+        for r in self.recurring.values():
+            for start, end in r.occurrences(first, last):
+                diff[max(start, first) - first] += 1
+                diff[min(end, last) - first + 1] -= 1
+
+        counts = list(itertools.accumulate(diff))[:-1]
+        self.counts[year] = counts
+        return counts
+
+    def countsOfMonth(self, month):
+        first = ordinal(month, 1)
+        offset = first - datetime.date(year_of(first), 1, 1).toordinal()
+        return self.countsOfYear(year_of(first))[offset:offset + days_of_month(month)]
+
+    def count(self, date):
+        year = year_of(date)
+        return self.countsOfYear(year)[date - datetime.date(year, 1, 1).toordinal()]
+
+
+class TagCounts(object):
+    # Number of live ranges per tag id.
+    def __init__(self):
+        self.counts = {}
+
+    def reset(self, ranges):
+        self.counts = {}
+        for r in ranges:
+            self.add(r, 1)
+
+    def apply(self, changes):
+        for before, after in changes:
+            self.add(before, -1)
+            self.add(after, 1)
+
+    def add(self, r, delta):
+        if r.deleted:
+            return
+
+        mask, i = r.tags, 0
+        while mask:
+            if mask & 1:
+                self.counts[i] = self.counts.get(i, 0) + delta
+            mask >>= 1
+            i += 1
+
+    def count(self, name):
+        return self.counts.get(TAG_IDS.get(name), 0)
+
+    def names(self):
+        return sorted((TAG_NAMES[i] for i in self.counts if self.counts[i] > 0), key=lambda name: name.lower())
+
+
+class MonthIndex(object):
+    # Ranges by the months they touch, recurring ranges are returned for
+    # every month.
+    def __init__(self):
+        self.months = {}
+        self.recurring = {}
+
+    def reset(self, ranges):
+        self.months = {}
+        self.recurring = {}
+        for r in ranges:
+            self.add(r, 1)
+
+    def apply(self, changes):
+        for before, after in changes:
+            self.add(before, -1)
+            self.add(after, 1)
+
+    def add(self, r, delta):
+        if r.deleted or r.start is None:
+            return
+
+        if r.isRecurring():
+            if delta > 0:
+                self.recurring[r.index] = r
+            else:
+                self.recurring.pop(r.index, None)
+            return
+
+        for month in range(month_and_day(r.start)[0], month_and_day(r.end)[0] + 1):
+            if delta > 0:
+                self.months.setdefault(month, {})[r.index] = r
+            else:
+                bucket = self.months.get(month, {})
+                bucket.pop(r.index, None)
+                if not bucket:
+                    self.months.pop(month, None)
+
+    def rangesOfMonth(self, month):
+        ranges = list(self.months.get(month, {}).values())
+        ranges.extend(self.recurring.values())
+        ranges.sort(key=lambda r: r.index)
+        return ranges
+
+
+REMINDER_TODAY = 0
+REMINDER_TOMORROW = 1
+
+
+class Reminders(object):
+    # Heap of (day, start, range id, kind) for the next reminder of every
+    # range. Outdated items stay in the heap and are dropped when they are
+    # popped and no longer match the range.
+    def __init__(self):
+        self.today = None
+        self.ranges = {}
+        self.heap = []
+        self.queued = set()
+
+    def reset(self, ranges, today):
+        # Reminders due today are reported by the next call of due().
+        self.today = today
+        self.ranges = {}
+        self.heap = []
+        self.queued = set()
+        for r in ranges:
+            if not r.deleted and r.start is not None:
+                self.ranges[r.index] = r
+                self.schedule(r, today - 1, heap=False)
+        heapq.heapify(self.heap)
+
+    def apply(self, changes):
+        for before, after in changes:
+            self.add(before, -1)
+            self.add(after, 1)
+
+        # Drop outdated items once they outweigh the live ones.
+        if len(self.heap) > 2 * len(self.ranges) + 64:
+            self.reset(list(self.ranges.values()), self.today)
+
+    def add(self, r, delta):
+        if r.deleted or r.start is None:
+            return
+
+        if delta < 0:
+            if self.ranges.get(r.index) is r:
+                del self.ranges[r.index]
+        else:
+            # Changes made today only remind from tomorrow on.
+            self.ranges[r.index] = r
+            self.schedule(r, self.today)
+
+    def nextStart(self, r, after):
+        if not r.isRecurring():
+            return r.start if r.start > after else None
+
+        for start, end in r.occurrences(after + 1, after + 366 * r.interval):
+            if start > after:
+                return start
+        return None
+
+    def isStart(self, r, start):
+        if not r.isRecurring():
+            return r.start == start
+        return any(first == start for first, last in r.occurrences(start, start))
+
+    def schedule(self, r, after, heap=True):
+        # Next reminder on a day after the given one.
+        start = self.nextStart(r, after)
+        if start is None:
+            return
+
+        if start - 1 > after:
+            self.push((start - 1, start, r.index, REMINDER_TOMORROW), heap)
+        else:
+            self.push((start, start, r.index, REMINDER_TODAY), heap)
+
+    def push(self, item, heap=True):
+        if item in self.queued:
+            return
+        self.queued.add(item)
+        if heap:
+            heapq.heappush(self.heap, item)
+        else:
+            self.heap.append(item)
+
+    def nextDay(self):
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, today):
+        # (kind, start, range) of all reminders up to today. Reminders of
+        # days that passed unnoticed are only kept if still meaningful.
+        self.today = today
+        result = []
+
+        while self.heap and self.heap[0][0] <= today:
+            item = heapq.heappop(self.heap)
+            self.queued.discard(item)
+            day, start, index, kind = item
+
+            r = self.ranges.get(index)
+            if r is None or not self.isStart(r, start):
+                continue
+
+            if start == today + 1:
+                result.append((REMINDER_TOMORROW, start, r))
+                self.push((start, start, index, REMINDER_TODAY))
+            elif start == today:
+                result.append((REMINDER_TODAY, start, r))
+                self.schedule(r, today)
+            else:
+                self.schedule(r, today - 1)
+
+        result.sort(key=lambda item: (item[1], item[2].title))
+        return result
+
+
+COPY_SAME_DATE = 0
+COPY_SAME_WEEKDAY = 1
+
+def shift_to_year(date, year, mode=COPY_SAME_DATE):
+    # Same day of month, or the nearest day with the same weekday.
+    month, day = month_and_day(date)
+    month += (year - year_of(date)) * 12
+    shifted = ordinal(month, min(day, days_of_month(month)))
+    if mode == COPY_SAME_WEEKDAY:
+        shifted = date + 7 * int(round((shifted - date) / 7.0))
+        # Stay within the target year at its first and last days.
+        if shifted < ordinal(month_index(year, 1), 1):
+            shifted += 7
+        elif shifted > ordinal(month_index(year, 12), 31):
+            shifted -= 7
+    return shifted
+
+def copy_year(monthIndex, source, target, mode=COPY_SAME_DATE, title="", color=None, skipHolidays=True):
+    # Copies of the plain ranges starting in the source year, ready for a
+    # single commitMany. Recurring ranges continue into the target year
+    # anyway, copies that already exist in the target year are left out.
+    title = title.strip().lower()
+    holidays = {}
+    copies = []
+
+    # Sundays only move copies by date, copies by weekday keep them.
+    mask = ~HOLIDAY_SUNDAY if mode == COPY_SAME_WEEKDAY else ~HOLIDAY_NONE
+    firstDay, lastDay = ordinal(month_index(target, 1), 1), ordinal(month_index(target, 12), 31)
+
+    def isHoliday(date):
+        month, day = month_and_day(date)
+        if month not in holidays:
+            holidays[month] = holidays_of_month(month)
+        return holidays[month][day - 1] & mask
+
+    for month in range(month_index(source, 1), month_index(source, 12) + 1):
+        first = ordinal(month, 1)
+        last = ordinal(month, days_of_month(month))
+        for r in monthIndex.months.get(month, {}).values():
+            if not first <= r.start <= last:
+                continue
+            if title and r.title.lower() != title:
+                continue
+            if color is not None and r.color != color:
+                continue
+
+            start = shift_to_year(r.start, target, mode)
+            if skipHolidays and isHoliday(start):
+                # The next working day, or the previous one at the end of
+                # the target year.
+                later = start
+                while later <= lastDay and isHoliday(later):
+                    later += 1
+                earlier = start
+                while earlier >= firstDay and isHoliday(earlier):
+                    earlier -= 1
+                if later <= lastDay:
+                    start = later
+                elif earlier >= firstDay:
+                    start = earlier
+
+            end = start + r.end - r.start
+            if any(other.start == start and other.end == end and other.title == r.title and other.color == r.color
+                   for other in monthIndex.months.get(month_and_day(start)[0], {}).values()):
+                continue
+
+            copy = r.copy()
+            copy.index = 0
+            copy.start = start
+            copy.end = end
+            copies.append(copy)
+
+    copies.sort(key=lambda r: (r.start, r.end, r.title))
+    return copies
+
+
+FREE_SLOT_HORIZON = 5 * 366
+
+def busy_intervals(monthIndex, first, last, title="", color=None, vacations=False):
+    # Sorted (start, end) pairs of everything a free slot has to avoid: plain
+    # ranges from the month buckets, expanded recurring ranges and
+    # optionally the vacations, merged from individually sorted lists.
+    title = title.strip().lower()
+
+    def accepts(r):
+        if title and r.title.lower() != title:
+            return False
+        return color is None or r.color == color
+
+    seen = set()
+    plain = []
+    for month in range(month_and_day(first)[0], month_and_day(last)[0] + 1):
+        for r in monthIndex.months.get(month, {}).values():
+            if r.index not in seen and r.end >= first and accepts(r):
+                seen.add(r.index)
+                plain.append((r.start, r.end))
+    plain.sort()
+
+    lists = [plain]
+    lists.extend(r.occurrences(first, last) for r in monthIndex.recurring.values() if accepts(r))
+    if vacations:
+        i = max(0, bisect.bisect_right(FERIEN_NIEDERSACHSEN_STARTS, first) - 2)
+        lists.append(FERIEN_NIEDERSACHSEN_ORDINALS[i:bisect.bisect_right(FERIEN_NIEDERSACHSEN_STARTS, last)])
+
+    return heapq.merge(*lists)
+
+def free_slot(monthIndex, length, earliest, title="", color=None, vacations=False, horizon=FREE_SLOT_HORIZON):
+    # Earliest window of length working days that touches none of the busy
+    # intervals. Sundays and holidays inside the window are skipped, but it
+    # neither starts nor ends on one. Returns (start, end) or None.
+    last = min(earliest + horizon, KERNEL_END - 1)
+    holidays = {}
+
+    def fit(first, gapLast):
+        start, count = None, 0
+        date = first
+        month, day = month_and_day(date)
+        while date <= gapLast:
+            if month not in holidays:
+                holidays[month] = holidays_of_month(month)
+            if not holidays[month][day - 1]:
+                if start is None:
+                    start = date
+                count += 1
+                if count == length:
+                    return start, date
+
+            date += 1
+            day += 1
+            if day > days_of_month(month):
+                month, day = month + 1, 1
+        return None
+
+    date = earliest
+    for busyStart, busyEnd in busy_intervals(monthIndex, earliest, last, title, color, vacations):
+        if busyEnd < date:
+            continue
+        if busyStart > date:
+            slot = fit(date, busyStart - 1)
+            if slot:
+                return slot
+        date = busyEnd + 1
+        if date > last:
+            return None
+
+    return fit(date, last)
+
+
+CONFLICTS_NONE = 0
+CONFLICTS_BY_TITLE = 1
+CONFLICTS_BY_COLOR = 2
+
+
+# Two recurring ranges are compared from the later start over this many
+# days, long enough for the weekly, monthly and yearly rules to line up.
+CONFLICTS_RECURRING_HORIZON = 4 * 366
+
+
+class Conflicts(object):
+    # Overlapping ranges with the same title or color. Plain ranges are kept
+    # as sorted intervals per group, a full reset runs a sweep line over
+    # them. Recurring ranges are kept as they are and expanded over the
+    # window of whatever they are compared with, so they meet entries in
+    # any year.
+    def __init__(self, mode=CONFLICTS_BY_TITLE):
+        self.mode = mode
+        self.groups = {}
+        self.recurring = {}
+        self.members = {}
+        self.conflicting = {}
+
+    def keyOf(self, r):
+        if r.deleted or r.start is None or self.mode == CONFLICTS_NONE:
+            return None
+        elif self.mode == CONFLICTS_BY_COLOR:
+            return r.color
+        else:
+            return r.title.strip().lower() or None
+
+    def reset(self, ranges):
+        self.groups = {}
+        self.recurring = {}
+        self.members = {}
+        self.conflicting = {}
+
+        grouped = {}
+        for r in ranges:
+            key = self.keyOf(r)
+            if key is None:
+                continue
+            elif r.isRecurring():
+                self.recurring.setdefault(key, {})[r.index] = r
+                self.members[r.index] = key, None
+            else:
+                interval = (r.start, r.end, r.index)
+                grouped.setdefault(key, []).append(interval)
+                self.members[r.index] = key, interval
+
+        for key, intervals in grouped.items():
+            intervals.sort()
+            starts = [start for start, end, index in intervals]
+            longest = max(end - start for start, end, index in intervals)
+            self.groups[key] = starts, intervals, longest
+
+            for a, b in self.sweep(intervals):
+                self.link(a, b)
+
+        for key, recurring in self.recurring.items():
+            for r in recurring.values():
+                for other in self.overlapping(r, key):
+                    self.link(r.index, other)
+
+    def sweep(self, intervals):
+        active = []
+        for start, end, index in intervals:
+            while active and active[0][0] < start:
+                heapq.heappop(active)
+            for activeEnd, other in active:
+                if other != index:
+                    yield index, other
+            heapq.heappush(active, (end, index))
+
+    def link(self, a, b):
+        self.conflicting.setdefault(a, set()).add(b)
+        self.conflicting.setdefault(b, set()).add(a)
+
+    def unlink(self, index):
+        for other in self.conflicting.pop(index, ()):
+            self.conflicting[other].discard(index)
+            if not self.conflicting[other]:
+                del self.conflicting[other]
+
+    def apply(self, changes):
+        for before, after in changes:
+            self.remove(before.index)
+            self.add(after)
+
+    def remove(self, index):
+        if index not in self.members:
+            return
+
+        key, interval = self.members.pop(index)
+        if interval is None:
+            recurring = self.recurring[key]
+            del recurring[index]
+            if not recurring:
+                del self.recurring[key]
+        else:
+            starts, intervals, longest = self.groups[key]
+            i = bisect.bisect_left(intervals, interval)
+            del intervals[i]
+            del starts[i]
+            if not intervals:
+                del self.groups[key]
+
+        self.unlink(index)
+
+    def add(self, r):
+        key = self.keyOf(r)
+        if key is None:
+            return
+
+        others = self.overlapping(r, key)
+
+        if r.isRecurring():
+            self.recurring.setdefault(key, {})[r.index] = r
+            self.members[r.index] = key, None
+        else:
+            starts, intervals, longest = self.groups.get(key, ([], [], 0))
+            interval = (r.start, r.end, r.index)
+            i = bisect.bisect_left(intervals, interval)
+            intervals.insert(i, interval)
+            starts.insert(i, interval[0])
+            self.groups[key] = starts, intervals, max(longest, r.end - r.start)
+            self.members[r.index] = key, interval
+
+        for other in others:
+            self.link(r.index, other)
+
+    def overlapping(self, r, key):
+        result = set()
+
+        # Plain ranges of the group, a recurring range is expanded over
+        # their span.
+        if key in self.groups:
+            starts, intervals, longest = self.groups[key]
+            if r.isRecurring():
+                window = r.occurrences(starts[0], starts[-1] + longest)
+            else:
+                window = [(r.start, r.end)]
+            for start, end in window:
+                lo = bisect.bisect_left(starts, start - longest)
+                hi = bisect.bisect_right(starts, end)
+                for otherStart, otherEnd, index in intervals[lo:hi]:
+                    if otherEnd >= start and index != r.index:
+                        result.add(index)
+
+        # Recurring ranges of the group, over the window of r.
+        for other in self.recurring.get(key, {}).values():
+            if other.index == r.index:
+                continue
+            if r.isRecurring():
+                first = max(r.start, other.start)
+                window = r.occurrences(first, first + CONFLICTS_RECURRING_HORIZON)
+            else:
+                window = [(r.start, r.end)]
+            if any(other.occurrences(start, end) for start, end in window):
+                result.add(other.index)
+
+        return sorted(result)
+
+    def conflictsWith(self, r):
+        return self.overlapping(r, self.keyOf(r))
+
+    def isConflicting(self, index):
+        return index in self.conflicting
+
+
+ICS_FREQUENCIES = {
+    "WEEKLY": REPEAT_WEEKLY,
+    "MONTHLY": REPEAT_MONTHLY,
+    "YEARLY": REPEAT_YEARLY,
+}
+
+ICS_WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+
+def ics_clamped(repeat, start):
+    # Days missing in some months are skipped by iCalendar, the model moves
+    # them to the last day of the month like add_months does.
+    date = datetime.date.fromordinal(start)
+    return repeat == REPEAT_MONTHLY and date.day > 28 or repeat == REPEAT_YEARLY and (date.month, date.day) == (2, 29)
+
+def ics_clamped_days(start):
+    # The day of the start or the last day of a shorter month, together
+    # with BYSETPOS=-1.
+    return ",".join(str(day) for day in range(28, datetime.date.fromordinal(start).day + 1))
+
+def ics_rule_supported(rule, start):
+    # A frequency with interval and end, BY parts only where they name
+    # the day of the start anyway. Rules on days missing in some months
+    # are only taken in the form the export writes for them.
+    frequency = rule.get("FREQ")
+    if frequency not in ICS_FREQUENCIES:
+        return False
+
+    date = datetime.date.fromordinal(start)
+    clamped = ics_clamped(ICS_FREQUENCIES[frequency], start)
+    if clamped and (rule.get("BYMONTHDAY") != ics_clamped_days(start) or rule.get("BYSETPOS") != "-1"):
+        return False
+
+    for part, value in rule.items():
+        if part in ("FREQ", "INTERVAL", "UNTIL", "COUNT", "WKST"):
+            continue
+        elif clamped and part in ("BYMONTHDAY", "BYSETPOS"):
+            continue
+        elif part == "BYDAY" and frequency == "WEEKLY" and value == ICS_WEEKDAYS[date.weekday()]:
+            continue
+        elif part == "BYMONTHDAY" and frequency != "WEEKLY" and value == str(date.day):
+            continue
+        elif part == "BYMONTH" and frequency == "YEARLY" and value == str(date.month):
+            continue
+        return False
+    return True
+
+def ics_unescape(value):
+    result = []
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            result.append("\n" if char in ("n", "N") else char)
+        else:
+            result.append(char)
+    return "".join(result)
+
+def ics_escape(value):
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def ics_date(value):
+    return datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8])).toordinal()
+
+def format_ics_date(date):
+    return datetime.date.fromordinal(date).strftime("%Y%m%d")
+
+def ics_fold(line):
+    # Lines are limited to 75 octets, continuation lines start with a space.
+    data = line.encode("utf-8")
+    limit = 75
+    while len(data) > limit:
+        cut = limit
+        while cut > 0 and (data[cut] & 0xc0) == 0x80:
+            cut -= 1
+        yield data[:cut].decode("utf-8")
+        data = b" " + data[cut:]
+    yield data.decode("utf-8")
+
+def read_ics_lines(handle):
+    # Unfold continuation lines without reading the whole file.
+    current = None
+    for line in handle:
+        line = line.rstrip("\r\n")
+        if line.startswith((" ", "\t")) and current is not None:
+            current += line[1:]
+        else:
+            if current:
+                yield current
+            current = line
+    if current:
+        yield current
+
+def read_ics_events(handle):
+    event = None
+    depth = 0
+
+    for line in read_ics_lines(handle):
+        name, _, value = line.partition(":")
+        name, _, params = name.partition(";")
+        name = name.upper()
+
+        if name == "BEGIN":
+            if event is not None:
+                depth += 1
+            elif value.upper() == "VEVENT":
+                event = []
+        elif name == "END":
+            if event is not None and depth:
+                depth -= 1
+            elif event is not None and value.upper() == "VEVENT":
+                yield event
+                event = None
+        elif event is not None and not depth:
+            event.append((name, params.upper(), value))
+
+def range_from_ics_event(event):
+    r = Range()
+    r.color = random.choice(ACCENT_COLORS)
+    duration = None
+    rule = None
+
+    for name, params, value in event:
+        if name == "SUMMARY":
+            r.title = ics_unescape(value).strip()
+        elif name == "DESCRIPTION":
+            r.notes = ics_unescape(value)
+        elif name == "DTSTART":
+            r.start = ics_date(value)
+        elif name == "DTEND":
+            r.end = ics_date(value)
+            if "T" not in value:
+                # All day events end exclusively.
+                r.end -= 1
+        elif name == "DURATION":
+            match = re.match(r"\+?P(?:(\d+)W)?(?:(\d+)D)?", value)
+            if match:
+                duration = 7 * int(match.group(1) or 0) + int(match.group(2) or 0)
+        elif name in ("COLOR", "X-KALENDER-COLOR"):
+            if re.match(r"^#[0-9a-fA-F]{6}$", value):
+                r.color = parse_color(value)
+        elif name == "RRULE":
+            rule = dict(part.partition("=")[::2] for part in value.upper().split(";") if part)
+        elif name == "EXDATE":
+            r.exceptions.extend(ics_date(d) for d in value.split(","))
+        elif name == "CATEGORIES":
+            r.tags |= tag_mask(ics_unescape(part) for part in re.split(r"(?<!\\),", value))
+
+    if r.start is None:
+        return None
+
+    if duration is not None:
+        r.end = r.start + max(0, duration - 1)
+    if r.end is None or r.end < r.start:
+        r.end = r.start
+
+    # Rules that would import as another series are rejected.
+    if rule is not None:
+        if not ics_rule_supported(rule, r.start):
+            raise ValueError(u"Wiederholung nicht unterstützt: %s" % (";".join("%s=%s" % item for item in sorted(rule.items())), ))
+        r.repeat = ICS_FREQUENCIES[rule["FREQ"]]
+        r.interval = max(1, int(rule.get("INTERVAL", 1)))
+        if "UNTIL" in rule:
+            r.until = ics_date(rule["UNTIL"])
+        if "COUNT" in rule:
+            r.until = r.nthStart(max(0, int(rule["COUNT"]) - 1))
+
+    return r
+
+def read_ics(handle, skipped=None):
+    # Events that cannot be imported are left out, with skipped they are
+    # collected as pairs of summary and reason.
+    for event in read_ics_events(handle):
+        try:
+            r = range_from_ics_event(event)
+        except ValueError as err:
+            if skipped is not None:
+                title = next((ics_unescape(value).strip() for name, params, value in event if name == "SUMMARY"), "")
+                skipped.append((title, str(err)))
+            continue
+        if r is not None:
+            yield r
+
+def write_ics(model, handle):
+    # Streams the events, years not loaded are read one at a time and
+    # stay unloaded.
+    events = ((r, "%d@kalender" % (r.index, )) for r in model.allRanges() if not r.deleted)
+    write_ics_events(events, handle)
+
+def write_ics_events(events, handle):
+    # Pairs of range and UID as one VCALENDAR.
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+
+    def write(line):
+        for part in ics_fold(line):
+            handle.write(part)
+            handle.write("\r\n")
+
+    write("BEGIN:VCALENDAR")
+    write("VERSION:2.0")
+    write("PRODID:-//Kalender//Kalender//DE")
+
+    for r, uid in events:
+        write("BEGIN:VEVENT")
+        write("UID:%s" % (uid, ))
+        write("DTSTAMP:%s" % (stamp, ))
+        write("DTSTART;VALUE=DATE:%s" % (format_ics_date(r.start), ))
+        write("DTEND;VALUE=DATE:%s" % (format_ics_date(r.end + 1), ))
+        if r.title:
+            write("SUMMARY:%s" % (ics_escape(r.title), ))
+        if r.notes:
+            write("DESCRIPTION:%s" % (ics_escape(r.notes), ))
+        write("X-KALENDER-COLOR:%s" % (format_color(r.color), ))
+        if r.tags:
+            write("CATEGORIES:%s" % (",".join(ics_escape(name) for name in tag_names(r.tags)), ))
+
+        if r.isRecurring():
+            freq = dict((repeat, name) for name, repeat in ICS_FREQUENCIES.items())[r.repeat]
+            rule = "FREQ=%s;INTERVAL=%d" % (freq, r.interval)
+            if ics_clamped(r.repeat, r.start):
+                if r.repeat == REPEAT_YEARLY:
+                    rule += ";BYMONTH=2"
+                rule += ";BYMONTHDAY=%s;BYSETPOS=-1" % (ics_clamped_days(r.start), )
+            if r.until is not None:
+                rule += ";UNTIL=%s" % (format_ics_date(r.until), )
+            write("RRULE:%s" % (rule, ))
+            if r.exceptions:
+                write("EXDATE;VALUE=DATE:%s" % (",".join(format_ics_date(d) for d in r.exceptions), ))
+
+        write("END:VEVENT")
+
+    write("END:VCALENDAR")
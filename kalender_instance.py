@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Single instance: a further launch hands its file and date to the running
+# instance over a local socket and exits. Only QtCore and QtNetwork are
+# needed for that, so it happens before the expensive imports.
+
+import getpass
+import json
+import os
+import re
+import sys
+
+from PySide2.QtCore import QObject, QByteArray, Signal
+from PySide2.QtNetwork import QLocalServer, QLocalSocket
+
+
+CONNECT_TIMEOUT = 200
+REPLY_TIMEOUT = 5000
+
+
+def instance_name():
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = ""
+    return "kalender-%s" % (re.sub(r"[^A-Za-z0-9_.-]", "_", user), )
+
+def instance_request(argv):
+    # Request of a plain launch, None for the command line tools and for
+    # launches that ask for a new instance.
+    request = {"path": None, "date": None, "background": False}
+
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--date":
+            request["date"] = next(args, None)
+        elif arg.startswith("--date="):
+            request["date"] = arg.split("=", 1)[1]
+        elif arg == "--background":
+            request["background"] = True
+        elif arg.startswith("-") or request["path"] is not None:
+            return None
+        else:
+            request["path"] = os.path.abspath(arg)
+
+    return request
+
+def send_request(request):
+    socket = QLocalSocket()
+    socket.connectToServer(instance_name())
+    if not socket.waitForConnected(CONNECT_TIMEOUT):
+        return False
+
+    # A connected instance is alive, it may just be busy for a moment.
+    socket.write(QByteArray((json.dumps(request) + "\n").encode("utf-8")))
+    if not socket.waitForBytesWritten(REPLY_TIMEOUT) or not socket.waitForReadyRead(REPLY_TIMEOUT):
+        return False
+
+    reply = bytes(socket.readAll())
+    socket.disconnectFromServer()
+    return reply.startswith(b"ok")
+
+def handoff(argv):
+    # Exits if a running instance took over.
+    request = instance_request(argv)
+    if request is not None and send_request(request):
+        sys.exit(0)
+
+
+class InstanceServer(QObject):
+    requested = Signal(object)
+
+    def __init__(self, parent=None):
+        super(InstanceServer, self).__init__(parent)
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.onNewConnection)
+        self.sockets = {}
+
+    def listen(self):
+        if self.server.listen(instance_name()):
+            return True
+
+        # Left behind by an instance that crashed, a live one would have
+        # answered the handoff.
+        QLocalServer.removeServer(instance_name())
+        return self.server.listen(instance_name())
+
+    def close(self):
+        self.server.close()
+
+    def onNewConnection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.sockets[id(socket)] = (socket, [b""])
+            socket.readyRead.connect(lambda socket=socket: self.onReadyRead(socket))
+            socket.disconnected.connect(lambda socket=socket: self.onDisconnected(socket))
+
+    def onReadyRead(self, socket):
+        buffer = self.sockets[id(socket)][1]
+        buffer[0] += bytes(socket.readAll())
+        if b"\n" not in buffer[0]:
+            return
+
+        line, buffer[0] = buffer[0].split(b"\n", 1)
+
+        # Acknowledge first, so that the other process can exit while the
+        # request is handled.
+        socket.write(QByteArray(b"ok\n"))
+        socket.flush()
+
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            return
+        if isinstance(request, dict):
+            self.requested.emit(request)
+
+    def onDisconnected(self, socket):
+        self.sockets.pop(id(socket), None)
+        socket.deleteLater()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Headless, read-only JSON query service for calendar files.
+
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from kalender_core import *
+
+
+class NotFound(Exception):
+    pass
+
+
+class CalendarIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.version = 0
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        model = Model.load(self.path)
+        model.loadAll()
+
+        # Bucket ranges by the months they touch.
+        months = collections.defaultdict(list)
+        recurring = []
+        for key in sorted(model.ranges):
+            r = model.ranges[key]
+            if r.isRecurring():
+                recurring.append(r)
+                continue
+
+            fromMonth, _ = month_and_day(r.start)
+            toMonth, _ = month_and_day(r.end)
+            for month in range(fromMonth, toMonth + 1):
+                months[month].append(r)
+
+        with self.lock:
+            self.model = model
+            self.months = months
+            self.recurring = recurring
+            self.mtime = mtime
+            self.version += 1
+
+    def isStale(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def query(self, first, last, tags=None):
+        with self.lock:
+            months, recurring = self.months, self.recurring
+
+        fromMonth, _ = month_and_day(first)
+        toMonth, _ = month_and_day(last)
+
+        candidates = {}
+        for month in range(fromMonth, toMonth + 1):
+            for r in months.get(month, ()):
+                candidates[r.index] = r
+        for r in recurring:
+            candidates[r.index] = r
+
+        result = []
+        for key in sorted(candidates):
+            r = candidates[key]
+            if tags is not None and not r.tags & tags:
+                continue
+            for start, end in r.occurrences(first, last):
+                result.append({
+                    "id": r.index,
+                    "title": r.title,
+                    "notes": r.notes,
+                    "start": format_date(start),
+                    "end": format_date(end),
+                    "color": format_color(r.color),
+                    "tags": tag_names(r.tags),
+                })
+        return result
+
+
+class QueryService(object):
+    def __init__(self, paths, cacheSize=1024, pollInterval=1.0):
+        self.indexes = collections.OrderedDict()
+        for path in paths:
+            index = CalendarIndex(path)
+            self.indexes[index.name] = index
+
+        # Responses computed while a reload swapped an index are not
+        # cached, the generation counts the reloads.
+        self.cacheLock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.generation = 0
+
+        self.pollInterval = pollInterval
+        self.watcher = threading.Thread(target=self.watch)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.pollInterval)
+            self.poll()
+
+    def poll(self):
+        for index in list(self.indexes.values()):
+            if index.isStale():
+                try:
+                    index.reload()
+                except Exception as err:
+                    print(err)
+                    continue
+
+                with self.cacheLock:
+                    self.cache.clear()
+                    self.generation += 1
+
+    def respond(self, path, params):
+        key = (path, tuple(sorted(params.items())))
+
+        with self.cacheLock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            generation = self.generation
+
+        try:
+            status, document = 200, self.query(path, params)
+        except NotFound as err:
+            status, document = 404, {"error": str(err)}
+        except (KeyError, ValueError) as err:
+            status, document = 400, {"error": str(err)}
+
+        response = status, json.dumps(document, ensure_ascii=False).encode("utf-8")
+
+        if status == 200:
+            with self.cacheLock:
+                if generation != self.generation:
+                    return response
+                self.cache[key] = response
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+
+        return response
+
+    def parseDate(self, params, name):
+        try:
+            return parse_date(params[name])
+        except ValueError:
+            raise ValueError("invalid date: %s" % (params[name], ))
+
+    def query(self, path, params):
+        if path == "/ranges":
+            if "file" in params:
+                if params["file"] not in self.indexes:
+                    raise NotFound("unknown file: %s" % (params["file"], ))
+                index = self.indexes[params["file"]]
+            else:
+                index = next(iter(self.indexes.values()))
+
+            first = self.parseDate(params, "from")
+            last = self.parseDate(params, "to") if "to" in params else first
+            tags = None
+            if "tags" in params:
+                # Only look up names, request threads must not intern tags.
+                tags = 0
+                for name in params["tags"].split(","):
+                    if name.strip() in TAG_IDS:
+                        tags |= 1 << TAG_IDS[name.strip()]
+            return {"file": index.name, "ranges": index.query(first, last, tags)}
+        elif path == "/holiday":
+            date = self.parseDate(params, "date")
+            holiday = is_holiday(*month_and_day(date))
+            return {
+                "date": format_date(date),
+                "holiday": holiday,
+                "names": [HOLIDAY_NAMES[flag] for flag in sorted(HOLIDAY_NAMES) if holiday & flag],
+            }
+        elif path == "/vacation":
+            date = self.parseDate(params, "date")
+            return {
+                "date": format_date(date),
+                "vacation": is_vacation(*month_and_day(date)),
+            }
+        elif path == "/files":
+            return {"files": list(self.indexes)}
+        else:
+            raise NotFound("unknown path: %s" % (path, ))
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        status, body = self.server.service.respond(url.path, params)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PoolMixIn(object):
+    # Like socketserver.ThreadingMixIn, but with a bounded pool of workers.
+    workers = 16
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, "pool"):
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class QueryHTTPServer(PoolMixIn, http.server.HTTPServer):
+    pass
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class QueryUnixServer(PoolMixIn, socketserver.UnixStreamServer):
+        pass
+
+def serve(paths, port=None, socketPath=None):
+    if socketPath:
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+        server = QueryUnixServer(socketPath, QueryRequestHandler)
+    else:
+        server = QueryHTTPServer(("127.0.0.1", port), QueryRequestHandler)
+
+    server.service = QueryService(paths)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Working day and booked day statistics on per-year NumPy day arrays.
+
+import datetime
+import functools
+
+import numpy as np
+
+from kalender_core import *
+
+
+def year_span(year):
+    return datetime.date(year, 1, 1).toordinal(), datetime.date(year, 12, 31).toordinal()
+
+@functools.lru_cache(maxsize=64)
+def holiday_mask(year):
+    first, last = year_span(year)
+    days = np.arange(first, last + 1)
+
+    mask = (days - 1) % 7 == 6
+
+    easter = ordinal(*easter_sunday(year))
+    for offset, flag in EASTER_HOLIDAYS:
+        if first <= easter + offset <= last:
+            mask[easter + offset - first] = True
+
+    for month, day, flag in FIXED_HOLIDAYS:
+        mask[datetime.date(year, month, day).toordinal() - first] = True
+
+    mask.setflags(write=False)
+    return mask
+
+@functools.lru_cache(maxsize=64)
+def vacation_mask(year):
+    first, last = year_span(year)
+
+    intervals = np.array(FERIEN_NIEDERSACHSEN_ORDINALS)
+    intervals = intervals[(intervals[:, 0] <= last) & (intervals[:, 1] >= first)]
+
+    diff = np.zeros(last - first + 2, dtype=np.int32)
+    np.add.at(diff, np.clip(intervals[:, 0], first, last + 1) - first, 1)
+    np.add.at(diff, np.clip(intervals[:, 1] + 1, first, last + 1) - first, -1)
+
+    mask = np.cumsum(diff[:-1]) > 0
+    mask.setflags(write=False)
+    return mask
+
+def span_mask(masks, first, last):
+    parts = []
+    for year in range(year_of(first), year_of(last) + 1):
+        yearFirst, yearLast = year_span(year)
+        mask = masks(year)
+        parts.append(mask[max(first, yearFirst) - yearFirst:min(last, yearLast) - yearFirst + 1])
+    return np.concatenate(parts)
+
+def month_starts(year):
+    first, last = year_span(year)
+    return np.array([datetime.date(year, month, 1).toordinal() - first for month in range(1, 13)])
+
+
+class Statistics(object):
+    def __init__(self):
+        self.model = None
+        self.arrays = None
+
+    def setModel(self, model):
+        if self.model:
+            self.model.modelChanged.disconnect(self.invalidate)
+        self.model = model
+        self.model.modelChanged.connect(self.invalidate)
+        self.invalidate()
+
+    def invalidate(self):
+        self.arrays = None
+
+    def rangeArrays(self):
+        # Column arrays of all plain ranges, recurring ones stay objects.
+        if self.arrays is None:
+            starts, ends, codes = [], [], []
+            titles = {}
+            recurring = []
+            for r in self.model.ranges.values():
+                if r.deleted:
+                    continue
+                elif r.isRecurring():
+                    recurring.append(r)
+                else:
+                    starts.append(r.start)
+                    ends.append(r.end)
+                    codes.append(titles.setdefault(r.title, len(titles)))
+
+            for r in recurring:
+                titles.setdefault(r.title, len(titles))
+
+            self.arrays = (
+                np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.array(codes, dtype=np.int64),
+                sorted(titles, key=titles.get),
+                recurring)
+
+        return self.arrays
+
+    def intervals(self, first, last):
+        self.model.ensureDates(first, last)
+        starts, ends, codes, titles, recurring = self.rangeArrays()
+
+        mask = (starts <= last) & (ends >= first)
+        starts, ends, codes = starts[mask], ends[mask], codes[mask]
+
+        if recurring:
+            codeOf = dict((title, code) for code, title in enumerate(titles))
+            extra = [(start, end, codeOf[r.title]) for r in recurring for start, end in r.occurrences(first, last)]
+            if extra:
+                extra = np.array(extra, dtype=np.int64)
+                starts = np.concatenate([starts, extra[:, 0]])
+                ends = np.concatenate([ends, extra[:, 1]])
+                codes = np.concatenate([codes, extra[:, 2]])
+
+        n = last - first + 1
+        return np.clip(starts - first, 0, n), np.clip(ends - first + 1, 0, n), codes
+
+    def coverage(self, first, last):
+        lo, hi, codes = self.intervals(first, last)
+        diff = np.zeros(last - first + 2, dtype=np.int32)
+        np.add.at(diff, lo, 1)
+        np.add.at(diff, hi, -1)
+        return np.cumsum(diff[:-1])
+
+    def workingMask(self, first, last, vacations=True):
+        mask = ~span_mask(holiday_mask, first, last)
+        if vacations:
+            mask &= ~span_mask(vacation_mask, first, last)
+        return mask
+
+    def summary(self, first, last):
+        working = self.workingMask(first, last, vacations=False)
+        booked = self.coverage(first, last) > 0
+        return {
+            "days": last - first + 1,
+            "workingDays": int(working.sum()),
+            "workingDaysOutsideVacations": int((working & ~span_mask(vacation_mask, first, last)).sum()),
+            "bookedDays": int(booked.sum()),
+            "bookedWorkingDays": int((booked & working).sum()),
+        }
+
+    def months(self, year):
+        first, last = year_span(year)
+        starts = month_starts(year)
+
+        working = self.workingMask(first, last, vacations=False)
+        booked = self.coverage(first, last) > 0
+
+        return {
+            "days": np.diff(np.append(starts, last - first + 1)),
+            "workingDays": np.add.reduceat(working.astype(np.int32), starts),
+            "bookedDays": np.add.reduceat(booked.astype(np.int32), starts),
+            "bookedWorkingDays": np.add.reduceat((booked & working).astype(np.int32), starts),
+        }
+
+    def titles(self, year):
+        # Booked days per title, one row of the difference matrix per title.
+        first, last = year_span(year)
+        lo, hi, codes = self.intervals(first, last)
+        titles = self.rangeArrays()[3]
+        if not len(codes):
+            return []
+
+        used, rows = np.unique(codes, return_inverse=True)
+        diff = np.zeros((len(used), last - first + 2), dtype=np.int32)
+        np.add.at(diff, (rows, lo), 1)
+        np.add.at(diff, (rows, hi), -1)
+        booked = (np.cumsum(diff[:, :-1], axis=1) > 0).sum(axis=1)
+
+        return sorted(((titles[code], int(days)) for code, days in zip(used, booked)), key=lambda row: (-row[1], row[0]))
+
+def print_report(model, year, handle):
+    statistics = Statistics()
+    statistics.setModel(model)
+
+    months = statistics.months(year)
+    handle.write("%-12s %6s %12s %8s %16s\n" % ("Monat", "Tage", "Arbeitstage", "Belegt", "Belegt (Arbeit)"))
+    for i in range(12):
+        handle.write("%-12s %6d %12d %8d %16d\n" % (
+            MONTH_NAMES[i], months["days"][i], months["workingDays"][i],
+            months["bookedDays"][i], months["bookedWorkingDays"][i]))
+    handle.write("%-12s %6d %12d %8d %16d\n" % (
+        "Summe", months["days"].sum(), months["workingDays"].sum(),
+        months["bookedDays"].sum(), months["bookedWorkingDays"].sum()))
+
+    handle.write("\n%-40s %8s\n" % ("Titel", "Belegt"))
+    for title, days in statistics.titles(year):
+        handle.write("%-40s %8d\n" % (title or "(ohne Titel)", days))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# Team availability over a directory with one calendar file per person.
+# Files are parsed in worker processes, the busy intervals are kept in a
+# cache next to the files and only files with another mtime are read again.
+
+import collections
+import concurrent.futures
+import json
+import os
+
+import numpy as np
+
+from kalender_core import *
+from kalender_stats import holiday_mask, span_mask
+
+
+TEAM_CACHE_NAME = ".kalender-team.json"
+TEAM_CACHE_VERSION = 1
+
+
+def team_files(directory):
+    return sorted(
+        name for name in os.listdir(directory)
+        if name.lower().endswith(".json") and not name.startswith(".")
+        and os.path.isfile(os.path.join(directory, name)))
+
+def file_key(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def parse_calendar(path):
+    # Runs in a worker process. Plain ranges are merged into sorted busy
+    # intervals, recurring ranges are kept as entries and expanded later.
+    model = Model.load(path)
+    model.loadAll()
+
+    intervals = []
+    recurring = []
+    for r in sorted((r for r in model.ranges.values() if r.start is not None), key=lambda r: (r.start, r.end)):
+        if r.deleted:
+            continue
+        elif r.isRecurring():
+            recurring.append(entry_of_range(r))
+        elif intervals and r.start <= intervals[-1][1] + 1:
+            intervals[-1][1] = max(intervals[-1][1], r.end)
+        else:
+            intervals.append([r.start, r.end])
+
+    return {"intervals": intervals, "recurring": recurring}
+
+def parse_member(path):
+    # Errors are returned, so that one broken file does not end the pool.
+    try:
+        return parse_calendar(path), None
+    except Exception as err:
+        return None, str(err) or err.__class__.__name__
+
+
+class Team(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.members = collections.OrderedDict()
+        self.errors = {}
+        self.parsed = 0
+
+    def cachePath(self):
+        return os.path.join(self.directory, TEAM_CACHE_NAME)
+
+    def loadCache(self):
+        try:
+            with open(self.cachePath(), "r") as handle:
+                document = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return {}
+        if document.get("version") != TEAM_CACHE_VERSION:
+            return {}
+        return document.get("files", {})
+
+    def saveCache(self, files):
+        # A directory without write access is scanned without a cache.
+        try:
+            with open(self.cachePath(), "w") as handle:
+                json.dump({"version": TEAM_CACHE_VERSION, "files": files}, handle)
+        except (IOError, OSError):
+            pass
+
+    def load(self, workers=None):
+        cached = self.loadCache()
+        files = {}
+        stale = []
+
+        for name in team_files(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                key = file_key(path)
+            except OSError as err:
+                self.errors[name] = str(err)
+                continue
+            entry = cached.get(name)
+            if entry is not None and entry["key"] == key:
+                files[name] = entry
+            else:
+                stale.append((name, key))
+
+        # A single changed file is not worth starting the pool.
+        paths = [os.path.join(self.directory, name) for name, key in stale]
+        if len(stale) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(parse_member, paths))
+        else:
+            results = [parse_member(path) for path in paths]
+
+        for (name, key), (entry, error) in zip(stale, results):
+            if error is not None:
+                self.errors[name] = error
+                continue
+            entry["key"] = key
+            files[name] = entry
+            self.parsed += 1
+
+        if self.parsed or set(files) != set(cached):
+            self.saveCache(files)
+
+        self.members = collections.OrderedDict(
+            (os.path.splitext(name)[0], files[name]) for name in sorted(files))
+        return self
+
+    def busy(self, first, last):
+        # Boolean matrix with one row per member and one column per day,
+        # from a difference array over all intervals at once.
+        rows, starts, ends = [], [], []
+        for row, member in enumerate(self.members.values()):
+            intervals = [(start, end) for start, end in member["intervals"] if start <= last and end >= first]
+            for entry in member["recurring"]:
+                intervals.extend(range_of_entry(entry).occurrences(first, last))
+            rows.extend([row] * len(intervals))
+            starts.extend(start for start, end in intervals)
+            ends.extend(end for start, end in intervals)
+
+        n = last - first + 1
+        rows = np.array(rows, dtype=np.int64)
+        lo = np.clip(np.array(starts, dtype=np.int64) - first, 0, n)
+        hi = np.clip(np.array(ends, dtype=np.int64) - first + 1, 0, n)
+
+        diff = np.zeros((len(self.members), n + 1), dtype=np.int32)
+        np.add.at(diff, (rows, lo), 1)
+        np.add.at(diff, (rows, hi), -1)
+        return np.cumsum(diff[:, :-1], axis=1) > 0
+
+    def availability(self, first, last):
+        # Number of members without an entry, per day.
+        return len(self.members) - self.busy(first, last).sum(axis=0)
+
+
+def print_availability(team, first, last, handle):
+    busy = team.busy(first, last)
+    free = len(team.members) - busy.sum(axis=0)
+    holidays = span_mask(holiday_mask, first, last)
+    names = list(team.members)
+
+    for i, name in enumerate(names):
+        handle.write("%3d %s\n" % (i + 1, name))
+    for name in sorted(team.errors):
+        handle.write("  - %s: %s\n" % (name, team.errors[name]))
+
+    handle.write("\n%-10s %-2s %s %5s\n" % ("Datum", "", "".join(str((i + 1) % 10) for i in range(len(names))), "Frei"))
+    for day in range(last - first + 1):
+        date = first + day
+        handle.write("%s %-2s %s %2d/%d%s\n" % (
+            format_date(date), WEEKDAY_NAMES[day_of_week(date)][:2],
+            "".join("#" if cell else "." for cell in busy[:, day]),
+            free[day], len(names), " *" if holidays[day] else ""))
@@ -0,0 +1,953 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import json
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import kalender_caldav
+import kalender_core
+import kalender_service
+from kalender_core import *
+
+try:
+    import kalender_stats
+    import kalender_team
+except ImportError:
+    kalender_stats = kalender_team = None
+
+try:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import kalender
+except ImportError:
+    kalender = None
+
+
+def plain(title, start, end=None):
+    r = Range()
+    r.title = title
+    r.color = ACCENT_COLORS[0]
+    r.start = parse_date(start)
+    r.end = parse_date(end or start)
+    return r
+
+def weekly(title, start, interval=1):
+    r = plain(title, start)
+    r.repeat = REPEAT_WEEKLY
+    r.interval = interval
+    return r
+
+
+class OccurrencesTest(unittest.TestCase):
+
+    def test_cache_follows_rule_changes(self):
+        r = weekly("Kurs", "2025-01-06")
+        first, last = parse_date("2025-01-01"), parse_date("2026-12-31")
+        self.assertIs(r.occurrencesOfYear(2025), r.occurrencesOfYear(2025))
+
+        def change(**values):
+            for name, value in values.items():
+                setattr(r, name, value)
+            self.assertEqual(r.occurrences(first, last), r.copy().occurrences(first, last))
+
+        change(interval=2)
+        change(start=parse_date("2025-01-07"), end=parse_date("2025-01-08"))
+        change(until=parse_date("2025-06-30"))
+        r.exceptions.append(parse_date("2025-01-21"))
+        change()
+        change(repeat=REPEAT_MONTHLY, until=None)
+        self.assertEqual(len(r.occurrencesOfYear(2026)), 6)
+
+
+class ConflictsTest(unittest.TestCase):
+
+    def test_recurring_meets_later_plain(self):
+        model = Model()
+        model.commitMany([weekly("Raum A", "2020-01-06")])
+
+        conflicts = Conflicts()
+        conflicts.reset(model.ranges.values())
+        model.rangesChanged.connect(conflicts.apply)
+
+        monday = plain("Raum A", "2025-03-03")
+        self.assertEqual(conflicts.conflictsWith(monday), [1])
+
+        model.commit(monday)
+        self.assertEqual(conflicts.conflicting, {1: {2}, 2: {1}})
+
+        full = Conflicts()
+        full.reset(model.ranges.values())
+        self.assertEqual(full.conflicting, conflicts.conflicting)
+
+    def test_recurring_added_after_plain(self):
+        model = Model()
+        model.commitMany([plain("Raum A", "2025-03-03"), plain("Raum A", "2025-03-04")])
+
+        conflicts = Conflicts()
+        conflicts.reset(model.ranges.values())
+        model.rangesChanged.connect(conflicts.apply)
+
+        model.commit(weekly("Raum A", "2020-01-06"))
+        self.assertEqual(conflicts.conflicting, {1: {3}, 3: {1}})
+
+    def test_incremental_matches_reset(self):
+        rng = random.Random(31)
+        model = Model()
+        conflicts = Conflicts()
+        conflicts.reset(model.ranges.values())
+        model.rangesChanged.connect(conflicts.apply)
+
+        base = parse_date("2020-01-01")
+        for step in range(300):
+            r = Range()
+            r.title = rng.choice(["a", "b"])
+            r.color = ACCENT_COLORS[0]
+            r.start = base + rng.randint(0, 2000)
+            r.end = r.start + rng.randint(0, 3)
+            if rng.random() < 0.1:
+                r.repeat = REPEAT_WEEKLY
+                r.interval = rng.randint(1, 3)
+            if model.ranges and rng.random() < 0.3:
+                r.index = rng.choice(list(model.ranges))
+                r.deleted = rng.random() < 0.5
+            model.commit(r)
+
+        full = Conflicts()
+        full.reset(model.ranges.values())
+        self.assertEqual(conflicts.conflicting, full.conflicting)
+
+        # Against the occurrences of every pair within the span.
+        live = [r for r in model.ranges.values() if not r.deleted]
+        expected = {}
+        for a in live:
+            for b in live:
+                if a.index < b.index and a.title == b.title:
+                    first = max(a.start, b.start)
+                    last = base + 2010 + CONFLICTS_RECURRING_HORIZON
+                    if any(b.occurrences(start, end) for start, end in a.occurrences(first, last)):
+                        expected.setdefault(a.index, set()).add(b.index)
+                        expected.setdefault(b.index, set()).add(a.index)
+        self.assertEqual(full.conflicting, expected)
+
+
+class OccupancyTest(unittest.TestCase):
+
+    def test_incremental_matches_reset(self):
+        rng = random.Random(30)
+        model = Model()
+        accept = lambda r: r.title == "a"
+        occupancy = Occupancy(accept)
+        occupancy.reset(model.ranges.values())
+        model.rangesChanged.connect(occupancy.apply)
+
+        base = parse_date("2024-11-01")
+        years = [2024, 2025, 2026]
+        for step in range(300):
+            if model.undoStack and rng.random() < 0.1:
+                model.undo()
+            elif model.redoStack and rng.random() < 0.1:
+                model.redo()
+            else:
+                r = Range()
+                r.title = rng.choice(["a", "b"])
+                r.start = base + rng.randint(0, 600)
+                r.end = r.start + rng.randint(0, 60)
+                if rng.random() < 0.1:
+                    r.repeat = REPEAT_WEEKLY
+                    r.interval = rng.randint(1, 3)
+                if model.ranges and rng.random() < 0.3:
+                    r.index = rng.choice(list(model.ranges))
+                    r.deleted = rng.random() < 0.5
+                model.commit(r)
+            # Cached years have to follow the later changes.
+            occupancy.countsOfYear(rng.choice(years))
+
+        full = Occupancy(accept)
+        full.reset(model.ranges.values())
+        live = [r for r in model.ranges.values() if not r.deleted and accept(r)]
+        for year in years:
+            first = datetime.date(year, 1, 1).toordinal()
+            counts = occupancy.countsOfYear(year)
+            self.assertEqual(counts, full.countsOfYear(year))
+            for date in range(first, first + len(counts), 17):
+                self.assertEqual(counts[date - first], sum(len(r.occurrences(date, date)) for r in live))
+
+
+class TagsTest(unittest.TestCase):
+
+    def test_pickled_range_keeps_tag_names(self):
+        r = plain("Kurs", "2025-03-03")
+        r.tags = tag_mask(["Schule", "Sport"])
+        data = pickle.dumps(r)
+
+        # Another process interned other tags first.
+        with mock.patch.object(kalender_core, "TAG_NAMES", ["Andere"]), \
+                mock.patch.object(kalender_core, "TAG_IDS", {"Andere": 0}):
+            copy = pickle.loads(data)
+            self.assertEqual(kalender_core.tag_names(copy.tags), ["Schule", "Sport"])
+
+    def test_tag_ids_from_threads(self):
+        names = ["Thread %d" % i for i in range(200)]
+        ids = []
+        def intern():
+            ids.append([tag_id(name) for name in names])
+        threads = [threading.Thread(target=intern) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(result == ids[0] for result in ids))
+        self.assertEqual([kalender_core.TAG_NAMES[i] for i in ids[0]], names)
+
+
+@unittest.skipIf(kalender_stats is None, "NumPy is not installed")
+class StatisticsTest(unittest.TestCase):
+
+    def expected(self, model, year):
+        # Day by day over the occurrences of every range.
+        live = [r for r in model.ranges.values() if not r.deleted]
+        months = dict((name, [0] * 12) for name in ("days", "workingDays", "bookedDays", "bookedWorkingDays"))
+        titles = {}
+        for month in range((year - 1900) * 12, (year - 1900) * 12 + 12):
+            holidays = holidays_of_month(month)
+            for day in range(1, days_of_month(month) + 1):
+                date = ordinal(month, day)
+                booked = set(r.title for r in live if r.occurrences(date, date))
+                working = not holidays[day - 1]
+                months["days"][month % 12] += 1
+                months["workingDays"][month % 12] += working
+                months["bookedDays"][month % 12] += bool(booked)
+                months["bookedWorkingDays"][month % 12] += bool(booked) and working
+                for title in booked:
+                    titles[title] = titles.get(title, 0) + 1
+        return months, sorted(titles.items(), key=lambda row: (-row[1], row[0]))
+
+    def check(self, statistics, model, year):
+        months, titles = self.expected(model, year)
+        self.assertEqual(dict((name, list(values)) for name, values in statistics.months(year).items()), months)
+        self.assertEqual(statistics.titles(year), titles)
+
+    def test_months_and_titles(self):
+        model = Model()
+        chor = weekly("Chor", "2021-11-29")
+        model.commitMany([
+            plain("Kurs", "2021-04-01", "2021-04-06"),
+            plain("Urlaub", "2021-04-05", "2021-04-12"),
+            plain("Kurs", "2021-04-06", "2021-04-08"),
+            chor,
+            plain("Kurs", "2021-12-30", "2022-01-03"),
+            plain("Weg", "2021-05-03"),
+        ])
+        r = model.ranges[6].copy()
+        r.deleted = True
+        model.commit(r)
+
+        statistics = kalender_stats.Statistics()
+        statistics.setModel(model)
+        for year in (2021, 2022):
+            self.check(statistics, model, year)
+        self.assertEqual(statistics.titles(2020), [])
+
+        # The arrays are rebuilt after a change.
+        r = model.ranges[4].copy()
+        r.interval = 2
+        model.commit(r)
+        self.check(statistics, model, 2022)
+
+
+ICS_EVENTS = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+SUMMARY:Kurs
+DTSTART;VALUE=DATE:20250303
+RRULE:FREQ=WEEKLY;BYDAY=MO;COUNT=3
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Training
+DTSTART;VALUE=DATE:20250303
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Tabletten
+DTSTART;VALUE=DATE:20250303
+RRULE:FREQ=DAILY;COUNT=10
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Urlaub
+DTSTART;VALUE=DATE:20250704
+DTEND;VALUE=DATE:20250711
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_unsupported_rules_are_reported(self):
+        skipped = []
+        ranges = list(read_ics(io.StringIO(ICS_EVENTS), skipped))
+
+        self.assertEqual([r.title for r in ranges], ["Kurs", "Urlaub"])
+        self.assertEqual(ranges[0].repeat, REPEAT_WEEKLY)
+        self.assertEqual(ranges[0].until, parse_date("2025-03-17"))
+        self.assertEqual([title for title, reason in skipped], ["Training", "Tabletten"])
+
+    def test_export_keeps_years_unloaded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "export.json")
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-01"), weekly("Chor", "2024-01-08"), plain("Urlaub", "2011-07-01")])
+        model.save(path)
+
+        model = Model.load(path)
+        handle = io.StringIO()
+        write_ics(model, handle)
+        self.assertEqual(sorted(r.title for r in read_ics(io.StringIO(handle.getvalue()))), ["Chor", "Kurs", "Urlaub"])
+        self.assertNotIn(2010, model.loadedSegments)
+        self.assertNotIn(1, model.ranges)
+
+    def test_days_missing_in_some_months(self):
+        def event(start, rule):
+            return "BEGIN:VCALENDAR\nBEGIN:VEVENT\nSUMMARY:Miete\nDTSTART;VALUE=DATE:%s\nRRULE:%s\nEND:VEVENT\nEND:VCALENDAR\n" % (start, rule)
+
+        for start, rule in [("20230131", "FREQ=MONTHLY;BYMONTHDAY=31"), ("20230131", "FREQ=MONTHLY"), ("20240229", "FREQ=YEARLY")]:
+            skipped = []
+            self.assertEqual(list(read_ics(io.StringIO(event(start, rule)), skipped)), [])
+            self.assertEqual(len(skipped), 1)
+
+        # The export names the last day of shorter months and imports again.
+        for r in [plain("Miete", "2023-01-31"), plain("Geburtstag", "2024-02-29"), plain("Abo", "2023-01-15")]:
+            r.repeat = REPEAT_YEARLY if r.title == "Geburtstag" else REPEAT_MONTHLY
+            handle = io.StringIO()
+            write_ics_events([(r, "1@test")], handle)
+            skipped = []
+            imported = list(read_ics(io.StringIO(handle.getvalue()), skipped))
+            self.assertEqual(skipped, [])
+            first, last = parse_date("2023-01-01"), parse_date("2028-12-31")
+            self.assertEqual(imported[0].occurrences(first, last), r.occurrences(first, last))
+
+    def test_batches_are_one_undo_step(self):
+        model = Model()
+        model.commit(plain("Vorher", "2025-01-01"))
+        notified = []
+        model.rangesChanged.connect(notified.append)
+
+        ranges = (plain("Termin %d" % i, "2025-02-01") for i in range(5))
+        self.assertEqual(model.commitBatches(ranges, size=2), 5)
+        self.assertEqual([len(changes) for changes in notified], [2, 2, 1])
+        self.assertEqual(len(model.undoStack), 2)
+
+        model.undo()
+        self.assertEqual([r.title for r in model.ranges.values() if not r.deleted], ["Vorher"])
+
+
+class CopyYearTest(unittest.TestCase):
+
+    def copies(self, ranges, source, target, mode=COPY_SAME_DATE):
+        for i, r in enumerate(ranges):
+            r.index = i + 1
+        monthIndex = MonthIndex()
+        monthIndex.reset(ranges)
+        return [format_date(r.start) for r in copy_year(monthIndex, source, target, mode)]
+
+    def test_holidays_at_the_end_of_the_year(self):
+        # 2023-12-31 is a Sunday and 2024-01-01 a holiday.
+        self.assertEqual(self.copies([plain("Silvester", "2022-12-31")], 2022, 2023), ["2023-12-30"])
+
+    def test_weekday_copies_keep_sundays(self):
+        ranges = [plain("Wanderung", "2022-03-06"), plain("Ostern", "2022-04-17")]
+        self.assertEqual(self.copies(ranges, 2022, 2023, COPY_SAME_WEEKDAY), ["2023-03-05", "2023-04-16"])
+        self.assertEqual(self.copies(ranges, 2022, 2023), ["2023-03-06", "2023-04-17"])
+
+        # Real holidays still move, Good Friday 2023 is on 2023-04-07.
+        self.assertEqual(self.copies([plain("Kurs", "2022-04-08")], 2022, 2023, COPY_SAME_WEEKDAY), ["2023-04-08"])
+
+
+class FreeSlotTest(unittest.TestCase):
+
+    def slot(self, ranges, length, earliest, **kwargs):
+        for i, r in enumerate(ranges):
+            r.index = i + 1
+        monthIndex = MonthIndex()
+        monthIndex.reset(ranges)
+        slot = free_slot(monthIndex, length, parse_date(earliest), **kwargs)
+        return slot and (format_date(slot[0]), format_date(slot[1]))
+
+    def test_gaps_between_busy_ranges(self):
+        ranges = [plain("Kurs", "2021-06-01", "2021-06-04"), plain("Kurs", "2021-06-09", "2021-06-10")]
+        self.assertEqual(self.slot(ranges, 3, "2021-06-01"), ("2021-06-05", "2021-06-08"))
+        # The first gap has only three working days.
+        self.assertEqual(self.slot(ranges, 4, "2021-06-01"), ("2021-06-11", "2021-06-15"))
+        # Only ranges with the given title are busy.
+        self.assertEqual(self.slot(ranges, 4, "2021-06-01", title="urlaub"), ("2021-06-01", "2021-06-04"))
+
+    def test_sundays_and_holidays_are_skipped(self):
+        # Good Friday, Easter Sunday and Easter Monday 2021.
+        self.assertEqual(self.slot([], 3, "2021-04-01"), ("2021-04-01", "2021-04-06"))
+        self.assertEqual(self.slot([], 1, "2021-04-04"), ("2021-04-06", "2021-04-06"))
+        self.assertEqual(self.slot([weekly("Kurs", "2021-03-02")], 5, "2021-03-03"), ("2021-03-03", "2021-03-08"))
+
+    def test_vacations(self):
+        self.assertEqual(self.slot([], 5, "2021-03-25"), ("2021-03-25", "2021-03-30"))
+        # Osterferien 2021-03-29 to 2021-04-09.
+        self.assertEqual(self.slot([], 5, "2021-03-25", vacations=True), ("2021-04-10", "2021-04-15"))
+
+    def test_horizon(self):
+        self.assertIsNone(self.slot([], 10, "2021-06-01", horizon=5))
+        # A weekly range leaves five working days between its occurrences.
+        self.assertIsNone(self.slot([weekly("Kurs", "2021-03-02")], 6, "2021-03-03", horizon=60))
+        self.assertIsNone(self.slot([plain("Kurs", "2021-06-03", "2021-08-31")], 3, "2021-06-01", horizon=60))
+        self.assertEqual(self.slot([plain("Kurs", "2021-06-03", "2021-08-31")], 3, "2021-06-01"), ("2021-09-01", "2021-09-03"))
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_versions_across_snapshots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        history = History(os.path.join(directory, "kalender.history"))
+
+        # Version k renames the first range and adds a range on day k, the
+        # second range is gone from version 20 on.
+        first = parse_date("2025-01-01")
+        documents = []
+        document = {}
+        for k in range(HISTORY_SNAPSHOT_INTERVAL + 8):
+            document = dict(document)
+            document["1"] = entry_of_range(plain("Version %d" % (k, ), "2025-06-01"))
+            document[str(k + 2)] = entry_of_range(plain("Tag %d" % (k, ), format_date(first + k)))
+            if k == 20:
+                del document["2"]
+            documents.append(document)
+            history.append(document, format_date(first + k) + "T12:00:00")
+
+        history = History(history.path)
+        self.assertEqual([depth for time, depth, offset in history.versions()],
+            list(range(HISTORY_SNAPSHOT_INTERVAL)) + list(range(8)))
+
+        self.assertIsNone(history.documentAt(first - 1))
+        for k in (0, 19, 20, HISTORY_SNAPSHOT_INTERVAL - 1, HISTORY_SNAPSHOT_INTERVAL, HISTORY_SNAPSHOT_INTERVAL + 7):
+            self.assertEqual(history.documentAt(first + k), documents[k])
+        self.assertEqual(history.documentAt(first + 100), documents[-1])
+
+        model = history.modelAt(first + HISTORY_SNAPSHOT_INTERVAL + 3)
+        self.assertEqual(model.ranges[1].title, "Version %d" % (HISTORY_SNAPSHOT_INTERVAL + 3, ))
+        self.assertNotIn(2, model.ranges)
+        self.assertEqual(len(model.ranges), HISTORY_SNAPSHOT_INTERVAL + 4)
+
+
+class EvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "evict.json")
+
+        model = Model()
+        a, b = plain("Kurs", "2010-03-01", "2010-03-05"), plain("Kurs", "2010-03-04")
+        a.tags = tag_mask(["Schule"])
+        model.commitMany([a, b, plain("Urlaub", "2011-07-01")])
+        model.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_indexes_over_all_years_ignore_eviction(self):
+        model = Model.load(self.path)
+        self.assertEqual(model.loadedSegments.get(2010), None)
+        self.assertEqual(sorted(r.index for r in model.allRanges()), [1, 2, 3])
+
+        # The indexes are built from the summaries in the main file.
+        conflicts, tagCounts, monthIndex = Conflicts(), TagCounts(), MonthIndex()
+        with mock.patch.object(model, "readSegment", side_effect=AssertionError):
+            ranges = list(model.summaryRanges())
+        conflicts.reset(ranges)
+        tagCounts.reset(ranges)
+        monthIndex.reset(model.ranges.values())
+        for index in (conflicts, tagCounts, monthIndex):
+            model.rangesChanged.connect(index.apply)
+        model.residentChanged.connect(monthIndex.apply)
+        self.assertEqual(conflicts.conflicting, {1: {2}, 2: {1}})
+        self.assertEqual(tagCounts.count("Schule"), 1)
+
+        with mock.patch.object(kalender_core, "SEGMENT_RANGE_BUDGET", 0):
+            model.ensureDates(parse_date("2010-01-01"), parse_date("2011-12-31"))
+            self.assertEqual(len(monthIndex.rangesOfMonth(month_index(2010, 3))), 2)
+            model.evict()
+            self.assertNotIn(2010, model.loadedSegments)
+
+        # Only the view of the loaded years changes.
+        self.assertEqual(monthIndex.rangesOfMonth(month_index(2010, 3)), [])
+        self.assertEqual(conflicts.conflicting, {1: {2}, 2: {1}})
+        self.assertEqual(tagCounts.count("Schule"), 1)
+
+        # Edits of an evicted year are applied to the indexes as usual.
+        model.commit(plain("Kurs", "2010-03-02"))
+        self.assertEqual(conflicts.conflicting, {1: {2, 4}, 2: {1}, 4: {1}})
+        deleted = model.ranges[1].copy()
+        deleted.deleted = True
+        model.commit(deleted)
+        self.assertEqual(conflicts.conflicting, {})
+        self.assertEqual(tagCounts.count("Schule"), 0)
+
+    def test_summaries_of_older_files(self):
+        with open(self.path) as handle:
+            index = json.load(handle)
+        for segment in index["segments"].values():
+            del segment["summary"]
+        with open(self.path, "w") as handle:
+            json.dump(index, handle)
+
+        model = Model.load(self.path)
+        self.assertEqual(sorted((r.index, r.title) for r in model.summaryRanges()), [(1, "Kurs"), (2, "Kurs"), (3, "Urlaub")])
+        self.assertEqual(model.loadedSegments.get(2010), None)
+
+        # The next save writes them.
+        model.commit(plain("Neu", "2012-01-01"))
+        model.save(self.path)
+        model = Model.load(self.path)
+        with mock.patch.object(model, "readSegment", side_effect=AssertionError):
+            self.assertEqual(len(list(model.summaryRanges())), 4)
+            self.assertEqual([r.title for r in model.rangesBetween(parse_date("2011-01-01"), parse_date("2011-12-31"))], ["Urlaub"])
+
+    def test_peek_does_not_load(self):
+        model = Model.load(self.path)
+        ranges = model.peek([1, 3])
+        self.assertEqual((ranges[1].title, ranges[3].title), ("Kurs", "Urlaub"))
+        self.assertNotIn(2010, model.loadedSegments)
+        self.assertNotIn(1, model.ranges)
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = kalender_caldav.StandInServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.collection = self.server.collection
+        self.engine = kalender_caldav.SyncEngine(self.server.url())
+        self.client = self.engine.client
+        self.state = kalender_caldav.SyncState()
+        self.state.url = self.server.url()
+
+    def tearDown(self):
+        self.engine.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sync(self, model, prefer=kalender_caldav.PREFER_REMOTE):
+        result = kalender_caldav.sync(self.client, self.state, model.document(), prefer)
+        kalender_caldav.apply_sync_result(model, self.state, result)
+        self.assertEqual(result.errors, [])
+        return result
+
+    def remote(self, path, title, start):
+        with self.collection.lock:
+            uid = os.path.basename(path)[:-len(".ics")]
+            self.collection.change(path, kalender_caldav.calendar_data_of_range(plain(title, start), uid))
+
+    def pathOf(self, index):
+        return self.state.items[str(index)]["path"]
+
+    def titles(self, model):
+        return sorted(r.title for r in model.ranges.values() if not r.deleted)
+
+    def remoteTitles(self):
+        return sorted(kalender_caldav.range_of_calendar_data(text)[1].title for etag, text in self.collection.items.values())
+
+    def synced(self):
+        model = Model()
+        model.commitMany([plain("Kurs", "2025-03-03"), plain("Urlaub", "2025-07-01")])
+        self.remote(self.collection.path + "fremd.ics", "Messe", "2025-05-05")
+        self.sync(model)
+        self.sync(model)
+        return model
+
+    def test_first_sync(self):
+        model = Model()
+        model.commitMany([plain("Kurs", "2025-03-03"), plain("Urlaub", "2025-07-01")])
+        self.remote(self.collection.path + "fremd.ics", "Messe", "2025-05-05")
+
+        result = self.sync(model)
+        self.assertEqual(result.pushed, 2)
+        self.assertEqual(self.titles(model), ["Kurs", "Messe", "Urlaub"])
+        self.assertEqual(self.remoteTitles(), ["Kurs", "Messe", "Urlaub"])
+        self.assertEqual(len(self.state.items), 3)
+
+    def test_unchanged_collection_is_not_listed(self):
+        model = self.synced()
+        for name in ("syncCollection", "etags", "multiget", "put", "delete"):
+            setattr(self.client, name, mock.Mock(wraps=getattr(self.client, name)))
+
+        result = self.sync(model)
+        self.assertEqual((result.pushed, result.updates), (0, []))
+        for name in ("syncCollection", "etags", "put", "delete"):
+            self.assertFalse(getattr(self.client, name).called, name)
+        self.client.multiget.assert_called_once_with({})
+
+    def test_only_changed_etags_are_fetched(self):
+        model = self.synced()
+        path = self.pathOf(1)
+        self.remote(path, "Kurs verlegt", "2025-03-04")
+        self.client.multiget = mock.Mock(wraps=self.client.multiget)
+
+        result = self.sync(model)
+        self.client.multiget.assert_called_once_with({path: self.collection.items[path][0]})
+        self.assertEqual(result.pushed, 0)
+        self.assertEqual((model.ranges[1].title, format_date(model.ranges[1].start)), ("Kurs verlegt", "2025-03-04"))
+
+    def test_remote_deletion(self):
+        model = self.synced()
+        with self.collection.lock:
+            self.collection.change(self.pathOf(2), None)
+
+        self.sync(model)
+        self.assertEqual(self.titles(model), ["Kurs", "Messe"])
+        self.assertNotIn("2", self.state.items)
+
+    def conflict(self, prefer):
+        model = self.synced()
+        self.remote(self.pathOf(1), "Kurs (Server)", "2025-03-03")
+        r = model.ranges[1].copy()
+        r.title = "Kurs (lokal)"
+        model.commit(r)
+
+        result = self.sync(model, prefer)
+        self.assertEqual(result.conflicts, ["1"])
+        self.sync(model, prefer)
+        return model
+
+    def test_conflict_prefer_remote(self):
+        model = self.conflict(kalender_caldav.PREFER_REMOTE)
+        self.assertEqual(model.ranges[1].title, "Kurs (Server)")
+        self.assertEqual(self.remoteTitles(), ["Kurs (Server)", "Messe", "Urlaub"])
+
+    def test_conflict_prefer_local(self):
+        model = self.conflict(kalender_caldav.PREFER_LOCAL)
+        self.assertEqual(model.ranges[1].title, "Kurs (lokal)")
+        self.assertEqual(self.remoteTitles(), ["Kurs (lokal)", "Messe", "Urlaub"])
+
+    def test_change_during_sync(self):
+        model = self.synced()
+        r = model.ranges[1].copy()
+        r.title = "Kurs (lokal)"
+        model.commit(r)
+
+        # The server changes after the changes were listed, the push fails
+        # with 412 and the next sync takes the server version.
+        multiget = self.client.multiget
+        def changing(paths):
+            items = multiget(paths)
+            self.remote(self.pathOf(1), "Kurs (Server)", "2025-03-03")
+            return items
+        self.client.multiget = changing
+
+        result = self.sync(model)
+        self.assertEqual((result.pushed, result.conflicts), (0, ["1"]))
+        self.assertEqual(model.ranges[1].title, "Kurs (lokal)")
+
+        self.client.multiget = multiget
+        self.sync(model)
+        self.assertEqual(model.ranges[1].title, "Kurs (Server)")
+
+    def test_sync_loads_only_updated_years(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "sync.json")
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-01"), plain("Urlaub", "2011-07-01")])
+        model.save(path)
+
+        model = Model.load(path)
+        self.assertEqual(self.sync(model).pushed, 2)
+        self.assertEqual(set(model.loadedSegments) & set([2010, 2011]), set())
+
+        self.remote(self.pathOf(1), "Kurs verlegt", "2010-03-02")
+        self.sync(model)
+        self.assertEqual(model.ranges[1].title, "Kurs verlegt")
+        self.assertIn(2010, model.loadedSegments)
+        self.assertNotIn(2011, model.loadedSegments)
+
+
+@unittest.skipIf(kalender_team is None, "NumPy is not installed")
+class TeamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.write("anna", [plain("Kurs", "2025-03-03", "2025-03-05")])
+        self.write("ben", [weekly("Chor", "2025-03-03")])
+        self.write("carla", [])
+
+    def write(self, name, ranges):
+        path = os.path.join(self.directory, name + ".json")
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        model = Model()
+        if ranges:
+            model.commitMany(ranges)
+        model.save(path)
+        # Also a rewrite within the timestamp resolution is another version.
+        if mtime is not None:
+            os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+    def test_unchanged_files_come_from_the_cache(self):
+        first, last = parse_date("2025-03-03"), parse_date("2025-03-11")
+        team = kalender_team.Team(self.directory).load(workers=2)
+        self.assertEqual((team.parsed, list(team.members)), (3, ["anna", "ben", "carla"]))
+        self.assertEqual(list(team.availability(first, last)), [1, 2, 2, 3, 3, 3, 3, 2, 3])
+
+        with mock.patch.object(kalender_team, "parse_member", side_effect=AssertionError):
+            cached = kalender_team.Team(self.directory).load()
+        self.assertEqual(cached.parsed, 0)
+        self.assertEqual(cached.busy(first, last).tolist(), team.busy(first, last).tolist())
+
+        # Only the changed file is parsed again, a removed one is dropped.
+        self.write("anna", [plain("Urlaub", "2025-03-10")])
+        os.remove(os.path.join(self.directory, "carla.json"))
+        with mock.patch.object(kalender_team, "parse_member", wraps=kalender_team.parse_member) as parse:
+            team = kalender_team.Team(self.directory).load()
+        parse.assert_called_once_with(os.path.join(self.directory, "anna.json"))
+        self.assertEqual((team.parsed, list(team.members)), (1, ["anna", "ben"]))
+        self.assertEqual(list(team.availability(first, last)), [1, 2, 2, 2, 2, 2, 2, 0, 2])
+        self.assertEqual(kalender_team.Team(self.directory).load().parsed, 0)
+
+
+class QueryServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "service.json")
+        self.save("Vorher")
+        self.service = kalender_service.QueryService([self.path], pollInterval=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, title, mtime=1000000000):
+        model = Model()
+        model.commit(plain(title, "2025-03-03"))
+        model.save(self.path)
+        os.utime(self.path, (mtime, mtime))
+
+    def titles(self):
+        status, body = self.service.respond("/ranges", {"from": "2025-03-03"})
+        return [r["title"] for r in json.loads(body.decode("utf-8"))["ranges"]]
+
+    def test_reload_during_query_is_not_cached(self):
+        index = self.service.indexes["service"]
+        query = index.query
+
+        def reloading(*args):
+            result = query(*args)
+            self.save("Nachher", mtime=1000000010)
+            self.service.poll()
+            return result
+
+        with mock.patch.object(index, "query", reloading):
+            self.assertEqual(self.titles(), ["Vorher"])
+        self.assertEqual(self.titles(), ["Nachher"])
+
+    def test_unknown_paths_are_not_found(self):
+        self.assertEqual(self.service.respond("/unbekannt", {})[0], 404)
+        self.assertEqual(self.service.respond("/ranges", {"file": "fehlt", "from": "2025-03-03"})[0], 404)
+        self.assertEqual(self.service.respond("/ranges", {"from": "03.03.2025"})[0], 400)
+
+
+@unittest.skipIf(kalender is None, "PySide2 is not installed")
+class MainWindowTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        for format in (kalender.QSettings.NativeFormat, kalender.QSettings.IniFormat):
+            kalender.QSettings.setPath(format, kalender.QSettings.UserScope, cls.directory)
+        cls.app = kalender.QApplication.instance() or kalender.Application(["kalender"])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.window = kalender.MainWindow(self.app)
+
+    def tearDown(self):
+        self.window.calendar.shutdown()
+        self.window.minimap.shutdown()
+        self.window.hide()
+        self.window.deleteLater()
+        self.app.sendPostedEvents(None, kalender.QEvent.DeferredDelete)
+        self.app.processEvents()
+
+    def copyYear(self, model, source, target):
+        values = (source, target, COPY_SAME_DATE, "", None, False)
+        dialog = mock.Mock(**{"return_value.exec_.return_value": True, "return_value.values.return_value": values})
+        self.window.setModel(model)
+        with mock.patch.object(kalender, "CopyYearDialog", dialog):
+            self.window.onCopyYearAction()
+
+    def test_copy_year_out_of_evicted_year(self):
+        path = os.path.join(self.directory, "copy.json")
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-%02d" % day) for day in (1, 2, 3, 4)])
+        model.save(path)
+
+        with mock.patch.object(kalender_core, "SEGMENT_RANGE_BUDGET", 3):
+            model = Model.load(path)
+            model.ensureDates(parse_date("2010-01-01"), parse_date("2010-12-31"))
+            model.evict()
+            self.assertNotIn(2010, model.loadedSegments)
+
+            self.copyYear(model, 2010, 2011)
+            copied = [r for r in model.ranges.values() if not r.deleted and year_of(r.start) == 2011]
+            self.assertEqual(len(copied), 4)
+            model.save(path)
+
+            # The copies in the evicted target year count as duplicates.
+            model = Model.load(path)
+            model.evict()
+            self.assertNotIn(2011, model.loadedSegments)
+            self.copyYear(model, 2010, 2011)
+            model.loadAll()
+            copied = [r for r in model.ranges.values() if not r.deleted and year_of(r.start) == 2011]
+            self.assertEqual(len(copied), 4)
+
+    def test_segments_are_loaded_outside_of_paint(self):
+        path = os.path.join(self.directory, "paint.json")
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-01")])
+        model.save(path)
+
+        model = Model.load(path)
+        self.window.setModel(model)
+        self.window.resize(1000, 700)
+        self.window.show()
+        calendar = self.window.calendar
+        calendar.targetOffset = calendar.offset = float(month_index(2010, 1))
+
+        with mock.patch.object(model, "ensureDates", wraps=model.ensureDates) as ensureDates:
+            calendar.repaint()
+            self.assertFalse(ensureDates.called)
+
+            calendar.requestSegments()
+            calendar.segmentTimer.timeout.emit()
+            self.assertTrue(ensureDates.called)
+        self.assertIn(2010, model.loadedSegments)
+
+    def test_agenda_and_reminders_keep_evicted_years(self):
+        path = os.path.join(self.directory, "agenda.json")
+        tomorrow = datetime.date.today().toordinal() + 1
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-01", "2010-03-02"), plain("Kurs", "2010-03-02"), plain("Zahnarzt", format_date(tomorrow))])
+        model.save(path)
+
+        model = Model.load(path)
+        with mock.patch.object(model, "readSegment", side_effect=AssertionError):
+            self.window.setModel(model)
+        agenda = self.window.agendaDock.agenda
+        reminders = self.window.reminders.reminders
+        self.assertEqual(agenda.rowCount(), 3)
+        self.assertEqual(agenda.data(agenda.index(0, kalender.AGENDA_TITLE)), "Kurs")
+        self.assertNotIn(2010, model.loadedSegments)
+
+        with mock.patch.object(kalender_core, "SEGMENT_RANGE_BUDGET", 0):
+            model.ensureDates(parse_date("2010-01-01"), parse_date("2010-12-31"))
+            model.evict()
+            self.assertNotIn(2010, model.loadedSegments)
+
+        self.assertEqual(agenda.rowCount(), 3)
+        self.assertEqual(agenda.rangeAt(1).start, parse_date("2010-03-02"))
+        self.assertIn(3, reminders.ranges)
+        self.assertEqual(self.window.calendar.conflicts.conflicting, {1: {2}, 2: {1}})
+
+    def test_thumbnails_of_evicted_years(self):
+        path = os.path.join(self.directory, "minimap.json")
+        model = Model()
+        model.commitMany([plain("Kurs", "2010-03-01"), plain("Urlaub", "2011-07-01")])
+        model.save(path)
+
+        model = Model.load(path)
+        self.window.setModel(model)
+        minimap = self.window.minimap
+        with mock.patch.object(kalender, "ThumbnailTask") as task, mock.patch.object(minimap.pool, "start"):
+            minimap.requestThumbnail(2010 - 1900)
+        ranges = task.call_args[0][2]
+        self.assertEqual([r.title for r in ranges], ["Kurs"])
+        self.assertNotIn(2010, model.loadedSegments)
+
+    def test_overview_and_hits_follow_changed_months(self):
+        model = Model()
+        model.commitMany([plain("Kurs", "2025-03-01", "2025-03-03"), plain("Urlaub", "2025-07-01"), plain("Messe", "2026-01-05")])
+        self.window.setModel(model)
+        self.window.resize(1000, 700)
+        self.window.show()
+        calendar = self.window.calendar
+        march, july = month_index(2025, 3), month_index(2025, 7)
+
+        image = calendar.overviewImage(2025 - 1900)
+        other = calendar.overviewImage(2026 - 1900)
+        color = kalender.qcolor(ACCENT_COLORS[0]).rgba()
+        self.assertEqual([image.pixel(2 * 2 + 1, day) == color for day in range(4)], [True, True, True, False])
+        self.assertEqual([segment[3] for segment in calendar.hitSegments(march)], [1])
+        julySegments = calendar.hitSegments(july)
+
+        model.commit(plain("Neu", "2025-03-10"))
+        self.assertNotIn(2025 - 1900, calendar.overviewImages)
+        self.assertIs(calendar.overviewImage(2026 - 1900), other)
+        self.assertIs(calendar.hitSegments(july), julySegments)
+        self.assertEqual(sorted(segment[3] for segment in calendar.hitSegments(march)), [1, 4])
+
+
+    def test_drag_is_one_commit(self):
+        model = Model()
+        model.commitMany([plain("Kurs", "2025-03-03", "2025-03-05"), plain("Urlaub", "2025-07-01")])
+        self.window.setModel(model)
+        self.window.resize(1000, 700)
+        self.window.show()
+        calendar = self.window.calendar
+        march = month_index(2025, 3)
+        calendar.targetOffset = calendar.offset = float(march)
+        x = int(calendar.hitSegments(march)[0][0])
+
+        def send(kind, day, button=kalender.Qt.LeftButton):
+            pos = kalender.QPoint(x, 40 + 20 + (day - 1) * calendar.rowHeight + calendar.rowHeight // 2)
+            buttons = kalender.Qt.NoButton if kind == kalender.QEvent.MouseButtonRelease else kalender.Qt.LeftButton
+            event = kalender.QMouseEvent(kind, pos, button, buttons, kalender.Qt.NoModifier)
+            self.app.sendEvent(calendar, event)
+
+        undoSteps = len(model.undoStack)
+        with mock.patch.object(model, "commit", wraps=model.commit) as commit:
+            send(kalender.QEvent.MouseButtonPress, 4)
+            for day in range(5, 11):
+                send(kalender.QEvent.MouseMove, day, kalender.Qt.NoButton)
+            self.assertFalse(commit.called)
+            self.assertEqual(format_date(calendar.dragPreview.start), "2025-03-09")
+            send(kalender.QEvent.MouseButtonRelease, 10)
+            self.assertEqual(commit.call_count, 1)
+        self.assertEqual((format_date(model.ranges[1].start), format_date(model.ranges[1].end)), ("2025-03-09", "2025-03-11"))
+        self.assertEqual(len(model.undoStack), undoSteps + 1)
+
+        # The end circle resizes, Escape drops the drag.
+        with mock.patch.object(model, "commit", wraps=model.commit) as commit:
+            send(kalender.QEvent.MouseButtonPress, 11)
+            for day in range(12, 15):
+                send(kalender.QEvent.MouseMove, day, kalender.Qt.NoButton)
+            self.assertEqual(calendar.dragMode, kalender.DRAG_END)
+            self.app.sendEvent(calendar, kalender.QKeyEvent(kalender.QEvent.KeyPress, kalender.Qt.Key_Escape, kalender.Qt.NoModifier))
+            send(kalender.QEvent.MouseButtonRelease, 14)
+            self.assertFalse(commit.called)
+        self.assertEqual(format_date(model.ranges[1].end), "2025-03-11")
+
+        model.undo()
+        self.assertEqual(format_date(model.ranges[1].start), "2025-03-03")
+
+
+if __name__ == "__main__":
+    unittest.main()